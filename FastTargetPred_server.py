@@ -0,0 +1,30 @@
+__version__ = "1.2"
+
+# Python 3.7 Built-in packages
+import sys
+
+if sys.version_info < (3, 7):
+    print("This program only works with Python 3.7+ version. Please install a newer python version.")
+    sys.exit(1)
+
+# Local packages
+from src import texts
+from src.misc import system_verification, clean_up
+from src.server import start
+
+
+def main():
+    print(texts.app_header.format(__version__))
+    print(texts.check_system, end='')
+    system_ok, messages = system_verification()
+    if system_ok:
+        print(texts.checked)
+        start()
+    else:
+        print(texts.system_not_ok + '\n\t'.join(messages))
+    clean_up()
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# Python 3.7 Built-in packages
+import argparse
+import contextlib
+import io
+import random
+import sys
+import time
+from pathlib import Path
+
+# Run from anywhere : the application paths are computed from argv[0]
+BASE_PATH = Path(__file__).resolve().parent.parent
+sys.argv[0] = str(BASE_PATH / "FastTargetPred.py")
+sys.path.insert(0, str(BASE_PATH))
+
+# Local packages
+from src import config
+from src.arg_parsing import _get_argparse_setup, ARGS_LIST, UserArguments
+from src.database import open_database
+from src.fingerprints import FingerprintList
+from src.misc import clean_up
+from src.molecules import MoleculeList
+
+"""
+Compare the throughput of the Tanimoto execution backends (-backend processes / threads).
+Query fingerprints are taken from the database itself, slightly mutated, so no MayaChemTools run is needed.
+"""
+
+
+def write_query_fpf(directory: Path, db_path: str, fp_name: str, query_number: int, seed: int) -> Path:
+    # Write a MayaChemTools-like .fpf file holding query_number fingerprints derived from database compounds
+    database = open_database(db_path, fp_name)
+    fp_byte_size = (config.FINGERPRINT_SIZE[fp_name] + 7) // 8
+    rng = random.Random(seed)
+    lines = ["# Benchmark query fingerprints"]
+    for q in range(query_number):
+        i = (q * 7919) % len(database)
+        fp = bytearray(database.fingerprints[i * database.stride:i * database.stride + fp_byte_size])
+        for _ in range(rng.randint(0, 16)):
+            bit = rng.randrange(config.FINGERPRINT_SIZE[fp_name])
+            fp[bit // 8] ^= 1 << (bit % 8)
+        lines.append("Q{} {}".format(q, fp.hex()))
+    fpf = Path(directory, "bench_{}.fpf".format(fp_name))
+    fpf.write_text("\n".join(lines) + "\n", encoding=config.ENCODING)
+    return fpf
+
+
+def run(backend: str, cpu: int, db_path: str, fp_names: list, query_number: int, output: Path) -> float:
+    if output.is_file():
+        output.unlink()
+    arg_dict = vars(_get_argparse_setup().parse_args([
+        "bench.sdf", "-db", db_path, "-fp", *fp_names, "-cpu", str(cpu), "-backend", backend, "-o", str(output), "-noinfo", "-nofpcache"
+    ]))
+    user_args = UserArguments({a: arg_dict[a] for a in ARGS_LIST})
+
+    Path(config.BASE_TEMP_DIR).mkdir(parents=True, exist_ok=True)
+    fps = FingerprintList(user_args, Path("bench.sdf"))
+    fps.create_fingerprints()
+    fps.db_list = [open_database(db_path, fp_name) for fp_name in fp_names]
+    fps.tc_threshold_list = [user_args.get_tc_threshold(fp_name) for fp_name in fp_names]
+    fpf_list = [
+        (write_query_fpf(Path(config.BASE_TEMP_DIR), db_path, fp_name, query_number, 0), config.FINGERPRINT_SIZE[fp_name], fp_name)
+        for fp_name in fp_names
+    ]
+    fps._db_thread.start()
+    fps.assemble_files(fpf_list)
+
+    t0 = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        molecules = MoleculeList.create_list(user_args, fps.query_dicts, fps)
+        molecules.compute_fingerprints()
+    elapsed = time.time() - t0
+    clean_up()
+    return elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the Tanimoto execution backends.")
+    parser.add_argument("-db", default=str(BASE_PATH / "db" / "approved-drugs"), help="Database to screen")
+    parser.add_argument("-fp", nargs="+", default=[config.DEFAULT_FP], help="Fingerprint(s)")
+    parser.add_argument("-n", type=int, nargs="+", default=[10, 100, 1000], help="Query molecule numbers")
+    parser.add_argument("-cpu", type=int, default=config.DEFAULT_NUM_CORE, help="Workers")
+    parser.add_argument("-repeat", type=int, default=3, help="Runs per measure, the best one is kept")
+    args = parser.parse_args()
+
+    output = Path(config.BASE_PATH, "out", "bench_backends.txt")
+    output.parent.mkdir(exist_ok=True)
+    print("{:<10} {:>10} {:>12} {:>14}".format("backend", "molecules", "seconds", "molecules/s"))
+    for query_number in args.n:
+        for backend in config.AVAILABLE_BACKEND:
+            elapsed = min(run(backend, args.cpu, args.db, args.fp, query_number, output) for _ in range(args.repeat))
+            print("{:<10} {:>10} {:>12.3f} {:>14.1f}".format(backend, query_number, elapsed, query_number / elapsed))
+    output.unlink()
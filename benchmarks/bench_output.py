@@ -0,0 +1,76 @@
+# Python 3.7 Built-in packages
+import argparse
+import queue
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# Run from anywhere : the application paths are computed from argv[0]
+BASE_PATH = Path(__file__).resolve().parent.parent
+sys.argv[0] = str(BASE_PATH / "FastTargetPred.py")
+sys.path.insert(0, str(BASE_PATH))
+
+# Local packages
+from src import config
+from src.output import OutputObject
+from src.target_info import open_target_info
+
+"""
+Measure the output throughput (hit rows written per second) of each output format written to a file.
+Results are synthetic : -n query molecules with -nbt targets each, one hit per target, as the tanimoto workers
+queue them. "csv reopen" writes the csv format the way the output used to, opening the file for every molecule.
+"""
+
+
+class ReopeningOutputObject(OutputObject):  # Reference : one open, write and close of the output file per molecule
+    def write_string(self, s: str):
+        with self.file.open('a', encoding=config.ENCODING) as f:
+            f.write(s)
+
+
+def synthetic_results(query_number: int, target_number: int, target_ids: list, seed: int) -> list:
+    rng = random.Random(seed)
+    return [
+        ({target_id: [("CHEMBL{}".format(rng.randrange(10 ** 6)), rng.uniform(0.3, 1.))] for target_id in rng.sample(target_ids, target_number)}
+         , "Q{}".format(q))
+        for q in range(query_number)
+    ]
+
+
+def run(output_class, output_format: str, results: list, target_number: int, show_info: bool, directory: Path) -> float:
+    output = Path(directory, "bench_output.{}".format(output_format))
+    if output.is_file():
+        output.unlink()
+    output_object = output_class(1, output_format, target_number, show_info)
+    output_object.file = str(output)
+    output_queue = queue.Queue()
+    for result in results:
+        output_queue.put(result)
+
+    t0 = time.time()
+    output_object.watch_output(open_target_info(config.DEFAULT_UNIPROT_DATABASE__CHEMBL_FILE_NAME), output_queue, len(results))
+    output_object.wait()
+    return time.time() - t0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the output formats.")
+    parser.add_argument("-n", type=int, default=10000, help="Query molecule number")
+    parser.add_argument("-nbt", type=int, default=100, help="Targets reported per molecule")
+    parser.add_argument("-noinfo", action="store_true", help="Only print the UniProt and ChEMBL ids of the targets")
+    parser.add_argument("-repeat", type=int, default=3, help="Runs per measure, the best one is kept")
+    args = parser.parse_args()
+
+    target_ids = ["CHEMBL{}".format(i) for i in range(max(args.nbt, 2000))]
+    results = synthetic_results(args.n, args.nbt, target_ids, 0)
+    row_number = args.n * args.nbt
+    sinks = [(ReopeningOutputObject, config.CSV_FILE_FORMAT, "csv reopen")] + [
+        (OutputObject, output_format, output_format) for output_format in config.AVAILABLE_FILE_FORMAT
+    ]
+    print("{:<12} {:>10} {:>12} {:>14}".format("format", "rows", "seconds", "rows/s"))
+    with tempfile.TemporaryDirectory() as directory:
+        for output_class, output_format, label in sinks:
+            elapsed = min(run(output_class, output_format, results, args.nbt, not args.noinfo, Path(directory)) for _ in range(args.repeat))
+            print("{:<12} {:>10} {:>12.3f} {:>14.0f}".format(label, row_number, elapsed, row_number / elapsed))
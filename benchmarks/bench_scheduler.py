@@ -0,0 +1,114 @@
+# Python 3.7 Built-in packages
+import argparse
+import heapq
+import math
+import queue
+import sys
+import time
+from pathlib import Path
+
+# Run from anywhere : the application paths are computed from argv[0]
+BASE_PATH = Path(__file__).resolve().parent.parent
+sys.argv[0] = str(BASE_PATH / "FastTargetPred.py")
+sys.path.insert(0, str(BASE_PATH))
+
+# Local packages
+from src import config
+from src.arg_parsing import _get_argparse_setup, ARGS_LIST, UserArguments
+from src.database import open_database
+from src.fingerprints import FingerprintList
+from src.misc import clean_up
+from src.molecule import compute_tanimoto_batch
+from src.molecules import MoleculeList, tanimoto_batch_size
+from src.scheduler import BatchScheduler, estimated_cost
+from bench_backends import write_query_fpf
+
+"""
+Compare the static partition of the molecules (floor(n / cpu) molecules per worker, in input order) with the
+batch scheduler (-cpu workers pulling guided batches, costliest molecules first).
+The kernel time of every molecule is measured once, on one core, then both schedules are replayed on -cpu cores :
+the results don't depend on the cores of the machine running the benchmark. Batching gains are left out of both.
+Static partitions with more chunks than cores share the cores equally, as processes do.
+"""
+
+
+def molecule_times(db_path: str, fp_name: str, tc: float, query_number: int) -> list:
+    # (molecule, seconds) couples, in input order
+    arg_dict = vars(_get_argparse_setup().parse_args([
+        "bench.sdf", "-db", db_path, "-fp", fp_name, "-tc", str(tc), "-cpu", "1", "-noinfo", "-nofpcache"
+    ]))
+    user_args = UserArguments({a: arg_dict[a] for a in ARGS_LIST})
+
+    Path(config.BASE_TEMP_DIR).mkdir(parents=True, exist_ok=True)
+    fps = FingerprintList(user_args, Path("bench.sdf"))
+    fps.create_fingerprints()
+    fps.db_list = [open_database(db_path, fp_name)]
+    fps.tc_threshold_list = [user_args.get_tc_threshold(fp_name)]
+    fpf = write_query_fpf(Path(config.BASE_TEMP_DIR), db_path, fp_name, query_number, 0)
+    fps._db_thread.start()
+    fps.assemble_files([(fpf, config.FINGERPRINT_SIZE[fp_name], fp_name)])
+    molecules = MoleculeList.create_list(user_args, fps.query_dicts, fps).molecules
+    target_table = fps.get_db()
+
+    times = []
+    for molecule in molecules:
+        t0 = time.perf_counter()
+        compute_tanimoto_batch([molecule], target_table, queue.Queue(), queue.Queue())
+        times.append((molecule, time.perf_counter() - t0))
+    clean_up()
+    return times
+
+
+def shared_makespan(works: list, cores: int) -> float:
+    # Time to run jobs started together, each active job getting an equal share of the cores (at most one)
+    elapsed, done = 0., 0.
+    works = sorted(works)
+    for i, work in enumerate(works):
+        elapsed += (work - done) / min(1., cores / (len(works) - i))
+        done = work
+    return elapsed
+
+
+def static_makespan(times: list, cpu: int) -> float:
+    chunk_size = max(math.floor(len(times) / cpu), 1)
+    return shared_makespan([sum(times[i:i + chunk_size]) for i in range(0, len(times), chunk_size)], cpu)
+
+
+def scheduled_makespan(times: list, cpu: int, max_batch_size: int) -> float:
+    # Each batch goes to the first worker done with its previous one
+    worker_number = min(cpu, len(times))
+    scheduler = BatchScheduler(len(times), worker_number, max_batch_size, shared=False)
+    workers = [0.] * worker_number
+    batch = scheduler.next_batch()
+    while batch is not None:
+        start, end = batch
+        heapq.heappush(workers, heapq.heappop(workers) + sum(times[start:end]))
+        batch = scheduler.next_batch()
+    return max(workers)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the scheduling of molecules over the workers.")
+    parser.add_argument("-db", default=str(BASE_PATH / "db" / "approved-drugs"), help="Database to screen")
+    parser.add_argument("-fp", default=config.DEFAULT_FP, help="Fingerprint")
+    parser.add_argument("-tc", type=float, default=config.DEFAULT_TC_THRESHOLD[config.DEFAULT_FP], help="Tanimoto threshold")
+    parser.add_argument("-n", type=int, nargs="+", default=[10, 100, 1000], help="Query molecule numbers")
+    parser.add_argument("-cpu", type=int, nargs="+", default=[4, 16], help="Workers")
+    args = parser.parse_args()
+
+    print("{:>10} {:>5} {:>12} {:>12} {:>12} {:>10} {:>10}".format(
+        "molecules", "cpu", "static s", "input s", "longest s", "static %", "longest %"
+    ))
+    for query_number in args.n:
+        measured = molecule_times(args.db, args.fp, args.tc, query_number)
+        input_order = [seconds for molecule, seconds in measured]
+        longest_first = [seconds for molecule, seconds in sorted(measured, key=lambda m: estimated_cost(m[0]), reverse=True)]
+        max_batch_size = tanimoto_batch_size([molecule for molecule, seconds in measured])
+        for cpu in args.cpu:
+            static = static_makespan(input_order, cpu)
+            longest = scheduled_makespan(longest_first, cpu, max_batch_size)
+            ideal = sum(input_order) / min(cpu, query_number)  # Core utilization : ideal time over makespan
+            print("{:>10} {:>5} {:>12.4f} {:>12.4f} {:>12.4f} {:>10.1f} {:>10.1f}".format(
+                query_number, cpu, static, scheduled_makespan(input_order, cpu, max_batch_size), longest
+                , 100 * ideal / static, 100 * ideal / longest
+            ))
@@ -0,0 +1,83 @@
+# Python 3.7 Built-in packages
+import random
+import sys
+import typing
+from pathlib import Path
+
+# Run from anywhere : the application paths are computed from argv[0]
+BASE_PATH = Path(__file__).resolve().parent.parent
+sys.argv[0] = str(BASE_PATH / "FastTargetPred.py")
+sys.path.insert(0, str(BASE_PATH))
+
+# Local packages
+from src import config
+from src.database import open_database
+from src.fingerprint_cache import molecule_key
+from src.fingerprint_providers import MayaProvider
+from src.sdf_index import SDFIndex
+
+"""
+Deterministic stand-in for the MayaChemTools fingerprint scripts, so the fingerprint stage runs without Perl.
+It is called with the command line MayaProvider builds, behind "-db <database>" :
+   python3.7 benchmarks/maya_stub.py -db db/approved-drugs ExtendedConnectivityFingerprints.pl -m ... -r <name> -o "<sdf>"
+and writes <name>.fpf in the working directory, like the real script. The fingerprint of a molecule is the one of
+a database compound picked from a hash of its structure, with a few bits flipped : the same molecule always gets the
+same fingerprint and queries find hits in the database, as real ones do. The structure is hashed like the fingerprint
+cache keys (see molecule_key) : molecules only differing by their name get the same fingerprint, cached or not.
+"""
+
+MUTATED_BITS = 16  # At most this number of bits flipped in the database fingerprint
+
+
+class StubMayaProvider(MayaProvider):  # MayaChemTools provider running the stub instead of Perl
+    def __init__(self, db_path: str):
+        self.maya_path = Path()
+        self.perl_path = '"{}" "{}" -db "{}"'.format(sys.executable, Path(__file__).resolve(), db_path)
+
+
+def fingerprint_name(script: str, maya_arguments: typing.List[str]) -> str:
+    # Fingerprint computed by a MayaChemTools command line (see config.FINGERPRINT_CMD)
+    command = " ".join(maya_arguments)
+    for fp_name, (fp_script, fp_cmd) in config.FINGERPRINT_CMD.items():
+        if fp_script == script and fp_cmd in command:
+            return fp_name
+    raise ValueError("Unknown MayaChemTools command : {} {}".format(script, command))
+
+
+def stub_fingerprints(db_path: str, fp_name: str, sdf: Path) -> typing.Iterator[typing.Tuple[str, bytes]]:
+    # (molecule name, fingerprint) couples of the molecules of sdf, in file order
+    database = open_database(db_path, fp_name)
+    fp_byte_size = (config.FINGERPRINT_SIZE[fp_name] + 7) // 8
+    index = SDFIndex([sdf])
+    try:
+        for i, name in enumerate(index.names):
+            seed = int.from_bytes(molecule_key(index.block(i), "")[:8], 'little')
+            rng = random.Random(seed)
+            j = seed % len(database)
+            fp = bytearray(database.fingerprints[j * database.stride:j * database.stride + fp_byte_size])
+            for _ in range(rng.randint(0, MUTATED_BITS)):
+                bit = rng.randrange(config.FINGERPRINT_SIZE[fp_name])
+                fp[bit // 8] ^= 1 << (bit % 8)
+            yield name, bytes(fp)
+    finally:
+        index.close()
+
+
+def main(argv: typing.List[str]) -> int:
+    if len(argv) < 3 or argv[0] != "-db":
+        print("Usage : maya_stub.py -db <database> <MayaChemTools script> <script arguments>", file=sys.stderr)
+        return 2
+    db_path, script, maya_arguments = argv[1], argv[2], argv[3:]
+    fp_name = fingerprint_name(script, maya_arguments)
+    fpf = Path(maya_arguments[maya_arguments.index("-r") + 1] + ".fpf")
+    sdf = Path(maya_arguments[maya_arguments.index("-o") + 1])
+
+    lines = ["# MayaChemTools stand-in : {} fingerprints of {}".format(fp_name, sdf)]
+    lines += ["{} {}".format(name, fp.hex()) for name, fp in stub_fingerprints(db_path, fp_name, sdf)]
+    fpf.write_text("\n".join(lines) + "\n", encoding=config.ENCODING)
+    print("{} fingerprints of {} molecules written in {}".format(fp_name, len(lines) - 1, fpf))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,281 @@
+# Python 3.7 Built-in packages
+import argparse
+import json
+import os
+import platform
+import queue
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+from datetime import datetime
+from pathlib import Path
+
+# Run from anywhere : the application paths are computed from argv[0]
+BASE_PATH = Path(__file__).resolve().parent.parent
+sys.argv[0] = str(BASE_PATH / "FastTargetPred.py")
+sys.path.insert(0, str(BASE_PATH))
+
+# Local packages
+from src import config
+from src.arg_parsing import _get_argparse_setup, ARGS_LIST, UserArguments
+from src.database import kernel_arguments
+from src.fingerprints import FingerprintList
+from src.molecule import Molecule, compute_tanimoto_batch, tc_process_arrays
+from src.molecules import MoleculeList, tanimoto_batch_size
+from src.output import OutputObject
+from src.target_info import open_target_info
+from maya_stub import StubMayaProvider
+
+"""
+Time every stage of a prediction on one SD file : SD file checking, fingerprint files (MayaChemTools replaced by
+maya_stub.py, so no Perl is needed), fingerprint assembly, the Tanimoto kernel for each fingerprint and in consensus,
+the best match per target and each output format. Stages run -repeat times on one core, the best time is kept.
+The report (-o) is a JSON file. Given the report of another commit (-compare), stages slower than it by more than
+-threshold are listed and the exit status is 1 :
+   python3.7 benchmarks/suite.py -o base.json
+   python3.7 benchmarks/suite.py -compare base.json
+"""
+
+REPORT_VERSION = 1
+
+
+def user_arguments(sdf: Path, db_path: str, fp_names: typing.List[str], show_info: bool) -> UserArguments:
+    arg_dict = vars(_get_argparse_setup().parse_args([
+        str(sdf), "-db", db_path, "-fp", *fp_names, "-cpu", "1", "-nofpcache", *([] if show_info else ["-noinfo"])
+    ]))
+    return UserArguments({a: arg_dict[a] for a in ARGS_LIST})
+
+
+class Stage(typing.NamedTuple):
+    name: str
+    times: typing.List[float]  # Seconds, one per run
+    items: int                 # Work of one run : molecules, comparisons or hits (see unit)
+    unit: str
+
+    def report(self) -> dict:
+        best = min(self.times)
+        return {
+            "best": best
+            , "median": statistics.median(self.times)
+            , "items": self.items
+            , "unit": self.unit
+            , "throughput": self.items / best if best > 0 else 0.
+            , "times": self.times
+        }
+
+
+def measure(name: str, function: typing.Callable[[], float], repeat: int, items: int, unit: str) -> Stage:
+    # function runs the stage once and returns the seconds spent in it, setup left out
+    return Stage(name, [function() for _ in range(repeat)], items, unit)
+
+
+class Pipeline(object):  # Query molecules of one fingerprint set, ready for the kernel
+    def __init__(self, sdf: Path, db_path: str, fp_names: typing.List[str], show_info: bool
+                 , fingerprints: typing.Dict[str, typing.Dict[str, bytes]]):
+        self.fp_names = fp_names
+        self.user_arguments = user_arguments(sdf, db_path, fp_names, show_info)
+        self.fingerprints = [fingerprints[fp_name] for fp_name in fp_names]
+        self.fps = FingerprintList(self.user_arguments, sdf)
+        self.fps.create_fingerprints()
+        self.fps.use_fingerprints(self.fingerprints)
+        self.molecules: typing.List[Molecule] = MoleculeList.create_list(self.user_arguments, self.fps.query_dicts, self.fps).molecules
+        self.batch_size = tanimoto_batch_size(self.molecules)
+
+    @property
+    def comparisons(self) -> int:  # Database compounds compared by the kernel in one run
+        return len(self.molecules) * sum(len(database) for database in self.fps.db_list)
+
+    def batches(self) -> typing.Iterator[typing.List[Molecule]]:
+        for i in range(0, len(self.molecules), self.batch_size):
+            yield self.molecules[i:i + self.batch_size]
+
+    def assemble(self) -> float:
+        self.fps.query_dicts = []
+        t0 = time.perf_counter()
+        self.fps.assemble_fingerprints([
+            (fingerprints, config.FINGERPRINT_SIZE[fp_name]) for fingerprints, fp_name in zip(self.fingerprints, self.fp_names)
+        ])
+        return time.perf_counter() - t0
+
+    def tc_process(self) -> float:  # Kernel calls only, batched as the workers do
+        t0 = time.perf_counter()
+        for batch in self.batches():
+            query_row, databases, *static_arguments = batch[0].tc_process_args
+            tc_process_arrays(
+                *batch[0].query_fingerprints.kernel_arguments([molecule.query_row for molecule in batch])
+                , kernel_arguments(databases)
+                , *static_arguments
+            )
+        return time.perf_counter() - t0
+
+    def compute_hits(self) -> int:  # Fill the hits of every molecule, return their number
+        target_table = self.fps.get_db()
+        for batch in self.batches():
+            compute_tanimoto_batch(batch, target_table, queue.Queue(), queue.Queue())
+        return sum(len(molecule.hits) for molecule in self.molecules)
+
+    def compute_bmpt(self) -> float:
+        t0 = time.perf_counter()
+        for molecule in self.molecules:
+            molecule.compute_bmpt()
+        return time.perf_counter() - t0
+
+    def output(self, output_format: str, info_path: str, directory: Path) -> float:
+        output = Path(directory, "suite.{}".format(output_format))
+        if output.is_file():
+            output.unlink()
+        output_object = OutputObject(1, output_format, self.user_arguments.max_target_number, self.user_arguments.show_info)
+        output_object.file = str(output)
+        output_object.target_info = open_target_info(info_path)
+        t0 = time.perf_counter()
+        for molecule in self.molecules:
+            output_object.process_output(molecule.hit_results_dict, molecule.name)
+        output_object.close()
+        return time.perf_counter() - t0
+
+
+def sdf_check(sdf: Path, db_path: str, fp_names: typing.List[str]) -> typing.Tuple[float, int]:
+    user_args = user_arguments(sdf, db_path, fp_names, False)
+    t0 = time.perf_counter()
+    user_args.check_sdf()
+    elapsed = time.perf_counter() - t0
+    molecule_number = len(user_args.sdf_index)
+    user_args.sdf_index.close()
+    return elapsed, molecule_number
+
+
+def fingerprint_files(sdf: Path, db_path: str, fp_names: typing.List[str]
+                      , fingerprints: typing.Dict[str, typing.Dict[str, bytes]]) -> float:
+    # Compute the fingerprints of every molecule with the MayaChemTools stand-in, into fingerprints
+    provider = StubMayaProvider(db_path)
+    t0 = time.perf_counter()
+    for fp_name in fp_names:
+        fingerprints[fp_name] = provider.compute(fp_name, sdf)
+    return time.perf_counter() - t0
+
+
+def run_suite(sdf: Path, db_path: str, fp_names: typing.List[str], info_path: str, show_info: bool, repeat: int, directory: Path
+              ) -> typing.List[Stage]:
+    check_times = [sdf_check(sdf, db_path, fp_names) for _ in range(repeat)]
+    molecule_number = check_times[0][1]
+    stages = [Stage("sdf_check", [seconds for seconds, n in check_times], molecule_number, "molecules")]
+
+    fingerprints = {}
+    stages.append(measure(
+        "fingerprint_files", lambda: fingerprint_files(sdf, db_path, fp_names, fingerprints), repeat, molecule_number * len(fp_names)
+        , "fingerprints"
+    ))
+
+    pipelines = [Pipeline(sdf, db_path, [fp_name], show_info, fingerprints) for fp_name in fp_names]
+    consensus = Pipeline(sdf, db_path, fp_names, show_info, fingerprints) if len(fp_names) > 1 else None
+    assembled = consensus if consensus is not None else pipelines[0]
+    stages.append(measure("fingerprint_assembly", assembled.assemble, repeat, molecule_number * len(fp_names), "fingerprints"))
+
+    for pipeline in pipelines + ([consensus] if consensus is not None else []):
+        name = "tc_process_{}".format("consensus" if pipeline is consensus else pipeline.fp_names[0])
+        stages.append(measure(name, pipeline.tc_process, repeat, pipeline.comparisons, "comparisons"))
+
+    # Best match per target and output : results of the first fingerprint alone, the default run
+    hit_number = pipelines[0].compute_hits()
+    stages.append(measure("compute_bmpt", pipelines[0].compute_bmpt, repeat, hit_number, "hits"))
+    for output_format in config.AVAILABLE_FILE_FORMAT:
+        stages.append(measure(
+            "output_{}".format(output_format), lambda: pipelines[0].output(output_format, info_path, directory), repeat, molecule_number, "molecules"
+        ))
+    return stages
+
+
+def git_commit() -> typing.Optional[str]:
+    # Commit of the benchmarked tree, marked "+" when it has uncommitted changes
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=str(BASE_PATH), capture_output=True, encoding=config.ENCODING, check=True)
+        status = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"], cwd=str(BASE_PATH), capture_output=True, encoding=config.ENCODING, check=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit.stdout.strip() + ("+" if status.stdout.strip() else "")
+
+
+def make_report(stages: typing.List[Stage], parameters: dict) -> dict:
+    return {
+        "version": REPORT_VERSION
+        , "commit": git_commit()
+        , "date": datetime.now().isoformat(timespec="seconds")
+        , "python": platform.python_version()
+        , "platform": platform.platform()
+        , "cpu_count": os.cpu_count()
+        , "parameters": parameters
+        , "stages": {stage.name: stage.report() for stage in stages}
+    }
+
+
+def compare_reports(report: dict, baseline: dict, threshold: float, noise: float) -> typing.List[str]:
+    """
+    Print the best time of every stage against the baseline report. Return the stages slower than the baseline by more
+    than threshold (a fraction of its time) plus noise (seconds), the timer resolution and scheduling jitter.
+    """
+    if report["parameters"] != baseline["parameters"]:
+        print("Warning : the reports were measured with different parameters, times may not be comparable.")
+    regressions = []
+    print("{:<24} {:>12} {:>12} {:>8}  {}".format("stage", "baseline s", "current s", "ratio", "status"))
+    for name, stage in report["stages"].items():
+        if name not in baseline["stages"]:
+            print("{:<24} {:>12} {:>12.4f} {:>8}  {}".format(name, "-", stage["best"], "-", "new"))
+            continue
+        base = baseline["stages"][name]["best"]
+        ratio = stage["best"] / base if base > 0 else float("inf")
+        status = "ok"
+        if stage["best"] > base * (1 + threshold) + noise:
+            status = "REGRESSION"
+            regressions.append(name)
+        elif stage["best"] < base * (1 - threshold) - noise:
+            status = "faster"
+        print("{:<24} {:>12.4f} {:>12.4f} {:>8.2f}  {}".format(name, base, stage["best"], ratio, status))
+    for name in baseline["stages"]:
+        if name not in report["stages"]:
+            print("{:<24} {:>12.4f} {:>12} {:>8}  {}".format(name, baseline["stages"][name]["best"], "-", "-", "missing"))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark every stage of a prediction.")
+    parser.add_argument("-sdf", default=str(BASE_PATH / "test_set" / "sample_1k.sdf"), help="Query SD file")
+    parser.add_argument("-db", default=str(BASE_PATH / "db" / "approved-drugs"), help="Database to screen")
+    parser.add_argument("-fp", nargs="+", default=[config.DEFAULT_FP, "MACCS"], help="Fingerprint(s), the consensus uses them all")
+    parser.add_argument("-info", default=config.DEFAULT_UNIPROT_DATABASE__CHEMBL_FILE_NAME, help="Target information file")
+    parser.add_argument("-noinfo", action="store_true", help="Only output the UniProt and ChEMBL ids of the targets")
+    parser.add_argument("-repeat", type=int, default=5, help="Runs per stage, the best one is kept")
+    parser.add_argument("-o", help="JSON report file")
+    parser.add_argument("-compare", help="JSON report to compare with, the exit status is 1 on regression")
+    parser.add_argument("-threshold", type=float, default=0.2, help="Slowdown reported as a regression, fraction of the baseline time")
+    parser.add_argument("-noise", type=float, default=0.002, help="Slowdown ignored, in seconds")
+    args = parser.parse_args()
+
+    sdf = Path(args.sdf).resolve()
+    db_path = str(Path(args.db).resolve())
+    parameters = {"sdf": Path(args.sdf).name, "db": Path(args.db).name, "fp": args.fp, "info": not args.noinfo, "repeat": args.repeat}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)  # MayaChemTools files are written in the working directory
+        try:
+            stages = run_suite(sdf, db_path, args.fp, str(Path(args.info).resolve()), not args.noinfo, max(1, args.repeat), Path(directory))
+        finally:
+            os.chdir(cwd)
+    report = make_report(stages, parameters)
+
+    print("{:<24} {:>10} {:>10} {:>14} {}".format("stage", "best s", "median s", "per second", ""))
+    for name, stage in report["stages"].items():
+        print("{:<24} {:>10.4f} {:>10.4f} {:>14.0f} {}".format(name, stage["best"], stage["median"], stage["throughput"], stage["unit"]))
+    if args.o:
+        Path(args.o).write_text(json.dumps(report, indent=1) + "\n", encoding=config.ENCODING)
+
+    if args.compare:
+        print()
+        regressions = compare_reports(report, json.loads(Path(args.compare).read_text(encoding=config.ENCODING)), args.threshold, args.noise)
+        if regressions:
+            print("{} regression(s) : {}".format(len(regressions), " ".join(regressions)))
+            sys.exit(1)
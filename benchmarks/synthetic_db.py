@@ -0,0 +1,251 @@
+# Python 3.7 Built-in packages
+import argparse
+import itertools
+import json
+import random
+import string
+import sys
+import time
+import typing
+from pathlib import Path
+
+# Run from anywhere : the application paths are computed from argv[0]
+BASE_PATH = Path(__file__).resolve().parent.parent
+sys.argv[0] = str(BASE_PATH / "FastTargetPred.py")
+sys.path.insert(0, str(BASE_PATH))
+
+# Local packages
+from src import config
+from src.database import FingerprintDatabase, open_database, write_database
+from src.target_info import write_target_info_store
+from src.target_table import read_target_table, write_target_table
+
+"""
+Write a synthetic database of any size, with everything FastTargetPred reads, to test scaling offline :
+   python3.7 benchmarks/synthetic_db.py -n 1000000 -o /tmp/synthetic/chembl_1m
+writes, for -o <db> :
+   <db>_<FP>.bfp              fingerprint databases (version 2), one per -fp, compounds in the same order
+   <db>.tlt, <db>.tltb        target lookup table, text and compiled
+   <db>_uniprot.csv, .sqlite  target information, CSV and compiled store (not read by FastTargetPred from there :
+                              copy them to db/uniprot_database_ChEMBL.csv, or give -info to benchmarks/suite.py)
+   <db>_queries_<FP>.fpf      query fingerprints (MayaChemTools format), the same -queries molecules for every fingerprint
+   <db>.json                  generation parameters
+Fingerprints follow a model database (-model, the bundled approved drugs by default) : compounds come by analog series,
+each series built on a model compound with about half of its bits redrawn from the bit frequencies of the model,
+then each analog changes a few bits of the series core. Popcounts and bit frequencies match those of the model
+for each fingerprint, and analogs are similar to each other as in ChEMBL. Compounds of a series share targets.
+Everything is drawn from -seed : the same parameters give the same files.
+"""
+
+SERIES_SIZE = 20            # Mean number of compounds of an analog series
+ANALOG_CHANGES = 4          # At most this number of bits removed from, and added to, the series core by an analog
+SERIES_TARGETS = 3          # At most this number of targets per series
+EXTRA_TARGETS = 0.5         # Mean number of targets of a compound besides those of its series
+TARGET_KEPT = 0.8           # Probability for a compound to have each target of its series
+TARGET_ZIPF = 0.8           # Target popularity : target k is drawn with weight 1 / (k + 1) ** TARGET_ZIPF
+MISSING_INFO = 0.05         # Fraction of the targets without information rows
+COMPLEX_INFO = 0.1          # Fraction of the targets with several information rows (protein complexes)
+QUERY_CHANGES = 16          # At most this number of bits flipped in a query fingerprint
+INFO_COLUMNS = [config.INFO_CHEMBLID_FIELD_NAME, config.INFO_UNIPROTID_FIELD_NAME, "Entry name", "Protein names", "Gene names", "Organism"]
+ORGANISMS = [("Homo sapiens", "HUMAN", 60), ("Rattus norvegicus", "RAT", 15), ("Mus musculus", "MOUSE", 15), ("Bos taurus", "BOVIN", 5)
+             , ("Escherichia coli", "ECOLI", 5)]
+
+Series = typing.Tuple[int, int]     # Model compound and number of compounds of an analog series
+
+
+def set_bits(fp: int) -> typing.List[int]:
+    return [bit for bit, value in enumerate(reversed(bin(fp)[2:])) if value == '1']
+
+
+class BitModel(object):  # Fingerprints of the model database and the frequency of each of their bits
+    def __init__(self, database: FingerprintDatabase):
+        self.fingerprints: typing.List[int] = [int.from_bytes(fp, 'little') for compound_id, fp in database.records()]
+        frequencies = [0] * database.fp_size
+        for fp in self.fingerprints:
+            for bit in set_bits(fp):
+                frequencies[bit] += 1
+        self.bits = [bit for bit, frequency in enumerate(frequencies) if frequency > 0]
+        self.cum_weights = list(itertools.accumulate(frequencies[bit] for bit in self.bits))
+
+    def add_bits(self, rng: random.Random, fp: int, k: int) -> int:
+        # fp with k more bits set, drawn with the model frequencies among those not set yet
+        k = min(k, len(self.bits) - bin(fp).count('1'))
+        while k > 0:
+            for bit in rng.choices(self.bits, cum_weights=self.cum_weights, k=k):
+                if not fp >> bit & 1 and k > 0:
+                    fp |= 1 << bit
+                    k -= 1
+        return fp
+
+
+def series_plan(compound_number: int, series_size: float, model_size: int, seed: int) -> typing.Iterator[Series]:
+    # Analog series of the database, in compound order. The same for every fingerprint.
+    rng = random.Random("{} series".format(seed))
+    remaining = compound_number
+    while remaining > 0:
+        size = 1 if series_size <= 1 else 1 + int(rng.expovariate(1 / (series_size - 1)))
+        size = min(size, remaining)
+        yield rng.randrange(model_size), size
+        remaining -= size
+
+
+def compound_id(i: int) -> bytes:
+    return "CHEMBL{}".format(i + 1).encode('ascii')
+
+
+def compound_records(model: BitModel, plan: typing.Iterable[Series], fp_name: str, seed: int) -> typing.Iterator[typing.Tuple[bytes, bytes]]:
+    # (compound id, fingerprint) records of the database of a fingerprint
+    rng = random.Random("{} {}".format(seed, fp_name))
+    fp_byte_size = (config.FINGERPRINT_SIZE[fp_name] + 7) // 8
+    i = 0
+    for model_index, size in plan:
+        parent = model.fingerprints[model_index]
+        parent_bits = set_bits(parent)
+        core = parent
+        for bit in rng.sample(parent_bits, len(parent_bits) // 2):
+            core &= ~(1 << bit)
+        core = model.add_bits(rng, core, len(parent_bits) // 2)
+        core_bits = set_bits(core)
+        for _ in range(size):
+            changes = rng.randint(0, ANALOG_CHANGES)
+            fp = core
+            for bit in rng.sample(core_bits, min(changes, len(core_bits))):
+                fp &= ~(1 << bit)
+            fp = model.add_bits(rng, fp, changes)
+            yield compound_id(i), fp.to_bytes(fp_byte_size, 'little')
+            i += 1
+
+
+def target_id(compound_number: int, t: int) -> str:  # Target ids follow the compound ids
+    return "CHEMBL{}".format(compound_number + 1 + t)
+
+
+def write_targets(path: Path, plan: typing.Iterable[Series], compound_number: int, target_number: int, seed: int):
+    # Target lookup table, in the text format of db/tlt_gen.py
+    rng = random.Random("{} targets".format(seed))
+    targets = list(range(target_number))
+    cum_weights = list(itertools.accumulate(1 / (t + 1) ** TARGET_ZIPF for t in targets))
+    i = 0
+    with path.open('w', encoding=config.ENCODING) as f:
+        for model_index, size in plan:
+            series_targets = set(rng.choices(targets, cum_weights=cum_weights, k=rng.randint(1, SERIES_TARGETS)))
+            lines = []
+            for _ in range(size):
+                compound_targets = {t for t in series_targets if rng.random() < TARGET_KEPT} or {rng.choice(list(series_targets))}
+                extra_number = int(rng.expovariate(1 / EXTRA_TARGETS)) if EXTRA_TARGETS > 0 else 0
+                compound_targets.update(rng.choices(targets, cum_weights=cum_weights, k=extra_number))
+                lines.append("{} {}\n".format(compound_id(i).decode('ascii'), "  ".join(target_id(compound_number, t) for t in sorted(compound_targets))))
+                i += 1
+            f.write("".join(lines))
+
+
+def uniprot_accession(rng: random.Random) -> str:
+    alphanumeric = string.ascii_uppercase + string.digits
+    return "{}{}{}{}".format(rng.choice("OPQ"), rng.choice(string.digits), "".join(rng.choice(alphanumeric) for _ in range(3)), rng.choice(string.digits))
+
+
+def write_target_info(path: Path, compound_number: int, target_number: int, seed: int):
+    # Target information CSV file, in the layout of db/uniprot_database_ChEMBL.csv
+    rng = random.Random("{} info".format(seed))
+    organism_weights = [weight for organism, code, weight in ORGANISMS]
+    delimiter = config.UNIPROT_DATABASE__CHEMBL_FILE_DELIMITER
+    with path.open('w', encoding=config.ENCODING) as f:
+        f.write(delimiter.join(INFO_COLUMNS) + "\n")
+        for t in range(target_number):
+            if rng.random() < MISSING_INFO:
+                continue
+            row_number = rng.randint(2, 4) if rng.random() < COMPLEX_INFO else 1
+            for r in range(row_number):
+                organism, code, weight = rng.choices(ORGANISMS, weights=organism_weights)[0]
+                gene = "SYN{}{}".format(t, "ABCD"[r] if row_number > 1 else "")
+                f.write(delimiter.join([
+                    target_id(compound_number, t), uniprot_accession(rng), "{}_{}".format(gene, code)
+                    , "Synthetic protein {}".format(gene), gene, organism
+                ]) + "\n")
+
+
+def write_queries(path: Path, database: FingerprintDatabase, compounds: typing.List[int], fp_name: str, seed: int):
+    # MayaChemTools-like .fpf file : the fingerprints of the given compounds (generation order), with a few bits flipped
+    rng = random.Random("{} queries {}".format(seed, fp_name))
+    fp_byte_size = (database.fp_size + 7) // 8
+    rows = compounds
+    if database.is_sorted:  # Compounds were moved by the sort
+        query_ids = {compound_id(i).decode('ascii') for i in compounds}
+        positions = {database.compound_id(j): j for j in range(len(database)) if database.compound_id(j) in query_ids}
+        rows = [positions[compound_id(i).decode('ascii')] for i in compounds]
+    lines = ["# Synthetic query fingerprints ({})".format(fp_name)]
+    for q, i in enumerate(rows):
+        fp = bytearray(database.fingerprints[i * database.stride:i * database.stride + fp_byte_size])
+        for _ in range(rng.randint(0, QUERY_CHANGES)):
+            bit = rng.randrange(database.fp_size)
+            fp[bit // 8] ^= 1 << (bit % 8)
+        lines.append("QUERY{} {}".format(q + 1, fp.hex()))
+    path.write_text("\n".join(lines) + "\n", encoding=config.ENCODING)
+
+
+def report(label: str, path: Path, t0: float):
+    print("{:<28} {:>10.1f} s  {}".format(label, time.time() - t0, path))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic database, its targets, their information and queries.")
+    parser.add_argument("-o", required=True, help="Database to write, without suffix (/tmp/synthetic/chembl_1m for instance)")
+    parser.add_argument("-n", type=int, default=100000, help="Compound number")
+    parser.add_argument("-fp", nargs="+", default=list(config.FINGERPRINT_SIZE), choices=list(config.FINGERPRINT_SIZE), help="Fingerprints")
+    parser.add_argument("-targets", type=int, default=None, help="Target number (default: n / 100, within [50, 15000])")
+    parser.add_argument("-queries", type=int, default=1000, help="Query molecule number")
+    parser.add_argument("-series", type=float, default=SERIES_SIZE, help="Mean size of the analog series")
+    parser.add_argument("-model", default=str(BASE_PATH / "db" / "approved-drugs"), help="Database the fingerprints are modeled on")
+    parser.add_argument("-seed", type=int, default=0, help="Random seed")
+    parser.add_argument("-sort", action="store_true", help="Sort the fingerprint databases by popcount (keeps them in memory)")
+    parser.add_argument("-nocompile", action="store_true", help="Don't compile the target lookup table and information")
+    args = parser.parse_args()
+
+    db_path = str(Path(args.o))
+    Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+    target_number = args.targets if args.targets is not None else min(15000, max(50, args.n // 100))
+
+    model_databases = [open_database(args.model, fp_name) for fp_name in args.fp]
+    if len({len(database) for database in model_databases}) > 1:
+        print("The model databases don't hold the same compounds.")
+        sys.exit(1)
+
+    def plan() -> typing.Iterator[Series]:
+        return series_plan(args.n, args.series, len(model_databases[0]), args.seed)
+
+    for fp_name, model_database in zip(args.fp, model_databases):
+        t0 = time.time()
+        bfp = Path("{}_{}.bfp".format(db_path, fp_name))
+        write_database(bfp, compound_records(BitModel(model_database), plan(), fp_name, args.seed), config.FINGERPRINT_SIZE[fp_name], args.sort
+                       , model_database.provider)
+        report("{} fingerprints".format(fp_name), bfp, t0)
+
+    t0 = time.time()
+    tlt = Path(db_path + config.DEFAULT_TLT_FILE_SUFFIX)
+    write_targets(tlt, plan(), args.n, target_number, args.seed)
+    report("target lookup table", tlt, t0)
+    t0 = time.time()
+    info = Path(db_path + "_uniprot.csv")
+    write_target_info(info, args.n, target_number, args.seed)
+    report("target information", info, t0)
+    if not args.nocompile:
+        t0 = time.time()
+        tltb = Path(db_path + config.COMPILED_TLT_FILE_SUFFIX)
+        write_target_table(tltb, read_target_table(db_path), open_database(db_path, args.fp[0]))
+        report("compiled lookup table", tltb, t0)
+        t0 = time.time()
+        store = info.with_suffix(config.TARGET_INFO_STORE_SUFFIX)
+        write_target_info_store(info, store)
+        report("compiled information", store, t0)
+
+    t0 = time.time()
+    query_compounds = random.Random("{} queries".format(args.seed)).choices(range(args.n), k=args.queries)
+    for fp_name in args.fp:
+        fpf = Path("{}_queries_{}.fpf".format(db_path, fp_name))
+        write_queries(fpf, open_database(db_path, fp_name), query_compounds, fp_name, args.seed)
+        report("{} queries".format(fp_name), fpf, t0)
+
+    Path(db_path + ".json").write_text(json.dumps({
+        "compounds": args.n, "fp": args.fp, "targets": target_number, "queries": args.queries, "series": args.series
+        , "model": Path(args.model).name, "seed": args.seed, "sorted": args.sort
+    }, indent=1) + "\n", encoding=config.ENCODING)
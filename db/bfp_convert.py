@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+# Script written in Python3.
+# This script converts a legacy fingerprint database (<db>_<FP>.bfp) into the version 2 memory-mappable format.
+# Version 2 databases written before popcounts were stored are upgraded as well.
+# With -sort, compounds are sorted by popcount : tc threshold searches then skip the compounds that can't reach the threshold.
+# Version 2 files are read by FastTargetPred without any parsing and are shared between processes through the page cache.
+# FastTargetPred keeps reading legacy files, so converting is optional.
+
+import sys
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from src import config
+from src.database import FingerprintDatabase, convert_database
+
+
+def convert(input_file: Path, output_file: Path, fp_name: str, sort_by_popcount: bool):
+    fp_size = config.FINGERPRINT_SIZE[fp_name]
+    database = FingerprintDatabase(input_file, fp_size)
+    up_to_date = database.is_mapped and database.popcounts is not None and database.is_sorted == sort_by_popcount
+    del database  # Release the mapping before the file gets rewritten
+    if up_to_date and input_file == output_file:
+        print("{} is already an up to date version 2 database.".format(input_file))
+        return
+    header = convert_database(input_file, output_file, fp_size, sort_by_popcount)
+    if not FingerprintDatabase(output_file, fp_size).verify():
+        print("Checksum verification failed for {}.".format(output_file))
+        sys.exit(1)
+    print("{} compounds written in {} (stride {} bytes, crc32 {:08x}).".format(header.count, output_file, header.stride, header.checksum))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a legacy .bfp fingerprint database into the version 2 format.")
+    parser.add_argument("input", help="Legacy database file, named <db>_<FP>.bfp")
+    parser.add_argument("-o", dest="output", default=None, help="Output file (default: overwrite the input file)")
+    parser.add_argument("-fp", dest="fp", default=None, choices=list(config.FINGERPRINT_SIZE)
+                        , help="Fingerprint name (default: taken from the file name)")
+    parser.add_argument("-sort", dest="sort", action="store_true"
+                        , help="Sort compounds by popcount, so single fingerprint tc threshold searches can skip most of them")
+    args = parser.parse_args()
+
+    input_file = Path(args.input)
+    fp_name = args.fp or input_file.stem.rsplit("_", 1)[-1]
+    if fp_name not in config.FINGERPRINT_SIZE:
+        print("Unable to guess the fingerprint from {}. Please use -fp.".format(input_file))
+        sys.exit(1)
+    convert(input_file, Path(args.output) if args.output else input_file, fp_name, args.sort)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+# Script written in Python3.
+# This script builds a version 2 fingerprint database (<db>_<FP>.bfp) from a SD file of database compounds.
+# Compound IDs are the molecule names of the SD file (first line of each molecule).
+# Fingerprints are computed by the same providers as the query fingerprints (see -provider in FastTargetPred),
+# so databases queried with -provider rdkit must be built here with -provider rdkit.
+# The provider is recorded in the database header : FastTargetPred refuses databases built by another provider.
+
+import sys
+import argparse
+from pathlib import Path
+from time import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from src import config, texts
+from src.database import write_database
+from src.fingerprint_providers import FingerprintError, get_provider, RDKIT_AVAILABLE
+from src.misc import system_verification
+
+
+def build(sdf: Path, output_file: Path, fp_name: str, provider_name: str, sort_by_popcount: bool):
+    provider = get_provider(provider_name, fp_name)
+    t0 = time()
+    try:
+        fingerprints = provider.compute(fp_name, sdf)
+    except FingerprintError as e:
+        print(e)
+        sys.exit(1)
+    elapsed = time() - t0
+    records = [(compound_id.encode('ascii'), fp) for compound_id, fp in fingerprints.items()]
+    header = write_database(output_file, records, config.FINGERPRINT_SIZE[fp_name], sort_by_popcount, provider.name)
+    print("{} {} fingerprints computed by {} in {:.2f}s, written in {} (crc32 {:08x}).".format(
+        header.count, fp_name, provider.name, elapsed, output_file, header.checksum
+    ))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a version 2 fingerprint database from a SD file.")
+    parser.add_argument("sdf", help="SD file of the database compounds")
+    parser.add_argument("db", help="Database name : <db>_<FP>.bfp is written")
+    parser.add_argument("-fp", dest="fp", default=config.DEFAULT_FP, choices=list(config.FINGERPRINT_SIZE)
+                        , help="Fingerprint (default: {})".format(config.DEFAULT_FP))
+    parser.add_argument("-provider", dest="provider", default=config.DEFAULT_FINGERPRINT_PROVIDER
+                        , choices=config.AVAILABLE_FINGERPRINT_PROVIDER, help="Fingerprint provider (default: maya)")
+    parser.add_argument("-sort", dest="sort", action="store_true"
+                        , help="Sort compounds by popcount, so single fingerprint tc threshold searches can skip most of them")
+    args = parser.parse_args()
+
+    if args.provider == config.RDKIT_PROVIDER and not RDKIT_AVAILABLE:
+        print("RDKit is not installed.")
+        sys.exit(1)
+    if args.provider == config.MAYA_PROVIDER or args.fp not in config.RDKIT_FINGERPRINT:
+        system_ok, messages = system_verification()  # Locates MayaChemTools
+        if not system_ok:
+            print(texts.system_not_ok + '\n\t'.join(messages))
+            sys.exit(1)
+    build(Path(args.sdf), Path("{}_{}.bfp".format(args.db, args.fp)), args.fp, args.provider, args.sort)
@@ -1,14 +1,25 @@
+# Split the rows of the raw UniProt export that list several ChEMBL targets into one row per target,
+# then compile the result into the indexed store FastTargetPred reads target information from (<csv>.sqlite).
+# With -compile, only compile an existing target information file (db/uniprot_database_ChEMBL.csv for instance).
+
 from pathlib import Path
+import sys
+import argparse
 import typing
 import csv
 import re
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from src import config
+from src.target_info import write_target_info_store
+
 CHEMBL_HEADER = 'CHEMBL'
 
 ENCODING = {'encoding': 'utf-8'}
 
-def list_way():
-    file = Path('uniprot_database__ChEMBL_raw.csv').open('r', **ENCODING)
+def list_way(input='uniprot_database__ChEMBL_raw.csv', output='uniprot_database__ChEMBL.csv'):
+    file = Path(input).open('r', **ENCODING)
     od = csv.DictReader(file, delimiter='\t')
     rows = [{k: v for k, v in f.items()} for f in od]
     file.close()
@@ -42,7 +53,7 @@ def list_way():
     key_list = keys_list[value_len_list.index(max(*value_len_list))]
     key_list = [key for key in key_list]
     print(key_list)
-    file = Path('uniprot_database__ChEMBL.csv').open('w', newline='', **ENCODING)
+    file = Path(output).open('w', newline='', **ENCODING)
     dw = csv.DictWriter(file, key_list, delimiter='\t')
     dw.writeheader()
     for row in rows:
@@ -50,8 +61,23 @@ def list_way():
     file.close()
 
 
+def compile_store(csv_file: Path):
+    store_file = csv_file.with_suffix(config.TARGET_INFO_STORE_SUFFIX)
+    row_number, target_number = write_target_info_store(csv_file, store_file)
+    print("{} rows of {} targets written in {}.".format(row_number, target_number, store_file))
+
+
 if __name__ == "__main__":
-    list_way()
+    parser = argparse.ArgumentParser(description="Build the target information file and its indexed store.")
+    parser.add_argument("-i", dest="input", default='uniprot_database__ChEMBL_raw.csv', help="Raw UniProt export")
+    parser.add_argument("-o", dest="output", default='uniprot_database__ChEMBL.csv', help="Target information file")
+    parser.add_argument("-compile", dest="compile", action="store_true"
+                        , help="Only compile the target information file (-o) into its store")
+    args = parser.parse_args()
+
+    if not args.compile:
+        list_way(args.input, args.output)
+    compile_store(Path(args.output))
 
 
 
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+# Script written in Python3.
+# This script compiles the target lookup table of a database (<db>.tlt) into <db>.tltb, which FastTargetPred
+# memory maps instead of parsing the text file. Targets are interned, so each target name is stored once.
+# Compounds are written in the order of a fingerprint database of the same name (<db>_<FP>.bfp) : hit indices of
+# this fingerprint are then directly rows of the table. Searches starting with another fingerprint whose database
+# lists compounds in another order (sorted by popcount for instance) still work, through a compound ID lookup.
+# The compiled table is only used while it is newer than the .tlt file.
+
+import sys
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from src import config
+from src.database import open_database
+from src.target_table import read_target_table, write_target_table, CompiledTargetTable
+
+
+def compile_table(db_path: str, fp_name: str, output_file: Path):
+    database = None
+    if Path("{}_{}.bfp".format(db_path, fp_name)).is_file():
+        database = open_database(db_path, fp_name)
+    table = read_target_table(db_path)
+    header = write_target_table(output_file, table, database)
+    compiled = CompiledTargetTable(output_file)
+    if not compiled.verify() or dict(compiled.items()) != table:
+        print("Verification failed for {}.".format(output_file))
+        sys.exit(1)
+    print("{} compounds and {} targets written in {} (order of {}).".format(
+        header.count, header.target_count, output_file, database.path if database is not None else "the .tlt file"
+    ))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile the target lookup table of a database (<db>.tlt) into <db>.tltb.")
+    parser.add_argument("db", help="Database, without suffix (db/chembl25_active for instance)")
+    parser.add_argument("-fp", dest="fp", default=config.DEFAULT_FP, choices=list(config.FINGERPRINT_SIZE)
+                        , help="Fingerprint database giving the compound order (default: {})".format(config.DEFAULT_FP))
+    parser.add_argument("-o", dest="output", default=None, help="Output file (default: <db>.tltb)")
+    args = parser.parse_args()
+
+    db_path = str(Path(args.db))
+    if not Path(db_path + config.DEFAULT_TLT_FILE_SUFFIX).is_file():
+        print("{} not found.".format(db_path + config.DEFAULT_TLT_FILE_SUFFIX))
+        sys.exit(1)
+    compile_table(db_path, args.fp, Path(args.output) if args.output else Path(db_path + config.COMPILED_TLT_FILE_SUFFIX))
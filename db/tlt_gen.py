@@ -2,6 +2,11 @@ import sys
 from pathlib import Path
 from csv import DictReader
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from src import config
+from tlt_compile import compile_table
+
 
 def generate__tlt_file(input, output):
     """
@@ -36,6 +41,10 @@ def generate__tlt_file(input, output):
         output_file.write("{} {}\n".format(k, "  ".join(v)))
     output_file.close()
 
+    # Compiled table, read by FastTargetPred instead of the text one
+    db_path = str(output.with_suffix(""))
+    compile_table(db_path, config.DEFAULT_FP, Path(db_path + config.COMPILED_TLT_FILE_SUFFIX))
+
 
 if __name__ == "__main__":
     try:
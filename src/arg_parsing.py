@@ -1,11 +1,16 @@
 # Python 3.7 Built-in packages
 from pathlib import Path
 import argparse
+import typing
 
 # Local packages
 from . import texts
 from . import config
 from . import output
+from . import profiling
+from .database import read_provider
+from .fingerprint_providers import RDKIT_AVAILABLE, get_provider_class
+from .sdf_index import SDFIndex
 
 
 
@@ -20,9 +25,8 @@ class UserArguments(object):
     def __init__(self, arg_dict: dict):
         self.dict = arg_dict
         self.errormsg = ''
-        self.merged_sdf = Path("target_prediction_merged_sdf.sdf")
         self._output_object = None
-        self._merged_sdf: Path = None
+        self.sdf_index: SDFIndex = None
         self.verbose_msg: str = ""
         self.number_query_molecule_found = -1
 
@@ -53,13 +57,11 @@ class UserArguments(object):
         return str(Path(self.dict[DATABASE]))
 
     @property
-    def sdf_path(self):
-        if self._merged_sdf is None:
-            if len(self.dict[SDFile]) > 1:
-                self.merge_sdf()
-            else:
-                self._merged_sdf = Path(self.dict[SDFile][0])
-        return self._merged_sdf
+    def sdf_path(self) -> Path:
+        # Name of the query, used for output files. Molecules are read through sdf_index, several SD files are never merged.
+        if len(self.dict[SDFile]) > 1:
+            return Path(config.DEFAULT_MERGE_SDF_NAME)
+        return Path(self.dict[SDFile][0])
 
     @property
     def consensus(self) -> bool:  # Figure out if there is a consensus or not
@@ -80,6 +82,10 @@ class UserArguments(object):
                 self._output_object.file = self.dict[OUTPUT]
         return self._output_object
 
+    @output_function.setter
+    def output_function(self, output_object: output.OutputObject):
+        self._output_object = output_object
+
     @property
     def zscore_threshold(self) -> float:
         return self.dict[ZSCORE_THRESHOLD]
@@ -92,8 +98,36 @@ class UserArguments(object):
     def show_info(self):
         return not self.dict[NO_INFO]
 
-    # Check user inputs
-    def are_ok(self) -> bool:
+    @property
+    def backend(self) -> str:
+        return self.dict[BACKEND]
+
+    @property
+    def use_result_cache(self) -> bool:
+        return self.dict[RESULT_CACHE]
+
+    @property
+    def use_fingerprint_cache(self) -> bool:
+        return not self.dict[NO_FINGERPRINT_CACHE]
+
+    @property
+    def fingerprint_provider(self) -> str:
+        return self.dict[FINGERPRINT_PROVIDER]
+
+    @property
+    def profile_file(self) -> typing.Optional[Path]:  # Chrome trace file of -profile, None when not profiling
+        return Path(self.dict[PROFILE]) if self.dict[PROFILE] is not None else None
+
+    @property
+    def shard_number(self) -> int:
+        return self.dict[SHARDS]
+
+    @property
+    def top_k(self) -> int:  # Number of best compounds kept per query by the Tanimoto calculation, 0 to keep them all
+        return self.max_target_number if self.dict[TOP_K] else 0
+
+    # Check user inputs. Without SD files (sdf_input False), queries come as fingerprints : SD files are not checked.
+    def are_ok(self, sdf_input: bool = True) -> bool:
         are_they = True
 
         i = 0
@@ -105,10 +139,11 @@ class UserArguments(object):
                 are_they = False
                 self.errormsg += f"Fingerprint {fp} not available.\n"
 
-        for sdf in self.dict[SDFile]:
+        sdf_found = sdf_input
+        for sdf in self.dict[SDFile] if sdf_input else []:
             sdf_path = Path(sdf)
-            if not sdf_path.is_file() and sdf_path.suffix == "sdf":
-                are_they = False
+            if not sdf_path.is_file():
+                are_they = sdf_found = False
                 self.errormsg += f"File {sdf} not found.\n"
 
         # if self.dict[REPORTED_TARGET_NUMBER] < 1:
@@ -140,8 +175,42 @@ class UserArguments(object):
         if self.dict[OUTPUT_FORMAT] not in config.AVAILABLE_FILE_FORMAT:
             are_they = False
             self.errormsg += f"File format {Path(self.dict[OUTPUT_FORMAT])} not supported. Supported format are : {','.join(config.AVAILABLE_FILE_FORMAT)}.\n"
+        elif self.dict[OUTPUT_FORMAT] == config.GZIP_CSV_FILE_FORMAT and self.dict[OUTPUT] is config.DEFAULT_OUTPUT:
+            are_they = False
+            self.errormsg += f"File format {config.GZIP_CSV_FILE_FORMAT} requires an output file (-{OUTPUT}).\n"
 
-        if self.check_sdf() is False:
+        if self.dict[BACKEND] not in config.AVAILABLE_BACKEND:
+            are_they = False
+            self.errormsg += f"Backend {self.dict[BACKEND]} not supported. Supported backends are : {','.join(config.AVAILABLE_BACKEND)}.\n"
+
+        if self.dict[FINGERPRINT_PROVIDER] not in config.AVAILABLE_FINGERPRINT_PROVIDER:
+            are_they = False
+            self.errormsg += f"Fingerprint provider {self.dict[FINGERPRINT_PROVIDER]} not supported. Supported providers are : {','.join(config.AVAILABLE_FINGERPRINT_PROVIDER)}.\n"
+        elif self.dict[FINGERPRINT_PROVIDER] == config.RDKIT_PROVIDER and not RDKIT_AVAILABLE:
+            are_they = False
+            self.errormsg += f"Fingerprint provider {config.RDKIT_PROVIDER} requires RDKit, which is not installed.\n"
+        else:
+            # Fingerprints of two providers can't be compared : the database must have been computed by the same one
+            for fp in self.dict[FINGERPRINT]:
+                bfp = Path(f"{self.dict[DATABASE]}_{fp}.bfp")
+                if fp not in config.FP_AVAILABLE or not bfp.is_file():
+                    continue
+                provider = get_provider_class(self.dict[FINGERPRINT_PROVIDER], fp).name
+                database_provider = read_provider(bfp)
+                if database_provider != provider:
+                    are_they = False
+                    self.errormsg += f"Database {bfp} was computed by {database_provider}, its fingerprints can't be compared to {provider} ones. " \
+                                     f"Use -{FINGERPRINT_PROVIDER} {database_provider}, or rebuild it with db/bfp_from_sdf.py -provider {provider}.\n"
+
+        if self.dict[TOP_K] and self.dict[REPORTED_TARGET_NUMBER] <= 1:
+            are_they = False
+            self.errormsg += f"Option -{TOP_K} requires a number of reported targets (-{REPORTED_TARGET_NUMBER}) greater than 1.\n"
+
+        if self.dict[SHARDS] < 1:
+            are_they = False
+            self.errormsg += f"Number of database shards (-{SHARDS}) must be at least 1.\n"
+
+        if sdf_found and self.check_sdf() is False:
             are_they = False
 
         if not are_they:
@@ -149,61 +218,20 @@ class UserArguments(object):
 
         return are_they
 
-    def check_sdf(self) -> (bool, str):
+    def check_sdf(self) -> bool:
         """
-        Check if the input SDfile have all uniquely named molecules.
+        Index the input SDfiles and check if they have all uniquely named molecules.
         """
-        error = False
-        msg = ""
-
-        mol_name_list = []  # For duplicate name finding purpose
-
-        for file in self.dict[SDFile]:
-            with open(file, "r", encoding=config.ENCODING) as f:
-                sdf_str = f.read()
-
-            mols_sdf_str = sdf_str.split(config.SD_MOL_DELIMITER)
-
-            i = 1
-            for mol_sdf_str in [m for m in mols_sdf_str if m != ""]:
-                if mol_sdf_str[0] == '\n':  # if the first character is line feed, it mean that the name is empty
-                    error = True
-                    msg += texts.sdf_no_mol_name_error.format(file, i)
-                else:
-                    # Taking the molecule's name
-                    i = 0
-                    c = mol_sdf_str[0]
-                    mol_name = ''
-                    while c != '\n':
-                        mol_name += c
-                        i += 1
-                        c = mol_sdf_str[i]
-
-                    if mol_name in mol_name_list:  # Check if the name already appeared before
-                        error = True
-                        msg += texts.sdf_mol_name_duplicate_error.format(file, mol_name)
-                    else:
-                        mol_name_list.append(mol_name)
-        self.number_query_molecule_found = len(mol_name_list)
+        with profiling.span("sdf_check"):
+            self.sdf_index = SDFIndex([Path(file) for file in self.dict[SDFile]])
+        msg = "".join(error + "\n" for error in self.sdf_index.errors)
+        if len(self.sdf_index) == 0:
+            msg += texts.no_molecule_error + "\n"
+
+        self.number_query_molecule_found = len(set(self.sdf_index.names) - {""})
         self.verbose_msg = texts.molecules_found.format(self.number_query_molecule_found) + "\n"
         self.errormsg += msg
-        return not error
-
-
-    def merge_sdf(self) -> (bool, str):
-        # Merge all user provided sd files
-        sd_mol_delimiter = config.SD_MOL_DELIMITER
-        mol_list = []
-        for sdf in self.dict[SDFile]:
-            # append all molecules from the file into the molecule list (if the molecule is not empty)
-            mol_list.extend([m for m in Path(sdf).read_text(encoding=config.ENCODING).split(sd_mol_delimiter) if len(m) > 0])
-
-        if len(mol_list) == 0:
-            self.errormsg += texts.merge_error
-            raise RuntimeError(self.errormsg)
-
-        self._merged_sdf = Path(config.DEFAULT_MERGE_SDF_NAME)
-        self._merged_sdf.write_text(sd_mol_delimiter.join(mol_list), encoding=config.ENCODING)
+        return msg == ""
 
 
 
@@ -224,6 +252,13 @@ OUTPUT_FORMAT = 'f'
 NUM_CORE = 'cpu'
 FILTER_BEST_POSE_PER_TARGET = 'bppt'
 NO_INFO = 'noinfo'
+BACKEND = 'backend'
+TOP_K = 'topk'
+FINGERPRINT_PROVIDER = 'provider'
+NO_FINGERPRINT_CACHE = 'nofpcache'
+RESULT_CACHE = 'resultcache'
+PROFILE = 'profile'
+SHARDS = 'shards'
 
 ARGS_LIST = [
     SDFile
@@ -237,26 +272,51 @@ ARGS_LIST = [
     , NUM_CORE
     , FILTER_BEST_POSE_PER_TARGET
     , NO_INFO
+    , BACKEND
+    , TOP_K
+    , FINGERPRINT_PROVIDER
+    , NO_FINGERPRINT_CACHE
+    , RESULT_CACHE
+    , PROFILE
+    , SHARDS
 ]
 
 
 
-def _get_args_dict() -> dict:
-    parser = _get_argparse_setup()
+def _get_args_dict(argv: typing.Optional[typing.List[str]] = None, parser_class=argparse.ArgumentParser) -> dict:
+    parser = _get_argparse_setup(parser_class)
 
     # Get arparse namespace
-    ns = parser.parse_args()
+    ns = parser.parse_args(argv)
 
     # Return arguments in a dictionary fashion
     d = {a: ns.__getattribute__(a) for a in ARGS_LIST}
     return d
 
 
+class ArgumentsError(Exception):
+    pass
+
+
+class _RaisingArgumentParser(argparse.ArgumentParser):
+    # Raise ArgumentsError on invalid arguments (or help requests) instead of exiting the program
+    def error(self, message):
+        raise ArgumentsError(message)
+
+    def exit(self, status=0, message=None):
+        raise ArgumentsError(message or "")
+
+
+def parse_arguments(argv: typing.List[str]) -> UserArguments:
+    # Arguments object from a command line given as a list, like a request made to the prediction server
+    return UserArguments(_get_args_dict(argv, _RaisingArgumentParser))
+
+
 # Initialize the argument parser for later use.
-def _get_argparse_setup() -> argparse.ArgumentParser:
+def _get_argparse_setup(parser_class=argparse.ArgumentParser) -> argparse.ArgumentParser:
     # the formatter_class here allow to the help string to be formatted as it is in the texts.py
-    parser = argparse.ArgumentParser(description=texts.abstract
-                                     , formatter_class=argparse.RawTextHelpFormatter)
+    parser = parser_class(description=texts.abstract
+                          , formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument(SDFile, metavar="SDF", type=str, nargs="+"
                         , help=texts.help_files_input)
     # parser.add_argument(f'-i', dest=SDFile, type=str, nargs="+", default=""
@@ -281,6 +341,20 @@ def _get_argparse_setup() -> argparse.ArgumentParser:
                         , help=texts.help_bppt)
     parser.add_argument(f'-{NO_INFO}', dest=NO_INFO, action="store_true"
                         , help=texts.help_noinfo)
+    parser.add_argument(f'-{BACKEND}', f'--{BACKEND}', dest=BACKEND, type=str, default=config.DEFAULT_BACKEND
+                        , help=texts.help_backend)
+    parser.add_argument(f'-{TOP_K}', dest=TOP_K, action="store_true"
+                        , help=texts.help_topk)
+    parser.add_argument(f'-{FINGERPRINT_PROVIDER}', dest=FINGERPRINT_PROVIDER, type=str, default=config.DEFAULT_FINGERPRINT_PROVIDER
+                        , help=texts.help_provider)
+    parser.add_argument(f'-{NO_FINGERPRINT_CACHE}', dest=NO_FINGERPRINT_CACHE, action="store_true"
+                        , help=texts.help_nofpcache)
+    parser.add_argument(f'-{RESULT_CACHE}', dest=RESULT_CACHE, action="store_true"
+                        , help=texts.help_resultcache)
+    parser.add_argument(f'-{PROFILE}', dest=PROFILE, type=str, nargs='?', const=config.DEFAULT_PROFILE_FILE, default=None
+                        , help=texts.help_profile)
+    parser.add_argument(f'-{SHARDS}', dest=SHARDS, type=int, default=config.DEFAULT_SHARD_NUMBER
+                        , help=texts.help_shards)
     return parser
 
 
@@ -12,12 +12,47 @@ DEFAULT_FP = "ECFP4"                    # Default fingerprint used
 DEFAULT_SD = 0.8                        # Default Zscore threshold for hit filtering
 DEFAULT_NBT = 100                       # Default target number displayed
 DEFAULT_NUM_CORE = 4
+MAYA_SHARD_SIZE = 200                   # Minimum number of molecules per maya subprocess. Larger inputs are split over -cpu subprocesses.
+TANIMOTO_BATCH_SIZE = 32                # Maximum number of molecules compared at once to the database by the C kernel
+TANIMOTO_BATCH_MEMORY = 256 * 2 ** 20   # Maximum size (bytes) of the kernel score buffer, shrinks the batch on large databases
 DEFAULT_OUTPUT_FORMAT = "txt"
+PROCESSES_BACKEND = "processes"         # One process per molecule chunk, data shared through a multiprocessing manager
+THREADS_BACKEND = "threads"             # Thread pool in the main process, the C kernel releases the GIL while scanning
+DEFAULT_BACKEND = PROCESSES_BACKEND
+DEFAULT_SHARD_NUMBER = 1                # Databases scanned whole by each worker. More shards : each one scanned by its own process.
+MAYA_PROVIDER = "maya"                  # MayaChemTools scripts run in a Perl subprocess, fingerprints read back from .fpf files
+RDKIT_PROVIDER = "rdkit"                # RDKit fingerprints computed in process (optional, RDKit must be installed)
+DEFAULT_FINGERPRINT_PROVIDER = MAYA_PROVIDER
+DEFAULT_DATABASE_PROVIDER = MAYA_PROVIDER   # Provider of the databases that don't record it (legacy and older .bfp files)
+DEFAULT_SERVER_HOST = "127.0.0.1"       # The prediction server only listens on the local host
+DEFAULT_SERVER_PORT = 8521
+SERVER_PREDICT_PATH = "/predict"        # Prediction requests : POST, JSON body (see server.PredictionServer)
+SERVER_STATUS_PATH = "/status"          # Loaded databases and number of requests served : GET
+SERVER_QUERY_NAME = "query.sdf"         # Name of the queries given as fingerprints (no file is written)
 CSV_FILE_FORMAT = "csv"
+JSONL_FILE_FORMAT = "jsonl"             # One JSON object per query molecule and line
+GZIP_CSV_FILE_FORMAT = "csv.gz"         # csv, gzip compressed. Output file only.
+OUTPUT_BUFFER_SIZE = 2 ** 20            # Characters of output gathered before being written to the output file at once
+GZIP_COMPRESS_LEVEL = 6                 # Level of the gzip command : 2.5 times as fast as the Python default (9), 2 % larger files
 DEFAULT_CSV_DELIMITER = "\t"
 DEFAULT_MERGE_SDF_NAME = "out/target_prediction_merged_sdf.sdf"
-DEFAULT_BINARY_FINGERPRINT_FOLDER = BASE_TEMP_DIR + '/' + "binary_fingerprints"
-                                        # Default Name of merged sdf
+                                        # Name of the query when several SD files are given (never written)
+DEFAULT_SDF_SHARD_FOLDER = BASE_TEMP_DIR + '/' + "sdf_shards"
+                                        # Input SD file shards computed by concurrent maya subprocesses
+DEFAULT_SERVER_TEMP_FOLDER = BASE_TEMP_DIR + '/' + "server"
+                                        # Query SD files of the prediction server requests
+DEFAULT_FINGERPRINT_CACHE_FILE = BASE_PATH + '/' + "cache/query_fingerprints.sqlite"
+                                        # Query fingerprints of previous runs, keyed by molecule content (see -nofpcache)
+FINGERPRINT_CACHE_MAX_ENTRIES = 2000000 # Least recently used fingerprints are evicted past this number (about 300 bytes each)
+DEFAULT_RESULT_CACHE_FILE = BASE_PATH + '/' + "cache/results.sqlite"
+                                        # Hit results of previous runs (see -resultcache)
+RESULT_CACHE_MAX_BYTES = 2 ** 30        # Least recently used results are evicted past this size
+RESULT_CACHE_VERSION = 1                # Bump when the results of a run change for the same inputs
+CHECKSUM_BLOCK_SIZE = 2 ** 20           # Database files are hashed by blocks of this size
+DEFAULT_PROFILE_FILE = "out/profile.json"
+                                        # Chrome trace written by -profile when no file is given
+PROFILE_RSS_INTERVAL = 0.1              # Seconds between two samples of the resident memory of each process (-profile)
+CACHE_QUERY_SIZE = 500                  # Keys looked up per SQLite query (fingerprint and result caches, target information)
 
 DEFAULT_TID_CHEMBLID_FILE_NAME = BASE_PATH + '/' + "db/tid-chembl_lookuptable.csv"
                                         # Default name of the file that link tid to CHEMBLID
@@ -29,7 +64,9 @@ SAVED_MAYA_PATH_FILE = BASE_PATH + '/' + "src/maya_path"
 
 DEFAULT_UNIPROT_DATABASE__CHEMBL_FILE_NAME = BASE_PATH + '/' + "db/uniprot_database_ChEMBL.csv"
                                         # Default name of the file that give some informations about TID
+TARGET_INFO_STORE_SUFFIX = ".sqlite"    # Indexed store compiled from it (db/correct_multiple_chembl.py), read instead of it when present
 DEFAULT_TLT_FILE_SUFFIX = ".tlt"
+COMPILED_TLT_FILE_SUFFIX = ".tltb"      # Compiled target lookup table (db/tlt_compile.py), read instead of the .tlt file when present
 
 UNIPROT_DATABASE__CHEMBL_FILE_DELIMITER = '\t'
                                         # Delimiter of the csv file
@@ -39,6 +76,7 @@ INFO_UNIPROTID_FIELD_NAME = 'Uniprot'
 ENCODING = 'utf-8'                      # encoding of red files
 
 PROGRESSION_SYMBOL = "#"
+WORKER_FAILED = "worker_failed"          # Posted on the progression and output queues by a failing tanimoto worker : their loops end
 
 DEFAULT_TC_THRESHOLD = {                # Default threshold that will be applied if no threshold are specified.
     "ECFP4": 0.6                        #  Note that in case of consensus, both fingerprint threshold and zscore
@@ -62,9 +100,27 @@ FINGERPRINT_SIZE = {                    # Same here. Please don't.
     , "PL": 1024
 }
 
+RDKIT_FINGERPRINT = {                   # RDKit generator of each fingerprint and its parameters. The others are left to maya.
+    "ECFP4": ["Morgan", {"radius": 2}]
+    , "ECFP6": ["Morgan", {"radius": 3}]
+    , "MACCS": ["MACCS", {}]
+}
+
 AVAILABLE_FILE_FORMAT = [
     DEFAULT_OUTPUT_FORMAT
     , CSV_FILE_FORMAT
+    , JSONL_FILE_FORMAT
+    , GZIP_CSV_FILE_FORMAT
+]
+
+AVAILABLE_BACKEND = [
+    PROCESSES_BACKEND
+    , THREADS_BACKEND
+]
+
+AVAILABLE_FINGERPRINT_PROVIDER = [
+    MAYA_PROVIDER
+    , RDKIT_PROVIDER
 ]
 
 SD_MOL_DELIMITER = "\n$$$$\n"           # SDfiles molecule delimiter
@@ -0,0 +1,394 @@
+# Python 3.7 Built-in packages
+import array
+import math
+import mmap
+import struct
+import typing
+import zlib
+from pathlib import Path
+
+# Local packages
+from . import config
+
+# Fingerprint database files (<db>_<FP>.bfp).
+#
+# Legacy files are a plain concatenation of variable-length records :
+#     [id length : 1 byte][id : ascii][fingerprint : fp_size / 8 bytes]
+#
+# Version 2 files start with a fixed-size header followed by an aligned fixed-stride fingerprint block
+# and a separate compound ID table, so they can be memory mapped and handed to the C kernel as is :
+#     header          BFP_HEADER_SIZE bytes, see BFP_HEADER_FORMAT
+#     fingerprints    count * stride bytes, each fingerprint zero-padded to stride, starting on a BFP_ALIGNMENT boundary
+#     id offsets      (count + 1) little-endian uint32, offsets of each compound ID inside the id block
+#     id block        concatenated ascii compound IDs
+#     popcounts       (optional, BFP_FLAG_POPCOUNTS) count little-endian uint16, number of bits set in each fingerprint
+#     buckets         (optional, BFP_FLAG_SORTED) fp_size + 2 little-endian uint32, index of the first compound of each popcount
+# Sorted files list their compounds by increasing popcount, so the compounds of a given popcount p are
+# buckets[p] <= i < buckets[p + 1]. The kernel uses them to skip compounds that can't reach the tc threshold.
+# The checksum is the crc32 of everything following the header.
+# The header also records the provider that computed the fingerprints (see fingerprint_providers) : fingerprints of two
+# providers can't be compared. Files that don't record it (legacy, older version 2) were all computed by MayaChemTools.
+
+BFP_MAGIC = b"\x89BFP\r\n\x1a\n"       # First byte can't be a legacy id length (signed byte)
+BFP_VERSION = 2
+BFP_HEADER_SIZE = 128
+BFP_HEADER_FORMAT = "<8sIIQIIQQIIQQ16s" # magic, version, header size, count, fp bits, stride, fp offset, id offset, checksum, flags, popcount offset, bucket offset, provider
+BFP_ALIGNMENT = 32                      # Fingerprint block and stride alignment (bytes). Allows wide loads in the kernel.
+BFP_FLAG_POPCOUNTS = 1                  # Per-compound popcounts are stored after the id block
+BFP_FLAG_SORTED = 2                     # Compounds are sorted by popcount, bucket offsets are stored after the popcounts
+ID_OFFSET_FORMAT = "<I"
+POPCOUNT_FORMAT = "<H"
+BUCKET_OFFSET_FORMAT = "<I"
+BFP_WRITE_BLOCK_SIZE = 2 ** 24          # Fingerprints are written by blocks of this size (bytes)
+
+
+def _align(n: int, alignment: int = BFP_ALIGNMENT) -> int:
+    return (n + alignment - 1) // alignment * alignment
+
+
+def fingerprint_stride(fp_size: int) -> int:
+    """
+    Number of bytes used by one fingerprint of fp_size bits inside a version 2 fingerprint block.
+    """
+    return _align((fp_size + 7) // 8)
+
+
+class BfpHeader(typing.NamedTuple):
+    version: int
+    header_size: int
+    count: int
+    fp_size: int
+    stride: int
+    fp_offset: int
+    id_offset: int
+    checksum: int
+    flags: int
+    popcount_offset: int = 0
+    bucket_offset: int = 0
+    provider: str = ""      # Empty when not recorded
+
+    def pack(self) -> bytes:
+        return struct.pack(
+            BFP_HEADER_FORMAT
+            , BFP_MAGIC, self.version, self.header_size, self.count, self.fp_size
+            , self.stride, self.fp_offset, self.id_offset, self.checksum, self.flags, self.popcount_offset, self.bucket_offset
+            , self.provider.encode('ascii')
+        ).ljust(self.header_size, b"\x00")
+
+    @classmethod
+    def unpack(cls, buffer) -> "BfpHeader":
+        magic, *fields = struct.unpack_from(BFP_HEADER_FORMAT, buffer)
+        if magic != BFP_MAGIC:
+            raise ValueError("Not a version 2 fingerprint database.")
+        *fields, provider = fields
+        return cls(*fields, provider=provider.rstrip(b"\x00").decode('ascii'))
+
+
+def is_bfp_v2(path: typing.Union[str, Path]) -> bool:
+    with open(str(path), "rb") as f:
+        return f.read(len(BFP_MAGIC)) == BFP_MAGIC
+
+
+def read_provider(path: typing.Union[str, Path]) -> str:
+    """
+    Provider that computed the fingerprints of a database, read from its header only.
+    """
+    with open(str(path), "rb") as f:
+        header = f.read(BFP_HEADER_SIZE)
+    if header[:len(BFP_MAGIC)] != BFP_MAGIC:
+        return config.DEFAULT_DATABASE_PROVIDER
+    return BfpHeader.unpack(header).provider or config.DEFAULT_DATABASE_PROVIDER
+
+
+def read_legacy_records(path: typing.Union[str, Path], fp_size: int) -> typing.Iterator[typing.Tuple[bytes, bytes]]:
+    """
+    Yield (compound id, fingerprint) couples from a legacy .bfp file.
+    """
+    raw = Path(path).read_bytes()
+    fp_byte_size = (fp_size + 7) // 8
+    position = 0
+    size = len(raw)
+    while position < size:
+        id_length = raw[position]
+        position += 1
+        compound_id = raw[position:position + id_length]
+        position += id_length
+        fp = raw[position:position + fp_byte_size]
+        position += fp_byte_size
+        if len(fp) != fp_byte_size:
+            raise ValueError("Truncated record for compound {} in {}.".format(compound_id.decode('ascii'), path))
+        yield compound_id, fp
+
+
+def fingerprint_popcount(fp: bytes) -> int:
+    return bin(int.from_bytes(fp, 'little')).count('1')
+
+
+class PackedRecords(typing.NamedTuple):
+    count: int
+    fingerprints: bytes
+    popcounts: bytes
+    id_offsets: bytes
+    id_block: bytes
+
+
+def _pack_records(records: typing.Iterable[typing.Tuple[bytes, bytes]], stride: int
+                  , write_fingerprints: typing.Optional[typing.Callable[[bytearray], None]] = None) -> PackedRecords:
+    # Build the fingerprint block, the popcounts, the id offsets and the id block from records.
+    # With write_fingerprints, the fingerprint block is handed to it by pieces of BFP_WRITE_BLOCK_SIZE bytes instead of kept.
+    fp_block = bytearray()
+    popcounts = bytearray()
+    id_offsets = bytearray()
+    id_block = bytearray()
+    count = 0
+    for compound_id, fp in records:
+        id_offsets += struct.pack(ID_OFFSET_FORMAT, len(id_block))
+        id_block += compound_id
+        fp_block += fp.ljust(stride, b"\x00")
+        popcounts += struct.pack(POPCOUNT_FORMAT, fingerprint_popcount(fp))
+        count += 1
+        if write_fingerprints is not None and len(fp_block) >= BFP_WRITE_BLOCK_SIZE:
+            write_fingerprints(fp_block)
+            fp_block = bytearray()
+    if write_fingerprints is not None:
+        write_fingerprints(fp_block)
+        fp_block = bytearray()
+    id_offsets += struct.pack(ID_OFFSET_FORMAT, len(id_block))
+    return PackedRecords(count, bytes(fp_block), bytes(popcounts), bytes(id_offsets), bytes(id_block))
+
+
+def _popcount_buckets(records: typing.List[typing.Tuple[bytes, bytes]], fp_size: int) -> bytes:
+    # Index of the first compound of each popcount (0 to fp_size), then the compound number. Records must be sorted.
+    buckets = bytearray()
+    i = 0
+    for popcount in range(fp_size + 1):
+        buckets += struct.pack(BUCKET_OFFSET_FORMAT, i)
+        while i < len(records) and fingerprint_popcount(records[i][1]) == popcount:
+            i += 1
+    buckets += struct.pack(BUCKET_OFFSET_FORMAT, len(records))
+    return bytes(buckets)
+
+
+def write_database(path: typing.Union[str, Path], records: typing.Iterable[typing.Tuple[bytes, bytes]], fp_size: int
+                   , sort_by_popcount: bool = False, provider: str = config.DEFAULT_DATABASE_PROVIDER) -> BfpHeader:
+    """
+    Write (compound id, fingerprint) records into a version 2 .bfp file.
+    With sort_by_popcount, compounds are reordered by popcount and the bucket offsets are stored.
+    provider is the name of the provider that computed the fingerprints, recorded in the header.
+    Fingerprints are streamed to the file as records come : unless sorting, only the compound ids are kept in memory.
+    """
+    stride = fingerprint_stride(fp_size)
+    buckets = b""
+    if sort_by_popcount:
+        records = sorted(records, key=lambda record: fingerprint_popcount(record[1]))  # Stable : same popcount, same order
+        buckets = _popcount_buckets(records, fp_size)
+
+    fp_offset = _align(BFP_HEADER_SIZE)
+    with open(str(path), "wb") as f:
+        checksum = 0
+
+        def write_body(data: bytes):
+            nonlocal checksum
+            f.write(data)
+            checksum = zlib.crc32(data, checksum)
+
+        f.write(b"\x00" * BFP_HEADER_SIZE)  # Written last, once the checksum is known
+        write_body(b"\x00" * (fp_offset - BFP_HEADER_SIZE))
+        packed = _pack_records(records, stride, write_body)
+
+        id_offset = fp_offset + packed.count * stride
+        id_end = id_offset + len(packed.id_offsets) + len(packed.id_block)
+        popcount_offset = _align(id_end, 8)
+        bucket_offset = _align(popcount_offset + len(packed.popcounts), 8) if sort_by_popcount else 0
+        for data in [
+            packed.id_offsets
+            , packed.id_block
+            , b"\x00" * (popcount_offset - id_end)
+            , packed.popcounts
+            , b"\x00" * (bucket_offset - popcount_offset - len(packed.popcounts) if sort_by_popcount else 0)
+            , buckets
+        ]:
+            write_body(data)
+
+        header = BfpHeader(
+            version=BFP_VERSION
+            , header_size=BFP_HEADER_SIZE
+            , count=packed.count
+            , fp_size=fp_size
+            , stride=stride
+            , fp_offset=fp_offset
+            , id_offset=id_offset
+            , checksum=checksum
+            , flags=BFP_FLAG_POPCOUNTS | (BFP_FLAG_SORTED if sort_by_popcount else 0)
+            , popcount_offset=popcount_offset
+            , bucket_offset=bucket_offset
+            , provider=provider
+        )
+        f.seek(0)
+        f.write(header.pack())
+    return header
+
+
+def convert_database(input_path: typing.Union[str, Path], output_path: typing.Union[str, Path], fp_size: int
+                     , sort_by_popcount: bool = False) -> BfpHeader:
+    """
+    (Re)write any fingerprint database in the current version 2 layout. The provider is kept.
+    """
+    database = FingerprintDatabase(input_path, fp_size)
+    return write_database(output_path, list(database.records()), fp_size, sort_by_popcount, database.provider)
+
+
+class FingerprintDatabase(object):
+    """
+    Read-only view over a fingerprint database, whatever its on-disk version.
+    Version 2 files are memory mapped, so every process working on the same file shares one page-cache copy.
+    Legacy files are converted in memory to the same fixed-stride layout.
+    Given a provider, databases whose fingerprints were computed by another one are refused (ValueError).
+    """
+
+    def __init__(self, path: typing.Union[str, Path], fp_size: int, provider: typing.Optional[str] = None):
+        self.path = Path(path)
+        self.fp_size = fp_size
+        self.provider = config.DEFAULT_DATABASE_PROVIDER
+        self.header: typing.Optional[BfpHeader] = None
+        self._mmap: typing.Optional[mmap.mmap] = None
+        self.popcounts = None                   # Left to None when the file doesn't store them : the kernel computes them
+        self.popcount_buckets = None            # Only for databases sorted by popcount
+        self._index_maps: typing.Dict[str, typing.Optional[array.array]] = {}
+
+        if is_bfp_v2(self.path):
+            self._open_v2()
+        else:
+            self._open_legacy()
+        if provider is not None:
+            self.check_provider(provider)
+
+    @classmethod
+    def open(cls, path: typing.Union[str, Path], fp_size: int, provider: typing.Optional[str] = None) -> "FingerprintDatabase":
+        return cls(path, fp_size, provider)
+
+    def _open_v2(self):
+        with self.path.open("rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.header = header = BfpHeader.unpack(self._mmap)
+        if header.version != BFP_VERSION:
+            raise ValueError("Unsupported fingerprint database version {} in {}.".format(header.version, self.path))
+        if header.fp_size != self.fp_size:
+            raise ValueError("Fingerprint size mismatch in {} : {} bits expected, {} found.".format(self.path, self.fp_size, header.fp_size))
+        self.provider = header.provider or config.DEFAULT_DATABASE_PROVIDER
+
+        view = memoryview(self._mmap)
+        id_block_offset = header.id_offset + (header.count + 1) * struct.calcsize(ID_OFFSET_FORMAT)
+        self.count = header.count
+        self.stride = header.stride
+        self.fingerprints = view[header.fp_offset:header.fp_offset + header.count * header.stride]
+        self.id_offsets = view[header.id_offset:id_block_offset]
+        if len(self.fingerprints) != self.count * self.stride or len(self.id_offsets) != (self.count + 1) * 4:
+            raise ValueError("Truncated fingerprint database {}.".format(self.path))
+        id_block_size, = struct.unpack_from(ID_OFFSET_FORMAT, self.id_offsets, self.count * 4)
+        self.id_block = view[id_block_offset:id_block_offset + id_block_size]
+
+        if header.flags & BFP_FLAG_POPCOUNTS:
+            popcount_size = self.count * struct.calcsize(POPCOUNT_FORMAT)
+            self.popcounts = view[header.popcount_offset:header.popcount_offset + popcount_size]
+            if len(self.popcounts) != popcount_size:
+                raise ValueError("Truncated fingerprint database {}.".format(self.path))
+
+        if header.flags & BFP_FLAG_SORTED:
+            bucket_size = (self.fp_size + 2) * struct.calcsize(BUCKET_OFFSET_FORMAT)
+            self.popcount_buckets = view[header.bucket_offset:header.bucket_offset + bucket_size]
+            if len(self.popcount_buckets) != bucket_size:
+                raise ValueError("Truncated fingerprint database {}.".format(self.path))
+
+    def _open_legacy(self):
+        self.stride = fingerprint_stride(self.fp_size)
+        self.count, self.fingerprints, self.popcounts, self.id_offsets, self.id_block = _pack_records(
+            read_legacy_records(self.path, self.fp_size)
+            , self.stride
+        )
+
+    def check_provider(self, provider: str):
+        if provider != self.provider:
+            raise ValueError(
+                "Fingerprint provider mismatch in {} : computed by {}, can't be compared to {} fingerprints.".format(self.path, self.provider, provider)
+            )
+
+    @property
+    def is_mapped(self) -> bool:
+        return self._mmap is not None
+
+    @property
+    def is_sorted(self) -> bool:
+        return self.popcount_buckets is not None
+
+    @property
+    def kernel_args(self) -> tuple:
+        # Order expected by tanimoto_processing for each database
+        return self.fingerprints, self.stride, self.count, self.id_offsets, self.id_block, self.popcounts
+
+    def index_map(self, reference: "FingerprintDatabase") -> typing.Optional[array.array]:
+        """
+        Index of each compound of the reference database inside this one (-1 when absent), as native int32.
+        None when both databases list the same compounds in the same order, which is the case for databases built together.
+        """
+        key = str(reference.path)
+        if key not in self._index_maps:
+            if bytes(self.id_offsets) == bytes(reference.id_offsets) and bytes(self.id_block) == bytes(reference.id_block):
+                self._index_maps[key] = None
+            else:
+                positions = {self.compound_id(i): i for i in range(self.count)}
+                self._index_maps[key] = array.array('i', (positions.get(reference.compound_id(i), -1) for i in range(reference.count)))
+        return self._index_maps[key]
+
+    def compound_id(self, index: int) -> str:
+        start, end = struct.unpack_from("<II", self.id_offsets, index * 4)
+        return bytes(self.id_block[start:end]).decode('ascii')
+
+    def popcount_range(self, popcount: int, tc_threshold: float) -> typing.Tuple[int, int]:
+        """
+        Compounds of a sorted database scanned by the kernel for a query of the given popcount (see feasible_range) :
+        the only ones whose tc may reach tc_threshold. tc_threshold must be > 0.
+        """
+        low = math.floor(popcount * tc_threshold)
+        high = min(math.ceil(popcount / tc_threshold), self.fp_size)
+        if low > high:
+            return 0, 0
+        start, = struct.unpack_from(BUCKET_OFFSET_FORMAT, self.popcount_buckets, low * 4)
+        end, = struct.unpack_from(BUCKET_OFFSET_FORMAT, self.popcount_buckets, (high + 1) * 4)
+        return start, end
+
+    def records(self) -> typing.Iterator[typing.Tuple[bytes, bytes]]:
+        """
+        Yield (compound id, fingerprint) couples, fingerprints trimmed to their actual byte size.
+        """
+        fp_byte_size = (self.fp_size + 7) // 8
+        for i in range(self.count):
+            start, end = struct.unpack_from("<II", self.id_offsets, i * 4)
+            fp_start = i * self.stride
+            yield bytes(self.id_block[start:end]), bytes(self.fingerprints[fp_start:fp_start + fp_byte_size])
+
+    def verify(self) -> bool:
+        """
+        Check the version 2 crc32 checksum. Reads the whole file, so it is not done on opening.
+        """
+        if self.header is None:
+            return True
+        return zlib.crc32(memoryview(self._mmap)[self.header.header_size:]) == self.header.checksum
+
+    def __len__(self):
+        return self.count
+
+    def __reduce__(self):
+        # Memory views can't be pickled : child processes re-open (and re-map) the file instead
+        return self.__class__, (str(self.path), self.fp_size)
+
+
+def kernel_arguments(databases: typing.List[FingerprintDatabase]) -> typing.List[tuple]:
+    """
+    Database tuples expected by tanimoto_processing. Compounds of every database are matched to those of the first one.
+    """
+    return [database.kernel_args + (database.index_map(databases[0]), database.popcount_buckets) for database in databases]
+
+
+def open_database(db_path: str, fp_name: str, provider: typing.Optional[str] = None) -> FingerprintDatabase:
+    return FingerprintDatabase("{}_{}.bfp".format(db_path, fp_name), config.FINGERPRINT_SIZE[fp_name], provider)
@@ -0,0 +1,49 @@
+# Python 3.7 Built-in packages
+import threading
+import typing
+
+# Local packages
+from . import config, profiling
+from .database import FingerprintDatabase, open_database
+from .target_info import TargetInfoSource, open_target_info
+from .target_table import TargetTable, open_target_table
+
+
+class DatabaseStore(object):
+    """
+    Fingerprint databases, target lookup tables and target information source of one or several runs.
+    Each of them is read on first use, then kept : a long-running server reads every file once.
+    Stored objects are shared between runs and must not be modified.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key_locks: typing.Dict[tuple, threading.Lock] = {}
+        self._loaded: typing.Dict[tuple, typing.Any] = {}
+
+    def _get(self, key: tuple, load: callable, *args):
+        # Load a value once, even when several threads ask for it at the same time. Different values load concurrently.
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if key not in self._loaded:
+                with profiling.span("load_{}".format(key[0]), key=" ".join(key[1:])):
+                    self._loaded[key] = load(*args)
+        return self._loaded[key]
+
+    def database(self, db_path: str, fp_name: str, provider: typing.Optional[str] = None) -> FingerprintDatabase:
+        # Given a provider, a database computed by another one is refused (ValueError), even when already read
+        database = self._get(("database", db_path, fp_name), open_database, db_path, fp_name)
+        if provider is not None:
+            database.check_provider(provider)
+        return database
+
+    def target_table(self, db_path: str) -> TargetTable:
+        return self._get(("target_table", db_path), open_target_table, db_path)
+
+    def target_info(self) -> typing.Optional[TargetInfoSource]:
+        return self._get(("target_info",), open_target_info, config.DEFAULT_UNIPROT_DATABASE__CHEMBL_FILE_NAME)
+
+    @property
+    def loaded(self) -> typing.List[tuple]:  # Keys of the values read so far
+        with self._lock:
+            return list(self._loaded)
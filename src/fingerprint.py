@@ -1,38 +1,42 @@
 # Python 3.7 Built-in packages
-import subprocess
 import threading
+import typing
+from concurrent.futures import Executor
+from time import time
 from pathlib import Path
 
 # Local packages
-from . import config
-from . import texts
+from . import config, profiling
 from .arg_parsing import UserArguments
-from .misc import get_perl_path, get_maya_path
+from .database import FingerprintDatabase
+from .database_store import DatabaseStore
+from .fingerprint_providers import Fingerprints, FingerprintError, FingerprintProvider, get_provider
 
 class Fingerprint(object):
-    perl_path = get_perl_path()
 
 
-    def __init__(self, name: str, args: UserArguments, sdf: Path):
-        self.maya_path = get_maya_path()
+    def __init__(self, name: str, args: UserArguments, sdf: Path, database_store: DatabaseStore):
         self.name = name  # refer to the fingerprint reference
         self.user_arguments = args
+        self.database_store = database_store
         self.fingerprint_size = config.FINGERPRINT_SIZE[name]
+        self.provider: FingerprintProvider = get_provider(args.fingerprint_provider, name)
 
-        self._maya_thread = threading.Thread(
-            name=f"maya_{name}"
-            , target=self.maya_fp_calculation
-            , args=(sdf,)
+        self._fp_thread = threading.Thread(
+            name=f"fp_{name}"
+            , target=self.fp_calculation
         )
         self._db_thread = threading.Thread(
             name=f"db_{name}"
-            , target=self._read_db_bytes
+            , target=self._read_database
         )
 
         # All lists that will be filled along the calculation
-        self._db_bytes: bytes = bytes()
-        self._fp_files = []
-        self.bfp_files_name = []
+        self._database: FingerprintDatabase = None
+        self._fingerprints: Fingerprints = {}
+        self._sdf: Path = Path(sdf)
+        self._shards: typing.List[Path] = [self._sdf]
+        self._executor: typing.Optional[Executor] = None
         self.compound_list = []
         self.out_files_name = []
 
@@ -41,17 +45,29 @@ class Fingerprint(object):
         self._results_dict = {}
         self._db = {}
 
+        # Fingerprint calculation throughput
+        self.calculation_time = 0.
+
         self.error = False
         self.errormsg = ''
 
-    def start_maya_calculation(self):
+    def start_fp_calculation(self, sdf: Path, shards: typing.List[Path], executor: Executor):
+        # Shards of the SD file may be computed concurrently by the executor (see FingerprintProvider.compute_shards).
+        # Without shards, there is nothing to compute.
+        self._sdf = sdf
+        self._shards = shards
+        self._executor = executor
         self._db_thread.start()
-        self._maya_thread.start()
+        self._fp_thread.start()
+
+    @property
+    def fingerprints(self) -> Fingerprints:
+        self._fp_thread.join()
+        return self._fingerprints
 
     @property
-    def fp_files(self):
-        self._maya_thread.join()
-        return self._fp_files
+    def throughput(self) -> float:  # Molecules per second
+        return len(self.fingerprints) / self.calculation_time if self.calculation_time > 0 else 0.
 
     @property
     def length(self) -> int:
@@ -66,57 +82,24 @@ class Fingerprint(object):
         return "{}_{}.bfp".format(self.user_arguments.db_path, self.name)
 
     @property
-    def db_bytes(self) -> bytes:
+    def database(self) -> FingerprintDatabase:
         self._db_thread.join()
-        return self._db_bytes
-
-    def _read_db_bytes(self):
-        self._db_bytes = Path("{}_{}.bfp".format(self.user_arguments.db_path, self.name)).read_bytes()
-
-
-
-    # start the maya calculation for this fingerprint
-    def maya_fp_calculation(self, sdf_filename: str):
-        """
-        It seems maya sdf reading doesn't lock the file, unlike C's fread.
-        So it might be useless to make [fp_number] sdf replicates for each maya thread.
-        """
-        base_sdf = Path(sdf_filename)
-        # sdf = Path(f'{self.name}_tmp.sdf')
-        # sdf.write_text(base_sdf.read_text(encoding=config.ENCODING), encoding=config.ENCODING)
-        output_dir = Path("out")
-        if not output_dir.is_dir():
-            output_dir.mkdir()
-
-        fp_files_name = Path( f"{base_sdf.stem}_{self.name}.fpf")
-        shell_cmd = '''{perl_path} {maya_path} {fp_cmd} --output FP --CompoundIDMode MolName -r {fp_file_name} -o "{input_file}"'''.format(
-            perl_path=self.perl_path
-            , maya_path=Path(self.maya_path, config.FINGERPRINT_CMD[self.name][0])
-            , fp_cmd=config.FINGERPRINT_CMD[self.name][1]
-            , input_file=base_sdf
-            , fp_file_name=fp_files_name.stem
-        )
-
-        # Calling maya fingerprint generation
-        completed_process = subprocess.run(shell_cmd, shell=True, capture_output=True, encoding=config.ENCODING)
-        # sdf.unlink()
-
-        if completed_process.returncode == 0:  # if everything went fine
+        return self._database
 
-            # Log maya output
-            Path(output_dir, f"log_{self.name}.log").write_text(completed_process.stdout, encoding=config.ENCODING)
+    def _read_database(self):
+        # Version 2 databases are only memory mapped here. Legacy ones are converted to the same layout.
+        self._database = self.database_store.database(self.user_arguments.db_path, self.name, self.provider.name)
 
-            # Move output in out dir
-            output_file_path = Path(output_dir, fp_files_name)
-            if output_file_path.is_file():
-                output_file_path.unlink()
-            fp_files_name.rename(output_file_path)
 
-            self._fp_files.append(output_file_path)
 
-        else:  # if something went wrong
-            self.errormsg = texts.maya_error.format(
-                self.name
-                , completed_process.stderr
-            )
+    # start the fingerprint calculation with the provider of this fingerprint
+    def fp_calculation(self):
+        t0 = time()
+        try:
+            if len(self._shards) > 0:
+                with profiling.span("fingerprints", fp=self.name, provider=self.provider.name, shards=len(self._shards)):
+                    self._fingerprints = self.provider.compute_shards(self.name, self._sdf, self._shards, self._executor)
+        except FingerprintError as e:  # if something went wrong
+            self.errormsg = str(e)
             self.error = True
+        self.calculation_time = time() - t0
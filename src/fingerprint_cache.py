@@ -0,0 +1,29 @@
+# Python 3.7 Built-in packages
+import hashlib
+import typing
+from pathlib import Path
+
+# Local packages
+from . import config
+from .sqlite_cache import SQLiteCache
+
+
+def molecule_key(molecule_block: str, signature: str) -> bytes:
+    """
+    Content address of the fingerprint of a SD file molecule : hash of its normalized molfile and of the provider signature.
+    The 3 header lines (name, program and timestamp, comment) and the data fields after "M  END" don't change
+    the fingerprint : they are left out, as are line endings and trailing spaces.
+    """
+    lines = [line.rstrip() for line in molecule_block.split('\n')[3:]]
+    if "M  END" in lines:
+        lines = lines[:lines.index("M  END") + 1]
+    return hashlib.sha256("\n".join([signature] + lines).encode(config.ENCODING)).digest()
+
+
+class FingerprintCache(SQLiteCache):
+    """
+    On-disk cache of query fingerprints, keyed by molecule_key.
+    The least recently used fingerprints are evicted past max_entries.
+    """
+    def __init__(self, path: typing.Union[str, Path], max_entries: int):
+        super().__init__(path, max_entries=max_entries)
@@ -0,0 +1,207 @@
+# Python 3.7 Built-in packages
+import abc
+import codecs
+import subprocess
+import typing
+from concurrent.futures import Executor
+from pathlib import Path
+
+# Local packages
+from . import config
+from . import texts
+from . import profiling
+from .misc import get_perl_path, get_maya_path
+
+# Optional packages. RDKit is only needed by the rdkit provider.
+try:
+    from rdkit import Chem, rdBase
+    from rdkit.Chem import AllChem, MACCSkeys
+    RDKIT_AVAILABLE = True
+except ImportError:
+    RDKIT_AVAILABLE = False
+
+Fingerprints = typing.Dict[str, bytes]  # Packed fingerprint of each molecule by name, in SD file order
+
+
+class FingerprintError(Exception):
+    pass
+
+
+class FingerprintProvider(abc.ABC):
+    """
+    Compute the fingerprints of every molecule of a SD file.
+    Fingerprints are packed bit vectors, in the layout of the databases : bit i is bit i % 8 of byte i // 8.
+    A provider must be used with databases built by the same provider, bits of different providers don't match.
+    """
+    name = ""
+
+    @classmethod
+    def supports(cls, fp_name: str) -> bool:
+        return fp_name in config.FINGERPRINT_SIZE
+
+    @abc.abstractmethod
+    def compute(self, fp_name: str, sdf: Path) -> Fingerprints:
+        raise NotImplementedError
+
+    def signature(self, fp_name: str) -> str:
+        # Everything the fingerprints depend on besides the molecule. Keys the fingerprint cache.
+        return "{} {} {}".format(self.name, fp_name, config.FINGERPRINT_SIZE[fp_name])
+
+    def compute_shards(self, fp_name: str, sdf: Path, shards: typing.List[Path], executor: Executor) -> Fingerprints:
+        # Compute the fingerprints of the molecules of sdf, split into shard files (see SDFIndex.shards), with executor running the jobs.
+        # sdf only names the outputs : it may not exist. In process providers are bound by the GIL : shards are computed in turn.
+        fingerprints = {}
+        for shard in shards:
+            fingerprints.update(self.compute(fp_name, shard))
+        return fingerprints
+
+
+class MayaProvider(FingerprintProvider):
+    """
+    Run the MayaChemTools script of the fingerprint (config.FINGERPRINT_CMD) in a Perl subprocess.
+    Fingerprints are written in out/<sdf>_<FP>.fpf, then read back.
+    """
+    name = config.MAYA_PROVIDER
+    perl_path = get_perl_path()
+
+    def __init__(self):
+        self.maya_path = get_maya_path()
+
+    @classmethod
+    def supports(cls, fp_name: str) -> bool:
+        return fp_name in config.FINGERPRINT_CMD
+
+    def compute(self, fp_name: str, sdf: Path) -> Fingerprints:
+        return self.compute_shards(fp_name, sdf, [sdf], None)
+
+    def signature(self, fp_name: str) -> str:
+        return "{} {}".format(super().signature(fp_name), " ".join(config.FINGERPRINT_CMD[fp_name]))
+
+    def compute_shards(self, fp_name: str, sdf: Path, shards: typing.List[Path], executor: Executor) -> Fingerprints:
+        """
+        Shards are computed by concurrent maya subprocesses, then their .fpf files are merged in input order.
+        It seems maya sdf reading doesn't lock the file, unlike C's fread.
+        So it might be useless to make [fp_number] sdf replicates for each maya thread.
+        """
+        output_dir = Path("out")
+        if not output_dir.is_dir():
+            output_dir.mkdir()
+
+        if len(shards) == 1:
+            shard_outputs = [self._run_maya(fp_name, shards[0], output_dir)]
+        else:
+            shard_outputs = [f.result() for f in [executor.submit(self._run_maya, fp_name, shard, shard.parent) for shard in shards]]
+
+        # Log maya output
+        Path(output_dir, f"log_{fp_name}.log").write_text("".join(stdout for fpf, stdout in shard_outputs), encoding=config.ENCODING)
+
+        fpf = Path(output_dir, f"{sdf.stem}_{fp_name}.fpf")
+        if len(shards) > 1:
+            merge_fpf([fpf for fpf, stdout in shard_outputs], fpf)
+        elif shard_outputs[0][0] != fpf:
+            shard_outputs[0][0].replace(fpf)
+        return read_fpf(fpf)
+
+    def _run_maya(self, fp_name: str, sdf: Path, output_dir: Path) -> typing.Tuple[Path, str]:
+        # Compute the fingerprints of sdf into output_dir/<sdf>_<FP>.fpf. Return the .fpf file and maya output.
+        fp_files_name = Path(f"{sdf.stem}_{fp_name}.fpf")
+        shell_cmd = '''{perl_path} {maya_path} {fp_cmd} --output FP --CompoundIDMode MolName -r {fp_file_name} -o "{input_file}"'''.format(
+            perl_path=self.perl_path
+            , maya_path=Path(self.maya_path, config.FINGERPRINT_CMD[fp_name][0])
+            , fp_cmd=config.FINGERPRINT_CMD[fp_name][1]
+            , input_file=sdf
+            , fp_file_name=fp_files_name.stem
+        )
+
+        # Calling maya fingerprint generation
+        with profiling.span("maya", fp=fp_name, sdf=sdf.name):
+            completed_process = subprocess.run(shell_cmd, shell=True, capture_output=True, encoding=config.ENCODING)
+        if completed_process.returncode != 0:
+            raise FingerprintError(texts.maya_error.format(fp_name, completed_process.stderr))
+
+        # Move output in out dir
+        output_file_path = Path(output_dir, fp_files_name)
+        if output_file_path.is_file():
+            output_file_path.unlink()
+        fp_files_name.rename(output_file_path)
+        return output_file_path, completed_process.stdout
+
+
+def _morgan_fingerprint(mol, fp_size: int, radius: int):
+    return AllChem.GetMorganFingerprintAsBitVect(mol, radius, nBits=fp_size)
+
+
+def _maccs_fingerprint(mol, fp_size: int):
+    return MACCSkeys.GenMACCSKeys(mol)
+
+
+RDKIT_GENERATORS = {                    # Generators named in config.RDKIT_FINGERPRINT
+    "Morgan": _morgan_fingerprint
+    , "MACCS": _maccs_fingerprint
+}
+
+
+class RDKitProvider(FingerprintProvider):
+    """
+    Compute the fingerprints in process with RDKit (config.RDKIT_FINGERPRINT), straight into memory.
+    Molecules RDKit can't read are skipped.
+    """
+    name = config.RDKIT_PROVIDER
+
+    @classmethod
+    def supports(cls, fp_name: str) -> bool:
+        return RDKIT_AVAILABLE and fp_name in config.RDKIT_FINGERPRINT
+
+    def signature(self, fp_name: str) -> str:
+        return "{} {} {}".format(super().signature(fp_name), rdBase.rdkitVersion, config.RDKIT_FINGERPRINT[fp_name])
+
+    def compute(self, fp_name: str, sdf: Path) -> Fingerprints:
+        generator_name, parameters = config.RDKIT_FINGERPRINT[fp_name]
+        generator = RDKIT_GENERATORS[generator_name]
+        fp_size = config.FINGERPRINT_SIZE[fp_name]
+        fingerprints = {}
+        with profiling.span("rdkit", fp=fp_name, sdf=sdf.name):
+            for mol in Chem.SDMolSupplier(str(sdf)):
+                if mol is None:
+                    continue
+                bits = generator(mol, fp_size, **parameters).ToBitString()
+                fingerprints[mol.GetProp("_Name")] = int(bits[::-1], 2).to_bytes((fp_size + 7) // 8, 'little')
+        return fingerprints
+
+
+PROVIDERS: typing.Dict[str, typing.Type[FingerprintProvider]] = {
+    config.MAYA_PROVIDER: MayaProvider
+    , config.RDKIT_PROVIDER: RDKitProvider
+}
+
+
+def get_provider_class(provider_name: str, fp_name: str) -> typing.Type[FingerprintProvider]:
+    # Provider class of a fingerprint. Fingerprints the provider can't compute fall back to MayaChemTools.
+    provider_class = PROVIDERS[provider_name]
+    if not provider_class.supports(fp_name):
+        provider_class = MayaProvider
+    return provider_class
+
+
+def get_provider(provider_name: str, fp_name: str) -> FingerprintProvider:
+    return get_provider_class(provider_name, fp_name)()
+
+
+def read_fpf(fpf: Path) -> Fingerprints:
+    # Read a MayaChemTools .fpf file : comment lines (#) then one "<molecule name> <hexadecimal fingerprint>" line per molecule
+    lines: typing.List[str] = fpf.read_text(encoding=config.ENCODING).split('\n')[:-1]
+    while lines and lines[0][0] == '#':
+        lines.pop(0)
+    return {molecule_name: codecs.decode(v, 'hex') for molecule_name, v in [line.split(' ') for line in lines]}
+
+
+def merge_fpf(fpf_list: typing.List[Path], output: Path):
+    # Concatenate .fpf files in order, keeping the comment lines of the first one only. The merged files are removed.
+    lines: typing.List[str] = []
+    for fpf in fpf_list:
+        fpf_lines = fpf.read_text(encoding=config.ENCODING).split('\n')[:-1]
+        while lines and fpf_lines and fpf_lines[0].startswith('#'):
+            fpf_lines.pop(0)
+        lines.extend(fpf_lines)
+        fpf.unlink()
+    output.write_text("".join(line + '\n' for line in lines), encoding=config.ENCODING)
@@ -1,172 +1,225 @@
 # Python 3.7 Built-in packages
 import typing
-import codecs
-import csv
+import array
 from pathlib import Path
 import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # Local packages
-from . import config
+from . import config, profiling
 from .fingerprint import Fingerprint
-from .arg_parsing import UserArguments, FINGERPRINT, SDFile
+from .fingerprint_providers import Fingerprints, read_fpf
+from .database import FingerprintDatabase, fingerprint_stride
+from .fingerprint_cache import FingerprintCache, molecule_key
+from .database_store import DatabaseStore
+from .target_info import TargetInfoSource
+from .target_table import TargetTable
+from .arg_parsing import UserArguments, FINGERPRINT, SDFile, NUM_CORE
 
 MOLECULE_NAME = 0
-QBFP_FILE = 1
+QUERY_ROW = 1
+QUERY_FINGERPRINTS = 2
 TC_PROCESS_ARGS = 3
 
 
 def get_empty_tc_process_dict():
     return {
         MOLECULE_NAME: None
-        , QBFP_FILE: None
+        , QUERY_ROW: None
+        , QUERY_FINGERPRINTS: None
         , TC_PROCESS_ARGS: None
     }
 
 
+class QueryFingerprints(object):
+    """
+    Fingerprints of every query molecule, kept in memory and handed as is to the kernel.
+    One packed matrix per fingerprint (in database order) with one row per molecule, zero-padded to the database stride,
+    plus the name table and the number of leading fingerprints available for each molecule.
+    """
+    def __init__(self, fp_sizes: typing.List[int]):
+        self.strides: typing.List[int] = [fingerprint_stride(fp_size) for fp_size in fp_sizes]
+        self.names: typing.List[str] = []
+        self.matrices: typing.List[bytearray] = [bytearray() for _ in fp_sizes]
+        self.fingerprint_numbers = bytearray()
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, molecule_name: str, fingerprints: typing.List[typing.Optional[bytes]]) -> int:
+        # Add a molecule, its fingerprints given in database order (None when missing). Return its row.
+        # Only the leading fingerprints are compared : a missing fingerprint ends the comparison of the molecule.
+        fingerprint_number = 0
+        while fingerprint_number < len(fingerprints) and fingerprints[fingerprint_number] is not None:
+            fingerprint_number += 1
+        for matrix, stride, fp in zip(self.matrices, self.strides, fingerprints):
+            matrix += (fp or b"")[:stride].ljust(stride, b"\x00")
+        self.fingerprint_numbers.append(fingerprint_number)
+        self.names.append(molecule_name)
+        return len(self.names) - 1
+
+    def fingerprint(self, row: int, f: int) -> bytes:  # f-th fingerprint of a molecule, zero-padded
+        return bytes(self.matrices[f][row * self.strides[f]:(row + 1) * self.strides[f]])
+
+    def row_fingerprints(self, row: int) -> bytes:
+        # Fingerprints compared for a molecule, packed : their number, then each of them
+        fingerprint_number = self.fingerprint_numbers[row]
+        return bytes([fingerprint_number]) + b"".join(
+            matrix[row * stride:(row + 1) * stride] for matrix, stride in zip(self.matrices[:fingerprint_number], self.strides)
+        )
+
+    def kernel_arguments(self, rows: typing.List[int]) -> tuple:
+        # Query arguments of tc_process_arrays for the given rows. The matrices are shared, not copied.
+        return (
+            list(zip(self.matrices, self.strides))
+            , self.fingerprint_numbers
+            , array.array('i', rows)
+        )
+
+    def block_arguments(self, rows: typing.List[int]) -> tuple:
+        # Same as kernel_arguments, with the rows copied into matrices of their own : small enough to be sent to another process
+        return (
+            [(b"".join(matrix[row * stride:(row + 1) * stride] for row in rows), stride) for matrix, stride in zip(self.matrices, self.strides)]
+            , bytes(self.fingerprint_numbers[row] for row in rows)
+            , array.array('i', range(len(rows)))
+        )
+
+
+def merge_fingerprints(names: typing.List[str], cached: Fingerprints, computed: Fingerprints) -> Fingerprints:
+    # Cached and computed fingerprints, in the input order of the molecules
+    fingerprints = {name: cached[name] if name in cached else computed[name] for name in names if name in cached or name in computed}
+    for name, bfp in computed.items():
+        fingerprints.setdefault(name, bfp)
+    return fingerprints
+
+
 class FingerprintList(object):
-    def __init__(self, args: UserArguments, sdf: Path):
+    def __init__(self, args: UserArguments, sdf: Path, database_store: typing.Optional[DatabaseStore] = None):
         self.user_arguments: UserArguments = args
+        self.database_store: DatabaseStore = database_store if database_store is not None else DatabaseStore()
         self.fp_list: typing.List[Fingerprint] = []
         self.molecule_files = []
         self.sdf: Path = sdf
 
         # DB reading thread
-        self._info_thread = threading.Thread(
-            target=self._read_info
-            , name='thread_read_info'
-        )
-        self._info_dict: typing.Dict[str, typing.List[str]] = {}
         self._db_thread = threading.Thread(
             target=self._read_database
             , name='thread_read_db'
         )
-        self._db: typing.Dict[str, typing.List[str]] = {}
-
-        temp_dir_path = Path(config.DEFAULT_BINARY_FINGERPRINT_FOLDER)
-        if not temp_dir_path.is_dir():
-            temp_dir_path.mkdir()
-        self.bfp_dir: Path = temp_dir_path
-        self.bfp_files: typing.List[typing.Tuple[str, Path]] = []
-        self.db_list: typing.List[str] = []
+        self._db: typing.Optional[TargetTable] = None
+
+        self.query_fingerprints: typing.Optional[QueryFingerprints] = None
+        self.fingerprint_cache: typing.Optional[FingerprintCache] = None
+        if self.user_arguments.use_fingerprint_cache:
+            self.fingerprint_cache = FingerprintCache(config.DEFAULT_FINGERPRINT_CACHE_FILE, config.FINGERPRINT_CACHE_MAX_ENTRIES)
+        self.db_list: typing.List[FingerprintDatabase] = []
         self.tc_threshold_list: typing.List[float] = []
         self.query_dicts: typing.List[dict] = []
 
     def create_fingerprints(self):
         for fp_name in self.user_arguments.dict[FINGERPRINT]:
-            self.fp_list.append(Fingerprint(fp_name, self.user_arguments, self.sdf))
+            self.fp_list.append(Fingerprint(fp_name, self.user_arguments, self.sdf, self.database_store))
 
     def generate_molecule_files(self) -> typing.List[typing.Dict[int, typing.Any]]:  # Start maya calculation in parallel (Worth it)
-        # Start maya calculation
+        # Start fingerprint calculation of the molecules missing from the cache.
+        # Large inputs are split into shards computed concurrently within the -cpu budget.
+        cpu = max(1, self.user_arguments.dict[NUM_CORE])
+        index = self.user_arguments.sdf_index
+        molecules = list(range(len(index)))
+        executor = ThreadPoolExecutor(max_workers=cpu, thread_name_prefix='fp_shard')
+        cached_fingerprints: typing.List[Fingerprints] = []
+        missing_keys: typing.List[typing.Dict[str, bytes]] = []
         for fp in self.fp_list:
-            fp.start_maya_calculation()
+            fp_molecules, cached, keys = molecules, {}, {}
+            if self.fingerprint_cache is not None:
+                signature = fp.provider.signature(fp.name)
+                keys = {index.names[i]: molecule_key(index.block(i), signature) for i in molecules}
+                found = self.fingerprint_cache.get_many(list(keys.values()))
+                cached = {name: found[key] for name, key in keys.items() if key in found}
+                fp_molecules = [i for i in molecules if index.names[i] not in cached]
+            # Shards are written straight from the input files, missing molecules only
+            shards = index.shards(
+                fp_molecules, min(cpu, len(fp_molecules) // config.MAYA_SHARD_SIZE), Path(config.DEFAULT_SDF_SHARD_FOLDER, fp.name)
+                , Path(self.sdf).stem
+            ) if len(fp_molecules) > 0 else []
+            fp.start_fp_calculation(Path(self.sdf), shards, executor)
+            cached_fingerprints.append(cached)
+            missing_keys.append({name: key for name, key in keys.items() if name not in cached})
+
+        self._start_database_reading()
+
+        fingerprint_list = []
+        for fp, cached, keys in zip(self.fp_list, cached_fingerprints, missing_keys):
+            fingerprints = fp.fingerprints  # Wait for the calculation
+            if fp.error:
+                raise RuntimeError(fp.errormsg)
+            if self.fingerprint_cache is not None:
+                self.fingerprint_cache.put_many([(keys[name], bfp) for name, bfp in fingerprints.items() if name in keys])
+            if len(cached) > 0:
+                fingerprints = merge_fingerprints(index.names, cached, fingerprints)
+            fingerprint_list.append((fingerprints, fp.length))
+        executor.shutdown()
+        self.assemble_fingerprints(fingerprint_list)
 
-        # Start reading target database and info for future matching
-        self._db_thread.start()
-        self._info_thread.start()
+        return self.query_dicts
 
-        self.db_list = [fp.db_bytes for fp in self.fp_list]
-        # self.db_list = [fp.db_name for fp in self.fp_list]
-        self.tc_threshold_list = [fp.threshold for fp in self.fp_list]
+    def use_fingerprints(self, fingerprint_list: typing.List[Fingerprints]) -> typing.List[typing.Dict[int, typing.Any]]:
+        # Use fingerprints computed beforehand, one Fingerprints per fingerprint of fp_list, instead of computing them
+        for fp in self.fp_list:
+            fp.start_fp_calculation(Path(self.sdf), [], None)
+        self._start_database_reading()
+        self.assemble_fingerprints([(fingerprints, fp.length) for fingerprints, fp in zip(fingerprint_list, self.fp_list)])
+        return self.query_dicts
 
-        self.assemble_files([fpf for fpf in [(fp.fp_files[0], fp.length, fp.name) for fp in self.fp_list]])
+    def _start_database_reading(self):
+        # Start reading target database for future matching
+        self._db_thread.start()
 
-        return self.query_dicts
+        self.db_list = [fp.database for fp in self.fp_list]
+        self.tc_threshold_list = [fp.threshold for fp in self.fp_list]
 
     def assemble_files(self, fpf_list: typing.List[typing.Tuple[Path, int, str]]):
-        d: typing.Dict[str, typing.List[typing.Tuple[bytes, bytes]]] = {}
-
-        for fpf, fp_length, fp_name in fpf_list:
+        self.assemble_fingerprints([(read_fpf(fpf), fp_length) for fpf, fp_length, fp_name in fpf_list])
 
-            lines: typing.List[str] = fpf.read_text(encoding=config.ENCODING).split('\n')[:-1]
-            while lines[0][0] == '#':
-                lines.pop(0)
+    def assemble_fingerprints(self, fingerprint_list: typing.List[typing.Tuple[Fingerprints, int]]):
+        with profiling.span("assemble_fingerprints"):
+            self._assemble_fingerprints(fingerprint_list)
 
-            for molecule_name, v in [line.split(' ') for line in lines]:
+    def _assemble_fingerprints(self, fingerprint_list: typing.List[typing.Tuple[Fingerprints, int]]):
+        d: typing.Dict[str, typing.List[typing.Optional[bytes]]] = {}
 
-                fp_length_bytes = fp_length.to_bytes(4, byteorder='big', signed=False)
+        for f, (fingerprints, fp_length) in enumerate(fingerprint_list):
+            for molecule_name, bfp in fingerprints.items():
                 if molecule_name not in d:
-                    d[molecule_name] = [(codecs.decode(v, 'hex'), fp_length_bytes)]
-                else:
-                    d[molecule_name].append((codecs.decode(v, 'hex'), fp_length_bytes))
+                    d[molecule_name] = [None] * len(fingerprint_list)
+                d[molecule_name][f] = bfp
 
-        if not self.bfp_dir.is_dir():
-            self.bfp_dir.mkdir()
+        self.query_fingerprints = QueryFingerprints([fp_length for fingerprints, fp_length in fingerprint_list])
 
-        static_arguments = (self.db_list, self.tc_threshold_list, self.user_arguments.zscore_threshold, self.user_arguments.consensus)
+        static_arguments = (
+            self.db_list, self.tc_threshold_list, self.user_arguments.zscore_threshold, self.user_arguments.consensus
+            , self.user_arguments.top_k
+        )
 
         for molecule_name, bfps in d.items():
             query_dict = get_empty_tc_process_dict()
             query_dict[MOLECULE_NAME] = molecule_name
 
-            file = Path(self.bfp_dir, "{}.qbfp".format(molecule_name))
-            stream = file.open('wb')
-
-            query_dict[QBFP_FILE] = file
-            query_dict[TC_PROCESS_ARGS] = ("{}".format(file), *static_arguments)
-
-
-            molecule_name_length = len(molecule_name).to_bytes(1, byteorder='big', signed=True)
-            encoded_molecule_name = molecule_name.encode('ascii')
-            for bfp, fp_length_byte in bfps:
-                stream.write(molecule_name_length)
-                stream.write(encoded_molecule_name)
-                stream.write(fp_length_byte)
-                stream.write(bfp)
-            stream.close()
+            row = self.query_fingerprints.add(molecule_name, bfps)
+            query_dict[QUERY_ROW] = row
+            query_dict[QUERY_FINGERPRINTS] = self.query_fingerprints
+            query_dict[TC_PROCESS_ARGS] = (row, *static_arguments)
 
             self.query_dicts.append(query_dict)
-            self.bfp_files.append((molecule_name, file))
 
     def _read_database(self):
-        text_ = Path(self.user_arguments.db_path + config.DEFAULT_TLT_FILE_SUFFIX).read_text()
-        self._db = {l[0]: l[1:] for l in [line.split(' ') for line in text_.split('\n')]}
-
-    def _read_info(self):
-
-        # Create filter function for info dictionary generation
-        def info_to_be_filtered(k):
-            return True
-        if not self.user_arguments.show_info:
-            def info_to_be_filtered(key):
-                # Filter out key that are not uniprot id nor chemblid
-                return key == config.INFO_UNIPROTID_FIELD_NAME \
-                       or key == config.INFO_CHEMBLID_FIELD_NAME
-
-        def get_correlation_dict(file_name: str) -> typing.Dict[str, str]:
-            # Give dict that take the TID as key and return chembl_id
-            file = Path(file_name).open('r', encoding=config.ENCODING)
-            od = csv.DictReader(file, delimiter=config.TID_CHEMBLID_DELIMITER)
-            d = {f[config.CORR_TID_FIELD_NAME]: f[config.CORR_CHEMBLID_FIELD_NAME] for f in od}
-            file.close()
-            return d
-
-        def get_info_dict(file_name: str) -> typing.Dict[str, typing.List[typing.Dict[str, str]]]:
-            # Give a dict that take the CHEMBLID as key and return a dict of information
-            file = Path(file_name).open('r', encoding=config.ENCODING)
-            od = csv.DictReader(file, delimiter=config.UNIPROT_DATABASE__CHEMBL_FILE_DELIMITER)
-            normal_dict_list = [{k: v for k, v in d.items() if info_to_be_filtered(k)} for d in od]
-            return_d = {normal_dict[config.INFO_CHEMBLID_FIELD_NAME]: [] for normal_dict in normal_dict_list}
-            [return_d[normal_dict[config.INFO_CHEMBLID_FIELD_NAME]].append(normal_dict) for normal_dict in normal_dict_list]
-            file.close()
-            return return_d
-
-        # correl_dict = get_correlation_dict(config.DEFAULT_TID_CHEMBLID_FILE_NAME)
-        # info_dict = get_info_dict(config.DEFAULT_UNIPROT_DATABASE__CHEMBL_FILE_NAME)
-        self._info_dict = get_info_dict(config.DEFAULT_UNIPROT_DATABASE__CHEMBL_FILE_NAME)
-        # print(self._info_dict)
-        # correl_dict = get_correlation_dict(config.DEFAULT_TID_CHEMBLID_FILE_NAME)
-        # info_dict = get_info_dict(config.DEFAULT_UNIPROT_DATABASE__CHEMBL_FILE_NAME)
-        # self._info_dict = {k: info_dict[v] for k, v in correl_dict.items() if v in info_dict}
-
-        # l = []  # Some lines I decided to keep to check file reading if changes occur
-        # [[l.append(vv) for vv in v] for v in self._info_dict.values()]
-        # print(f"Length of the information dictionary: {len(l)}")
-
-    def get_info(self) -> typing.Dict[str, typing.List[str]]:
-        self._info_thread.join()
-        return self._info_dict
-
-    def get_db(self) -> typing.Dict[str, typing.List[str]]:
+        self._db = self.database_store.target_table(self.user_arguments.db_path)
+
+    def get_target_info(self) -> typing.Optional[TargetInfoSource]:
+        # Opened only : the information of the targets found is read when results are output
+        return self.database_store.target_info()
+
+    def get_db(self) -> TargetTable:
         self._db_thread.join()
         return self._db
 
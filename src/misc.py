@@ -51,9 +51,6 @@ def system_verification() -> (bool, list):
     temp_dir = Path(config.BASE_TEMP_DIR)
     if not temp_dir.is_dir():
         temp_dir.mkdir()
-    bin_temp_dir = Path(config.DEFAULT_BINARY_FINGERPRINT_FOLDER)
-    if not bin_temp_dir.is_dir():
-        bin_temp_dir.mkdir()
 
 
     return system_ok, messages
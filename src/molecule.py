@@ -3,51 +3,78 @@ import typing
 from dataclasses import dataclass
 
 # Local packages
-from .fingerprints import MOLECULE_NAME, QBFP_FILE, TC_PROCESS_ARGS
+from . import profiling
+from .fingerprints import MOLECULE_NAME, QUERY_ROW, QUERY_FINGERPRINTS, TC_PROCESS_ARGS
 from .config import Target_Id, Database_Id, Score
+from .database import FingerprintDatabase, kernel_arguments
+from .target_table import TargetTable
 from .misc import is_windows, is_mac, is_linux
 
 # Import the compiled C library. This complex import is made to be plateform-independant.
 try:
     if is_windows():
-        from .clib_w64.tanimoto_processing import tc_process
+        from .clib_w64.tanimoto_processing import tc_process_arrays, tc_process_shard, popcount_kernel, popcount_self_test
     elif is_linux():
-        from .clib_linux64.tanimoto_processing import tc_process
+        from .clib_linux64.tanimoto_processing import tc_process_arrays, tc_process_shard, popcount_kernel, popcount_self_test
     elif is_mac():
-        from .clib_mac64.tanimoto_processing import tc_process
+        from .clib_mac64.tanimoto_processing import tc_process_arrays, tc_process_shard, popcount_kernel, popcount_self_test
 except ImportError:
     print("Error during compiled library importation. If the problem persists, please re-install the application.")
     exit(1)
 
 
+class HitArrays(typing.NamedTuple):  # Results of one query as returned by tc_process_arrays
+    indices: memoryview     # Index of each hit in the first database
+    tcs: memoryview         # Tanimoto coefficients, one per fingerprint for each hit
+    zscores: memoryview     # Normalization only : zscores, one per fingerprint then their mean for each hit
+    pruned_number: int      # Database compounds skipped by the popcount bounds (databases sorted by popcount)
+
+    @classmethod
+    def from_kernel(cls, results: typing.Tuple[bytes, bytes, bytes, int]) -> "HitArrays":
+        indices, tcs, zscores, pruned_number = results
+        return cls(memoryview(indices).cast('i'), memoryview(tcs).cast('d'), memoryview(zscores).cast('d'), pruned_number)
+
+    def scores(self) -> typing.Iterator[Score]:  # Score of each hit : the last value of its row, zscore mean or tanimoto
+        if len(self.indices) == 0:
+            return iter(())
+        values = self.zscores if len(self.zscores) > 0 else self.tcs
+        width = len(values) // len(self.indices)
+        return iter(values[width - 1::width])
+
+
 class Molecule(object):
     def __init__(self, query_dict: typing.Dict[int, typing.Any],  max_target: int, not_filter_best_match_per_target: bool):
         self.name = query_dict[MOLECULE_NAME]
-        self.bfp_file = query_dict[QBFP_FILE]
+        self.query_row = query_dict[QUERY_ROW]
+        self.query_fingerprints = query_dict[QUERY_FINGERPRINTS]
         self.tc_process_args = query_dict[TC_PROCESS_ARGS]
         self.hits: typing.List[Hit] = []
         self.max_target_number: int = max_target
         self.hit_results_dict: typing.Dict[Target_Id, typing.List[typing.Tuple[Database_Id, Score]]] = {}
         self.not_filter_best_match_per_target = not_filter_best_match_per_target
 
-    def compute_tanimoto(self, shared_db, shared_progression_queue, output_queue):  # Compute tanimoto, zscore if asked then give results
+    def compute_tanimoto(self, target_table: TargetTable, shared_progression_queue, output_queue):  # Compute tanimoto, zscore if asked then give results
 
         # Start C module. current bottleneck (with maya of course)
-        results_dict: typing.Dict[Database_Id, typing.List[Score]] = tc_process(*self.tc_process_args)
-
-        # print(f"Molecule : {self.name} - End of C computation - {len(results_dict.keys())} hits found\n", end='')
-        shared_db[0].acquire()  # I'm not sure it is usefull to lock dictionary while reading
-        db = shared_db[1]
-        for k, v in results_dict.items():
-            self.hits.append(Hit(k, db.get(k, []), v[-1]))
-        shared_db[0].release()
+        compute_tanimoto_batch([self], target_table, shared_progression_queue, output_queue)
+
+    def process_results(self, hit_arrays: HitArrays, database: FingerprintDatabase, target_table: TargetTable, shared_progression_queue, output_queue):
+        # print(f"Molecule : {self.name} - End of C computation - {len(hit_arrays.indices)} hits found\n", end='')
+        # The target table is a local object of the worker : looking up a hit costs no inter-process call
+        for index, score in zip(hit_arrays.indices, hit_arrays.scores()):
+            self.hits.append(Hit(database.compound_id(index), target_table.targets(database, index), score))
         self.compute_bmpt()
 
         # Adding None to the queue allow main process to know when this molecule's job's is finished
-        shared_progression_queue.put(None)
-        output_queue.put((self.hit_results_dict, self.name))
+        with profiling.span("queue_put"):
+            shared_progression_queue.put(None)
+            output_queue.put((self.hit_results_dict, self.name))
 
     def compute_bmpt(self):  # Build the best match per target dictionary (based on the higher zscore)
+        with profiling.span("compute_bmpt"):
+            self._compute_bmpt()
+
+    def _compute_bmpt(self):
         d = {}
         n_hits = 0
         for hit in self.hits:
@@ -67,6 +94,27 @@ class Molecule(object):
         self.hit_results_dict = d
 
 
+def compute_tanimoto_batch(molecules: typing.List[Molecule], target_table: TargetTable, shared_progression_queue, output_queue) -> int:
+    """
+    Compute tanimoto of a block of molecules with one kernel call, so the databases are streamed once for the whole block.
+    Molecules must share the same query fingerprints, databases and thresholds, which is the case for every molecule of a run.
+    Return the number of database compounds pruned for the block.
+    """
+    query_row, databases, *static_arguments = molecules[0].tc_process_args
+    with profiling.span("tc_process", molecules=len(molecules)):
+        results: typing.List[typing.Tuple[bytes, bytes, bytes, int]] = tc_process_arrays(
+            *molecules[0].query_fingerprints.kernel_arguments([molecule.query_row for molecule in molecules])
+            , kernel_arguments(databases)
+            , *static_arguments
+        )
+    pruned_number = 0
+    for molecule, results_tuple in zip(molecules, results):
+        hit_arrays = HitArrays.from_kernel(results_tuple)
+        pruned_number += hit_arrays.pruned_number
+        molecule.process_results(hit_arrays, databases[0], target_table, shared_progression_queue, output_queue)
+    return pruned_number
+
+
 @dataclass
 class Hit(object):  # Hold db name of a molecule that is beneath the thresholds
     chembl_id:     str
@@ -3,13 +3,19 @@ import typing
 import gc
 import multiprocessing as mp
 import threading
-import math
+import queue
+from concurrent.futures import Executor, ThreadPoolExecutor
 
 # Local packages
-from src.molecule import Molecule
+from src import config, texts, profiling
+from src.molecule import Molecule, compute_tanimoto_batch
 from src.progression_bar import ProgressionBar
 from .fingerprints import FingerprintList
-from .arg_parsing import UserArguments, NUM_CORE
+from .result_cache import ResultCache, result_key
+from .scheduler import BatchScheduler, estimated_cost
+from .shards import ShardPool
+from .target_table import target_table_file
+from .arg_parsing import UserArguments, NUM_CORE, FINGERPRINT
 
 
 class MoleculeList(object):
@@ -22,8 +28,6 @@ class MoleculeList(object):
     def _create_list(self, fps: FingerprintList): # Create the list of molecule object that will hold computations
         max_target = self.user_arguments.max_target_number
         best_match_per_target = self.user_arguments.not_filter_best_match_per_target
-        self._db_thr.start()
-        self._info_thr.start()
         for query_dict in self.query_dicts:
             self.molecules.append(Molecule(query_dict, max_target, best_match_per_target))
 
@@ -32,63 +36,103 @@ class MoleculeList(object):
         self.molecules: typing.List[Molecule] = []
         self.query_dicts:  typing.List[typing.Dict[int, typing.Any]] = query_dicts
 
-        self.processes_manager = mp.Manager()
-        self.output_lock = self.processes_manager.Lock()
-
-        self.db_lock = self.processes_manager.Lock()
-        self.db_lock.acquire()
-
-        self.info_lock = self.processes_manager.Lock()
-        self.info_lock.acquire()
-
-        self.shared_db = self.processes_manager.dict()
-        self.shared_info = self.processes_manager.dict()
-        self._db_thr = threading.Thread(
-            target=self._share_db
-            , args=(fps.get_db, )
-        )
-        self._info_thr = threading.Thread(
-            target=self._share_info
-            , args=(fps.get_info, )
-        )
-        self.shared_progression_queue = self.processes_manager.Queue()
-        self.shared_output_queue = self.processes_manager.Queue()
-        self.compute_arguments = ((self.db_lock, self.shared_db),)
-
-    def _share_db(self, get_db: callable):
-        self.shared_db.update(get_db())
-        self.db_lock.release()
-
-    def _share_info(self, get_info: callable):
-        self.shared_info.update(get_info())
-        self.info_lock.release()
+        if args.backend == config.THREADS_BACKEND:
+            # Everything lives in this process : plain objects, no manager server
+            self.processes_manager = None
+            lock_type, dict_type, queue_type = threading.Lock, dict, queue.Queue
+        else:
+            self.processes_manager = mp.Manager()
+            lock_type, dict_type, queue_type = self.processes_manager.Lock, self.processes_manager.dict, self.processes_manager.Queue
+
+        self.output_lock = lock_type()
+
+        self._get_target_table = fps.get_db
+        self._get_target_info = fps.get_target_info  # Read by the output thread of this process, workers never see it
+        self.shared_progression_queue = queue_type()
+        self.shared_output_queue = queue_type()
+        self.shared_statistics = dict_type()  # (compared, pruned) database compound numbers of each molecule list
+        self.shared_profiles = dict_type()  # -profile : spans of each worker process
+        self.compute_arguments: tuple = ()  # Arguments of compute_tanimoto_batch given to every worker, set when computing
+
+        self.result_cache: typing.Optional[ResultCache] = None
+        self.database_files: typing.List[str] = [fp.db_name for fp in fps.fp_list] + [str(target_table_file(args.db_path))]
+        if args.use_result_cache:
+            self.result_cache = ResultCache(config.DEFAULT_RESULT_CACHE_FILE, config.RESULT_CACHE_MAX_BYTES)
+        self.executor: typing.Optional[Executor] = None  # Threads backend : pool kept by the caller (prediction server) instead of one per run
+
+    def _take_cached_results(self) -> typing.Dict[str, bytes]:
+        """
+        Send the cached results of the molecules straight to the output and remove these molecules from the list.
+        Return the result cache key of each remaining molecule.
+        """
+        if len(self.molecules) == 0:
+            return {}
+        run_signature = self.result_cache.run_signature(self.database_files, (
+            self.user_arguments.dict[FINGERPRINT], *self.molecules[0].tc_process_args[2:], self.user_arguments.not_filter_best_match_per_target
+        ))
+        keys = {
+            molecule.name: result_key(run_signature, molecule.query_fingerprints.row_fingerprints(molecule.query_row))
+            for molecule in self.molecules
+        }
+        found = self.result_cache.get_results(list(keys.values()))
+        remaining_molecules = []
+        for molecule in self.molecules:
+            if keys[molecule.name] in found:
+                self.shared_progression_queue.put(None)
+                self.shared_output_queue.put((found[keys[molecule.name]], molecule.name))
+            else:
+                remaining_molecules.append(molecule)
+        self.molecules = remaining_molecules
+        return {molecule.name: keys[molecule.name] for molecule in remaining_molecules}
 
     def compute_fingerprints(self):
         num_concurrent_processes = self.user_arguments.dict[NUM_CORE]
         processes = []  # We keep a list of processes to join them
         molecules_number = len(self.molecules)
-        molecule_per_process = max(math.floor(molecules_number / num_concurrent_processes), 1) # Number of molecule per process
-        molecules_list = []  # Will hold a list of list of molecules to distribute calculations among a specified number of cores
-
-        while len(self.molecules) > 0:
-            molecules = []
-            for f in range(molecule_per_process):
-                if len(self.molecules) == 0:
-                    break
-                molecules.append(self.molecules.pop(0))
-            molecules_list.append(molecules)
-
-        i = 0  # Just for process naming purpose
-        for molecules in molecules_list:
-            # Start the right number of processes
-            process = mp.Process(
-                    target=compute_molecule_list
-                    , args=(self.compute_arguments, molecules, self.shared_progression_queue, self.shared_output_queue)
-                    , name="tanimoto_process_{}".format(i)
-                )
-            process.start()
-            processes.append(process)
-            i += 1
+        missing_keys = self._take_cached_results() if self.result_cache is not None else {}
+
+        # Workers get the target table itself, not a manager proxy : forked processes inherit it, spawned ones unpickle it once
+        self.compute_arguments = (self._get_target_table(),)
+
+        # A fixed pool of workers pulls batches of molecules until none is left, costliest molecules first
+        worker_number = min(max(num_concurrent_processes, 1), len(self.molecules))
+        shard_number = self.user_arguments.shard_number
+        shard_pool: typing.Optional[ShardPool] = None
+        compute_batch = compute_tanimoto_batch
+        if shard_number > 1 and len(self.molecules) > 0:
+            # Sharded databases : one thread of this process sends the batches to the shard processes and merges their results
+            shard_pool = ShardPool(self.molecules[0].tc_process_args[1], shard_number)
+            compute_batch = shard_pool.compute_batch
+            worker_number = 1
+        threaded = self.user_arguments.backend == config.THREADS_BACKEND or shard_pool is not None
+        if worker_number > 1:
+            self.molecules.sort(key=estimated_cost, reverse=True)
+        scheduler = BatchScheduler(
+            len(self.molecules), worker_number, tanimoto_batch_size(self.molecules, shard_number) if len(self.molecules) > 0 else 1
+            , shared=not threaded
+        )
+        worker_arguments = [
+            (compute_batch, self.compute_arguments, self.molecules, scheduler, self.shared_progression_queue, self.shared_output_queue
+             , self.shared_statistics, i, self.shared_profiles, profiling.origin(), not threaded)
+            for i in range(worker_number)
+        ]
+
+        if threaded:
+            executor = self.executor
+            if executor is None:
+                executor = ThreadPoolExecutor(max_workers=worker_number or 1, thread_name_prefix="tanimoto_thread")
+            jobs = [executor.submit(compute_scheduled_molecules, *arguments) for arguments in worker_arguments]
+        else:
+            executor = None
+            jobs = []
+            for i, arguments in enumerate(worker_arguments):
+                process = mp.Process(
+                        target=compute_scheduled_molecules
+                        , args=arguments
+                        , name="tanimoto_process_{}".format(i)
+                    )
+                process.start()
+                processes.append(process)
 
         if self.user_arguments.is_output_file:
             progression_bar = ProgressionBar(molecules_number, self.shared_progression_queue)
@@ -96,18 +140,81 @@ class MoleculeList(object):
             progression_bar.watch_progression()
 
         output_object = self.user_arguments.output_function
-        output_object.watch_output(self.shared_info, self.shared_output_queue, molecules_number)
+        if self.result_cache is not None:
+            output_object.processed_results = []
+        output_object.watch_output(self._get_target_info(), self.shared_output_queue, molecules_number)
 
         [p.join() for p in processes]  # Join all processes
+        if executor is not None:
+            try:
+                [job.result() for job in jobs]  # Wait for all threads, raising their errors if any
+            finally:
+                if executor is not self.executor:
+                    executor.shutdown()
+        shard_profiles = shard_pool.close() if shard_pool is not None else []
         output_object.wait()
+        profiler = profiling.current()
+        if profiler is not None:
+            for profile in [*self.shared_profiles.values(), *shard_profiles]:
+                profiler.add_process(profile)
         print()
-
-
-def compute_molecule_list(compute_arguments, molecules: typing.List[Molecule], shared_progression_queue, shared_output_queue):
-    gc.disable()  # Disable automated garbage collector while computing. Great performance improve
-    for molecule in molecules:
-        molecule.compute_tanimoto(*compute_arguments, shared_progression_queue, shared_output_queue)
-        gc.collect()  # Clean unreferenced variables manually to avoid memory overflow
-    gc.enable()  # Re-enable garbage collector back.
-
-
+        self.print_statistics()
+        if self.result_cache is not None:
+            self.result_cache.put_results([
+                (missing_keys[name], results) for results, name in output_object.processed_results if name in missing_keys
+            ])
+            print(texts.result_cache_statistics.format(
+                self.result_cache.hits, self.result_cache.misses, self.result_cache.hit_rate, self.result_cache.evictions
+            ))
+            self.result_cache.close()
+
+    def print_statistics(self):
+        statistics = list(self.shared_statistics.values())
+        compared_number = sum(compared for compared, pruned in statistics)
+        pruned_number = sum(pruned for compared, pruned in statistics)
+        if pruned_number > 0:
+            print(texts.pruned_compounds.format(pruned_number, compared_number, 100 * pruned_number / compared_number))
+
+
+def tanimoto_batch_size(molecules: typing.List[Molecule], shard_number: int = 1) -> int:
+    # Number of molecules sent at once to the kernel. It keeps one score (a double) per molecule and database compound,
+    # of its shard when the databases are sharded.
+    databases = molecules[0].tc_process_args[1]
+    scores_size = 8 * max(sum(len(database) for database in databases) // max(shard_number, 1), 1)
+    return max(1, min(config.TANIMOTO_BATCH_SIZE, config.TANIMOTO_BATCH_MEMORY // scores_size))
+
+
+def compute_scheduled_molecules(compute_batch, compute_arguments, molecules: typing.List[Molecule], scheduler: BatchScheduler
+                                , shared_progression_queue, shared_output_queue, shared_statistics, worker_id: int
+                                , shared_profiles=None, profile_origin: typing.Optional[float] = None, own_process: bool = False):
+    # Worker loop : compute the batches handed out by the scheduler with compute_batch (compute_tanimoto_batch, or
+    # ShardPool.compute_batch), one kernel call each, until there is none left
+    # Profiled worker processes hand their spans back through shared_profiles
+    # The garbage collector is only switched off in worker processes (own_process) : the collector is global to a process,
+    # and threads of the same process (threads backend, prediction server) would switch it on and off for each other
+    profiler = profiling.start_worker(profile_origin)
+    if own_process:
+        gc.disable()  # Disable automated garbage collector while computing. Great performance improve
+    compared_number = 0
+    pruned_number = 0
+    try:
+        with profiling.span("worker", worker=worker_id):
+            batch = scheduler.next_batch()
+            while batch is not None:
+                start, end = batch
+                pruned_number += compute_batch(molecules[start:end], *compute_arguments, shared_progression_queue, shared_output_queue)
+                compared_number += (end - start) * len(molecules[0].tc_process_args[1][0])
+                if own_process:
+                    gc.collect(0)  # Clean unreferenced variables manually to avoid memory overflow. The batch ones are all young
+                batch = scheduler.next_batch()
+    except BaseException:
+        # The molecules left will never be posted : end the progression and output loops, the caller reports the error
+        shared_progression_queue.put(config.WORKER_FAILED)
+        shared_output_queue.put(config.WORKER_FAILED)
+        raise
+    finally:
+        if own_process:
+            gc.enable()  # Re-enable garbage collector back, errors included.
+    shared_statistics[worker_id] = (compared_number, pruned_number)
+    if profiler is not None:
+        shared_profiles[worker_id] = profiler.stop()
@@ -1,12 +1,15 @@
 # Python 3.7 Built-in packages
+import gzip
+import json
 import threading
 import queue
 import typing
 from pathlib import Path
 
 # Local packages
-from . import config
+from . import config, profiling
 from .config import Target_Id, Database_Id, Score
+from .target_info import TargetInfoSource, info_columns
 
 
 def result_list_from_dict(
@@ -25,10 +28,19 @@ class OutputObject(object):
         self.file_name = "out/output.txt"
         self.csv_delimiter = config.DEFAULT_CSV_DELIMITER
         self.show_info = show_info
-        self.info_dict = {}
+        self.info_dict = {}  # Information rows of the targets looked up so far
+        self.target_info: typing.Optional[TargetInfoSource] = None
+        self._looked_up_targets: typing.Set[Target_Id] = set()
         self.molecules_number: int = 0
         self.output_queue: queue.Queue
         self._csv_num_row = 0
+        self._csv_info_cells: typing.Dict[Target_Id, typing.List[str]] = {}
+        self.processed_results: typing.Optional[list] = None  # When set, receives every (results, molecule name) couple written
+        self.buffer: typing.List[str] = []  # Output kept in memory (output stream 2), for the prediction server
+        self.output_format = output_format
+        self._handle: typing.Optional[typing.TextIO] = None  # Output file, opened on the first write and kept open
+        self._pending: typing.List[str] = []  # Output gathered for the next write to the output file
+        self._pending_size = 0
         self._output_thr = threading.Thread(  # Start thread of output watching
             target=self._watch_output
         )
@@ -37,10 +49,13 @@ class OutputObject(object):
         self.formatting_function = {
             config.DEFAULT_OUTPUT_FORMAT: self.human_readable_file_formatting
             , config.CSV_FILE_FORMAT: self.csv_formatting
+            , config.JSONL_FILE_FORMAT: self.jsonl_formatting
+            , config.GZIP_CSV_FILE_FORMAT: self.csv_formatting
         }[output_format]
         self.output_function = {
             0: self.stdout_basic
             , 1: self.write_string
+            , 2: self.buffer.append
         }[output_stream]
 
     def __call__(self, *args, **kwargs):
@@ -63,11 +78,21 @@ class OutputObject(object):
         else:
             return l
 
+    def look_up_info(self, l: typing.List[typing.Tuple[Target_Id, Database_Id, Score]]):
+        # Read the information of the targets output that were not looked up yet
+        if self.target_info is None:
+            return
+        target_ids = {target_id for target_id, db_id, score in l} - self._looked_up_targets
+        if len(target_ids) > 0:
+            with profiling.span("target_info_lookup", targets=len(target_ids)):
+                self.info_dict.update(self.target_info.lookup(target_ids, self.show_info))
+            self._looked_up_targets |= target_ids
+
     def stdout_basic(self, s: str):
         """
         Output the basic result string to stdout
         """
-        print(s)
+        print(s, end='' if self.output_format == config.JSONL_FILE_FORMAT else '\n')  # JSON lines : no blank line
 
     def human_readable_file_formatting(self, match_results_dict: typing.Dict[Target_Id, typing.List[typing.Tuple[Database_Id, Score]]], molecule_name: str):
         """
@@ -81,6 +106,7 @@ class OutputObject(object):
         # Build result array for sorting and iteration purpose
         match_results_list = result_list_from_dict(match_results_dict)
         l = self.slice_result_list(sorted(match_results_list, key=lambda x: x[2], reverse=True))
+        self.look_up_info(l)
         if len(l) == 0:
             s_data.append(si.format("", "No hit."))
         else:
@@ -105,8 +131,8 @@ class OutputObject(object):
         s = ""
         if self._csv_num_row == 0:  # If this is the first call
 
-            if len(self.info_dict.values()) > 0:
-                info_keys = self.info_dict.values()[0][0].keys()
+            if self.target_info is not None:
+                info_keys = info_columns(self.target_info.columns, self.show_info)
             else:
                 info_keys = ()
 
@@ -122,50 +148,100 @@ class OutputObject(object):
 
         match_results_list = result_list_from_dict(match_results_dict)
         l = self.slice_result_list(sorted(match_results_list, key=lambda x: x[2], reverse=True))
+        self.look_up_info(l)
         num_row = self._csv_num_row
 
-        with self.file.open('a', encoding=config.ENCODING) as f:
-            for target_id, db_id, score in l:
-                for info_list in self.info_dict.get(target_id, [{}]):
-                    row = []
-                    row.append(molecule_name)
-                    row.append(db_id)
-                    row.append(target_id)
-                    row.append(score)
-                    row.extend(info_list.values())
-                    while len(row) < num_row:
-                        row.append('')
-                    s += self.csv_delimiter.join([str(r) for r in row]) + '\n'
-
-        return s
+        lines = [s] if s else []
+        info_cells = self._csv_info_cells
+        for target_id, db_id, score in l:
+            if target_id not in info_cells:  # Information cells of a target, built once. If more than 1 information, duplicate the row
+                info_cells[target_id] = [
+                    "".join(self.csv_delimiter + value for value in [*info_list.values(), *[''] * (num_row - 4 - len(info_list))])
+                    for info_list in self.info_dict.get(target_id, [{}])
+                ]
+            cells = self.csv_delimiter.join((molecule_name, db_id, target_id, str(score)))
+            lines.extend(cells + target_cells + '\n' for target_cells in info_cells[target_id])
+
+        return "".join(lines)
+
+    def jsonl_formatting(self, match_results_dict: typing.Dict[Target_Id, typing.List[typing.Tuple[Database_Id, Score]]], molecule_name: str):
+        """
+        One JSON object per molecule : its hits, best first, each with the information rows of its target.
+        Molecules without hit are written too, with an empty hit list.
+        """
+        match_results_list = result_list_from_dict(match_results_dict)
+        l = self.slice_result_list(sorted(match_results_list, key=lambda x: x[2], reverse=True))
+        self.look_up_info(l)
+        return json.dumps({
+            "query_name": molecule_name
+            , "hits": [
+                {"database_molecule_id": db_id, "target_id": target_id, "score": score, "info": self.info_dict.get(target_id, [])}
+                for target_id, db_id, score in l
+            ]
+        }) + '\n'
 
     def write_string(self, s: str):
-        with self.file.open('a', encoding=config.ENCODING) as f:
-            f.write(s)
+        # Output gathered, then written by large blocks through a single handle
+        self._pending.append(s)
+        self._pending_size += len(s)
+        if self._pending_size >= config.OUTPUT_BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        if len(self._pending) == 0:
+            return
+        with profiling.span("output_write", characters=self._pending_size):
+            if self._handle is None:
+                if self.output_format == config.GZIP_CSV_FILE_FORMAT:
+                    self._handle = gzip.open(str(self.file), 'at', compresslevel=config.GZIP_COMPRESS_LEVEL, encoding=config.ENCODING)
+                else:
+                    self._handle = self.file.open('a', encoding=config.ENCODING)
+            self._handle.write("".join(self._pending))
+        self._pending = []
+        self._pending_size = 0
+
+    def close(self):  # Write what is left and close the output file
+        self.flush()
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
 
     def process_output(self, *args):
-        s = self.formatting_function(*args)
+        with profiling.span("output_format"):
+            s = self.formatting_function(*args)
         self.output_function(s)
 
     def _watch_output(self):  # Loop over the number of molecules and wait for a queue update
         i = 0
-        while i < self.molecules_number:
-            try:
-                self.process_output(*self.output_queue.get(timeout=60))
-            except queue.Empty:
-                print("\nProcesses terminates without completing jobs. Output result might not be complete.\n")
-                break
+        try:
+            while i < self.molecules_number:
+                try:
+                    with profiling.span("queue_wait"):
+                        output = self.output_queue.get(timeout=60)
+                    if output == config.WORKER_FAILED:
+                        print("\nProcesses terminates without completing jobs. Output result might not be complete.\n")
+                        break
+                    self.process_output(*output)
+                    if self.processed_results is not None:
+                        self.processed_results.append(output)
+                except queue.Empty:
+                    print("\nProcesses terminates without completing jobs. Output result might not be complete.\n")
+                    break
 
-            i += 1
+                i += 1
+        finally:
+            self.close()
 
-    def watch_output(self, shared_info, queue: queue.Queue, molecules_number: int):
+    def watch_output(self, target_info: typing.Optional[TargetInfoSource], queue: queue.Queue, molecules_number: int):
         self.molecules_number = molecules_number
         self.output_queue = queue
-        # if self.show_info:
-        #     self.info_dict = shared_info
-        self.info_dict = shared_info
+        self.target_info = target_info
         self._output_thr.start()
 
     def wait(self):
         self._output_thr.join()
 
+    @property
+    def text(self) -> str:  # Everything output in memory
+        return "".join(self.buffer)
+
@@ -0,0 +1,197 @@
+# Python 3.7 Built-in packages
+import contextlib
+import json
+import multiprocessing as mp
+import os
+import sys
+import threading
+import time
+import typing
+from pathlib import Path
+
+# Local packages
+from . import config
+
+# Optional packages. resource is only found on Unix systems : peak memory is not measured elsewhere.
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Stage-level tracing (-profile).
+#
+# Spans (with profiling.span("name"): ...) are recorded by the profiler of their process, with their thread.
+# Worker processes record their own spans (start_worker) and hand them back to the main process (stop), which
+# writes them all as a Chrome trace (chrome://tracing or ui.perfetto.dev) and prints a summary table.
+# The resident memory of each process is sampled every PROFILE_RSS_INTERVAL seconds.
+# Without a profiler, span returns a shared context that does nothing : instrumented code pays a function call.
+
+_NO_SPAN = contextlib.nullcontext()
+_profiler: typing.Optional["Profiler"] = None
+
+
+class ProcessProfile(typing.NamedTuple):  # What a worker process hands back to the main process
+    pid: int
+    name: str
+    peak_rss: int           # Bytes, 0 when unknown
+    events: typing.List[dict]
+
+
+class _Span(object):
+    __slots__ = ("profiler", "name", "args", "start")
+
+    def __init__(self, profiler: "Profiler", name: str, args: dict):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+        self.start = 0.
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.add_span(self.name, self.start, time.perf_counter(), self.args)
+        return False
+
+
+def _peak_rss() -> int:
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # Bytes on macOS, kilobytes elsewhere
+
+
+def _rss() -> int:
+    # Current resident memory (bytes). Where it can't be read (not Linux), the peak so far.
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return _peak_rss()
+
+
+class Profiler(object):
+    """
+    Spans and memory samples of one process, as Chrome trace events. Timestamps are microseconds since origin,
+    a time.time() value shared by every process of the run.
+    """
+    def __init__(self, origin: typing.Optional[float] = None):
+        self.pid = os.getpid()
+        self.name = mp.current_process().name
+        self.origin = origin if origin is not None else time.time()
+        self._offset = time.time() - time.perf_counter() - self.origin  # perf_counter value to seconds since origin
+        self.events: typing.List[dict] = [{"name": "process_name", "ph": "M", "pid": self.pid, "tid": 0, "args": {"name": self.name}}]
+        self._threads: typing.Set[int] = set()
+        self.peak_rss = 0
+        self.processes: typing.List[ProcessProfile] = []  # Profiles handed back by the worker processes
+        self._stopped = threading.Event()
+        self._sampler = threading.Thread(target=self._sample_memory, name="profile_rss", daemon=True)
+        self._sampler.start()
+
+    def _timestamp(self, perf_counter: float) -> float:
+        return (perf_counter + self._offset) * 1e6
+
+    def _thread_id(self) -> int:
+        tid = threading.get_ident()
+        if tid not in self._threads:
+            self._threads.add(tid)
+            self.events.append({"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid, "args": {"name": threading.current_thread().name}})
+        return tid
+
+    def add_span(self, name: str, start: float, end: float, args: dict):
+        self.events.append({
+            "name": name, "ph": "X", "pid": self.pid, "tid": self._thread_id()
+            , "ts": self._timestamp(start), "dur": (end - start) * 1e6, "args": args
+        })
+
+    def span(self, name: str, args: dict) -> _Span:
+        return _Span(self, name, args)
+
+    def _sample_memory(self):
+        while True:
+            rss = _rss()
+            self.peak_rss = max(self.peak_rss, rss)
+            self.events.append({
+                "name": "rss", "ph": "C", "pid": self.pid, "tid": 0, "ts": self._timestamp(time.perf_counter())
+                , "args": {"MB": round(rss / 2 ** 20, 1)}
+            })
+            if self._stopped.wait(config.PROFILE_RSS_INTERVAL):
+                break
+
+    def stop(self) -> ProcessProfile:
+        self._stopped.set()
+        self._sampler.join()
+        self.peak_rss = max(self.peak_rss, _peak_rss())
+        return ProcessProfile(self.pid, self.name, self.peak_rss, self.events)
+
+    def add_process(self, profile: ProcessProfile):
+        self.processes.append(profile)
+
+    def write(self, path: typing.Union[str, Path]):
+        # Stop, then write the Chrome trace of this process and its workers
+        profiles = [self.stop()] + self.processes
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open("w", encoding=config.ENCODING) as f:
+            json.dump({
+                "traceEvents": [event for profile in profiles for event in profile.events]
+                , "displayTimeUnit": "ms"
+                , "otherData": {"peak_rss": {str(profile.pid): profile.peak_rss for profile in profiles}}
+            }, f)
+
+    def summary(self) -> str:
+        # Table of the spans (calls, total and longest time by name) then of the peak memory of each process
+        profiles = [ProcessProfile(self.pid, self.name, self.peak_rss, self.events)] + self.processes
+        spans: typing.Dict[str, typing.List[float]] = {}
+        for profile in profiles:
+            for event in profile.events:
+                if event["ph"] == "X":
+                    spans.setdefault(event["name"], []).append(event["dur"] / 1e6)
+        lines = ["{:<28} {:>8} {:>12} {:>12} {:>12}".format("span", "calls", "total s", "mean ms", "max ms")]
+        for name, durations in sorted(spans.items(), key=lambda item: -sum(item[1])):
+            lines.append("{:<28} {:>8} {:>12.3f} {:>12.3f} {:>12.3f}".format(
+                name, len(durations), sum(durations), 1e3 * sum(durations) / len(durations), 1e3 * max(durations)
+            ))
+        lines.append("")
+        lines.append("{:<28} {:>8} {:>12}".format("process", "pid", "peak MB"))
+        for profile in profiles:
+            lines.append("{:<28} {:>8} {:>12}".format(
+                profile.name, profile.pid, "{:.1f}".format(profile.peak_rss / 2 ** 20) if profile.peak_rss > 0 else "-"
+            ))
+        return "\n".join(lines)
+
+
+def current() -> typing.Optional[Profiler]:
+    # Profiler of this process. Forked processes inherit the one of their parent : it is not theirs.
+    if _profiler is not None and _profiler.pid == os.getpid():
+        return _profiler
+    return None
+
+
+def enable(origin: typing.Optional[float] = None) -> Profiler:
+    global _profiler
+    _profiler = Profiler(origin)
+    return _profiler
+
+
+def start_worker(origin: typing.Optional[float]) -> typing.Optional[Profiler]:
+    """
+    Profile a worker of a run profiled from origin (None : not profiled). Return the profiler to stop at the end of
+    the worker, None when there is nothing to hand back : not profiled, or a thread of the profiled process.
+    """
+    if origin is None or current() is not None:
+        return None
+    return enable(origin)
+
+
+def origin() -> typing.Optional[float]:  # Given to the workers of a profiled run, None when not profiled
+    profiler = current()
+    return profiler.origin if profiler is not None else None
+
+
+def span(name: str, **args):
+    profiler = _profiler
+    if profiler is None or profiler.pid != os.getpid():
+        return _NO_SPAN
+    return profiler.span(name, args)
@@ -26,7 +26,8 @@ class ProgressionBar(object):
     def _watch_progression(self):
         while self.current_value < self.max_len:
             try:
-                self.queue.get(timeout=60)
+                if self.queue.get(timeout=60) == config.WORKER_FAILED:
+                    break
                 # print("Recieving signal")
                 self.increment()
             except queue.Empty:
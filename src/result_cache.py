@@ -0,0 +1,63 @@
+# Python 3.7 Built-in packages
+import hashlib
+import os
+import pickle
+import typing
+from pathlib import Path
+
+# Local packages
+from . import config
+from .config import Target_Id, Database_Id, Score
+from .sqlite_cache import SQLiteCache
+
+HitResults = typing.Dict[Target_Id, typing.List[typing.Tuple[Database_Id, Score]]]  # Molecule.hit_results_dict
+
+
+class ResultCache(SQLiteCache):
+    """
+    On-disk cache of the hit results of query molecules, keyed by result_key.
+    Keys hold the checksum of the database files : results of a changed database are never found again,
+    and get evicted with the least recently used ones past max_bytes.
+    """
+    def __init__(self, path: typing.Union[str, Path], max_bytes: int):
+        super().__init__(path, max_bytes=max_bytes)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS file_checksums (path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, checksum BLOB NOT NULL)"
+        )
+        self.connection.commit()
+
+    def file_checksum(self, path: typing.Union[str, Path]) -> bytes:
+        # SHA-256 of a file. It is only computed again when the size or the modification time of the file change.
+        stat = os.stat(str(path))
+        resolved = str(Path(path).resolve())
+        row = self.connection.execute("SELECT size, mtime_ns, checksum FROM file_checksums WHERE path = ?", (resolved,)).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+        file_hash = hashlib.sha256()
+        with open(str(path), "rb") as f:
+            for block in iter(lambda: f.read(config.CHECKSUM_BLOCK_SIZE), b""):
+                file_hash.update(block)
+        checksum = file_hash.digest()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO file_checksums (path, size, mtime_ns, checksum) VALUES (?, ?, ?, ?)"
+            , (resolved, stat.st_size, stat.st_mtime_ns, checksum)
+        )
+        self.connection.commit()
+        return checksum
+
+    def run_signature(self, database_files: typing.List[typing.Union[str, Path]], parameters: tuple) -> bytes:
+        # Everything the results of a run depend on besides the query fingerprints
+        run_hash = hashlib.sha256(repr((config.RESULT_CACHE_VERSION, parameters)).encode(config.ENCODING))
+        for database_file in database_files:
+            run_hash.update(self.file_checksum(database_file))
+        return run_hash.digest()
+
+    def get_results(self, keys: typing.List[bytes]) -> typing.Dict[bytes, HitResults]:
+        return {key: pickle.loads(value) for key, value in self.get_many(keys).items()}
+
+    def put_results(self, items: typing.List[typing.Tuple[bytes, HitResults]]):
+        self.put_many([(key, pickle.dumps(results, protocol=4)) for key, results in items])
+
+
+def result_key(run_signature: bytes, query_fingerprints: bytes) -> bytes:
+    return hashlib.sha256(run_signature + query_fingerprints).digest()
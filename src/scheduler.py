@@ -0,0 +1,59 @@
+# Python 3.7 Built-in packages
+import multiprocessing as mp
+import threading
+import typing
+
+# Local packages
+from .database import fingerprint_popcount
+from .molecule import Molecule
+
+
+def estimated_cost(molecule: Molecule) -> int:
+    """
+    Number of database compounds the kernel compares to a molecule. Databases sorted by popcount are only scanned
+    over the popcount range able to reach the tc threshold, when the kernel prunes (one fingerprint, no consensus).
+    """
+    row, databases, tc_threshold_list, zscore_threshold, consensus = molecule.tc_process_args[:5]
+    fingerprint_number = molecule.query_fingerprints.fingerprint_numbers[row]
+    if fingerprint_number == 0:
+        return 0
+    database = databases[0]
+    if len(databases) == 1 and not consensus and len(tc_threshold_list) > 0 and tc_threshold_list[0] > 0 and database.is_sorted:
+        start, end = database.popcount_range(fingerprint_popcount(molecule.query_fingerprints.fingerprint(row, 0)), tc_threshold_list[0])
+        return end - start
+    return sum(len(database) for database in databases[:fingerprint_number])
+
+
+class _LocalCounter(object):  # Same interface as multiprocessing.Value, for the threads backend
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def get_lock(self) -> threading.Lock:
+        return self._lock
+
+
+class BatchScheduler(object):
+    """
+    Hand out consecutive ranges of a list of molecules to the workers as they ask for them (guided self-scheduling).
+    A batch is the remaining molecules shared by twice the number of workers, within [1, max_batch_size] :
+    big batches (one kernel call each) while there is much work left, single molecules at the end, so every worker
+    finishes at about the same time. Molecules should be ordered by decreasing cost (see estimated_cost).
+    With shared set, the position lives in shared memory and the scheduler is handed to worker processes.
+    """
+    def __init__(self, molecule_number: int, worker_number: int, max_batch_size: int, shared: bool):
+        self.molecule_number = molecule_number
+        self.worker_number = max(1, worker_number)
+        self.max_batch_size = max(1, max_batch_size)
+        self._next = mp.Value('q', 0) if shared else _LocalCounter()  # First molecule not handed out yet
+
+    def next_batch(self) -> typing.Optional[typing.Tuple[int, int]]:
+        # (start, end) of the next batch, None when every molecule has been handed out
+        with self._next.get_lock():
+            start = self._next.value
+            remaining = self.molecule_number - start
+            if remaining <= 0:
+                return None
+            end = start + max(1, min(self.max_batch_size, remaining // (2 * self.worker_number)))
+            self._next.value = end
+        return start, end
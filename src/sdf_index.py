@@ -0,0 +1,102 @@
+# Python 3.7 Built-in packages
+import array
+import mmap
+import typing
+from pathlib import Path
+
+# Local packages
+from . import config
+from . import texts
+
+SD_MOL_END = b"\n$$$$"                  # End of a molecule block, followed by a line feed (or CRLF) or the end of the file
+
+
+class SDFIndex(object):
+    """
+    Byte offsets and names of the molecules of one or several SD files, built in a single pass over each memory mapped file.
+    Molecule i is the block files[file_ids[i]][starts[i]:ends[i]], without its "$$$$" line. Molecules keep the input order.
+    Downstream stages read or copy molecule ranges from the files instead of a merged copy.
+    """
+    def __init__(self, files: typing.List[Path]):
+        self.files: typing.List[Path] = files
+        self.file_ids = array.array('i')
+        self.starts = array.array('q')
+        self.ends = array.array('q')
+        self.names: typing.List[str] = []
+        self.errors: typing.List[str] = []
+        self._mmaps: typing.List[typing.Optional[mmap.mmap]] = []
+
+        names = set()
+        for file_id, file in enumerate(files):
+            with file.open("rb") as f:
+                # Empty files can't be mapped
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if file.stat().st_size > 0 else None
+            self._mmaps.append(data)
+            for i, (start, end) in enumerate(_molecule_ranges(data) if data is not None else ()):
+                name_end = data.find(b"\n", start, end)
+                name = data[start:name_end if name_end >= 0 else end].rstrip(b"\r").decode(config.ENCODING)
+                if name == "" and data[start:end].strip() == b"":
+                    continue  # Blank lines, after the last molecule for instance
+                if name == "":
+                    self.errors.append(texts.sdf_no_mol_name_error.format(file, i + 1))
+                elif name in names:
+                    self.errors.append(texts.sdf_mol_name_duplicate_error.format(file, name))
+                names.add(name)
+                self.file_ids.append(file_id)
+                self.starts.append(start)
+                self.ends.append(end)
+                self.names.append(name)
+
+    def __len__(self):
+        return len(self.names)
+
+    def block_bytes(self, i: int) -> bytes:
+        return self._mmaps[self.file_ids[i]][self.starts[i]:self.ends[i]]
+
+    def block(self, i: int) -> str:  # Text of molecule i, line feeds only
+        return self.block_bytes(i).decode(config.ENCODING).replace("\r\n", "\n")
+
+    def write(self, sdf: Path, molecules: typing.Iterable[int]):
+        # Write the given molecules into a new SD file, in the given order
+        sdf.parent.mkdir(parents=True, exist_ok=True)
+        with sdf.open("wb") as f:
+            for i in molecules:
+                f.write(self.block_bytes(i))
+                f.write(config.SD_MOL_DELIMITER.encode(config.ENCODING))
+
+    def shards(self, molecules: typing.List[int], shard_number: int, directory: Path, stem: str) -> typing.List[Path]:
+        """
+        Split the given molecules into at most shard_number SD files of consecutive molecules, named <stem>_<n>.sdf.
+        When every molecule of a single input file is asked in one shard, the input file itself is returned.
+        """
+        if len(molecules) == 0:
+            return []
+        if len(self.files) == 1 and shard_number <= 1 and molecules == list(range(len(self))):
+            return [self.files[0]]
+        shard_size = -(-len(molecules) // max(shard_number, 1))  # Rounded up
+        shards = []
+        for i in range(0, len(molecules), shard_size):
+            shard = Path(directory, "{}_{}.sdf".format(stem, len(shards)))
+            self.write(shard, molecules[i:i + shard_size])
+            shards.append(shard)
+        return shards
+
+    def close(self):
+        for data in self._mmaps:
+            if data is not None:
+                data.close()
+
+
+def _molecule_ranges(data: mmap.mmap) -> typing.Iterator[typing.Tuple[int, int]]:
+    # (start, end) of each molecule block of a mapped SD file
+    size = len(data)
+    start = 0
+    while start < size:
+        end = data.find(SD_MOL_END, start)
+        while end >= 0 and end + len(SD_MOL_END) < size and data[end + len(SD_MOL_END):end + len(SD_MOL_END) + 1] not in (b"\n", b"\r"):
+            end = data.find(SD_MOL_END, end + 1)  # "$$$$" followed by other characters is not a delimiter
+        yield start, end if end >= 0 else size
+        if end < 0:
+            break
+        start = data.find(b"\n", end + len(SD_MOL_END))
+        start = start + 1 if start >= 0 else size
@@ -0,0 +1,278 @@
+# Python 3.7 Built-in packages
+import argparse
+import http.client
+import json
+import os
+import signal
+import socket
+import socketserver
+import tempfile
+import threading
+import traceback
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from time import time
+
+# Local packages
+from . import config
+from . import texts
+from .arg_parsing import parse_arguments, ArgumentsError, NUM_CORE, BACKEND, OUTPUT, OUTPUT_FORMAT, FINGERPRINT, NO_FINGERPRINT_CACHE
+from .database_store import DatabaseStore
+from .fingerprint_providers import Fingerprints
+from .fingerprints import FingerprintList
+from .molecules import MoleculeList
+from .output import OutputObject
+
+
+class RequestError(Exception):  # Invalid request, reported to the client
+    pass
+
+
+class PredictionServer(object):
+    """
+    Answer prediction requests with the databases kept in memory and a warm pool of tanimoto threads.
+
+    A request is a JSON object with :
+        args            FastTargetPred arguments, without the SD files (["-fp", "ECFP4", "MACCS", "-nbt", "10"] for instance)
+        sdf             text of a SD file of query molecules
+        fingerprints    or query fingerprints computed beforehand : molecule name -> fingerprint name -> hexadecimal string,
+                        the fingerprint format of the .fpf files. Molecules keep the order of the object.
+    The answer is what FastTargetPred writes in its output file, in the -f format.
+    Every request runs on the threads backend of this server : -cpu, -backend and -o are not used.
+    """
+    def __init__(self, cpu: int):
+        self.cpu = max(1, cpu)
+        self.database_store = DatabaseStore()
+        self.executor = ThreadPoolExecutor(max_workers=self.cpu, thread_name_prefix="tanimoto_thread")
+        self.default_db = config.DEFAULT_DB   # Database of the requests without -db
+        self.request_number = 0
+        self._lock = threading.Lock()
+        Path(config.DEFAULT_SERVER_TEMP_FOLDER).mkdir(parents=True, exist_ok=True)
+
+    def load(self, db_paths: typing.List[str], fp_names: typing.List[str]) -> int:
+        # Read the given databases, with their lookup table, and the target information. Return the number of files read.
+        file_number = 0
+        self.default_db = db_paths[0]
+        for db_path in db_paths:
+            db_path = str(Path(db_path))  # Same key as UserArguments.db_path
+            for fp_name in fp_names:
+                if Path("{}_{}.bfp".format(db_path, fp_name)).is_file():
+                    self.database_store.database(db_path, fp_name)
+                    file_number += 1
+            self.database_store.target_table(db_path)
+            file_number += 1
+        target_info = self.database_store.target_info()
+        if target_info is None:
+            return file_number
+        target_info.load()
+        return file_number + 1
+
+    def predict(self, request: dict) -> str:
+        sdf_text, fingerprints = request.get("sdf"), request.get("fingerprints")
+        if (sdf_text is None) == (fingerprints is None):
+            raise RequestError(texts.server_query_error)
+        with self._lock:
+            self.request_number += 1
+
+        if fingerprints is not None:
+            return self._predict(Path(config.SERVER_QUERY_NAME), False, fingerprints, request.get("args", []))
+
+        # Each SD file request has its own file name : Maya output files are named after it
+        fd, sdf_name = tempfile.mkstemp(prefix="query_", suffix=".sdf", dir=config.DEFAULT_SERVER_TEMP_FOLDER)
+        os.close(fd)
+        sdf = Path(sdf_name)
+        try:
+            sdf.write_text(sdf_text, encoding=config.ENCODING)
+            return self._predict(sdf, True, None, request.get("args", []))
+        finally:
+            sdf.unlink()
+            for fpf in Path("out").glob("{}_*.fpf".format(sdf.stem)):
+                fpf.unlink()
+
+    def _predict(self, sdf: Path, sdf_input: bool, fingerprints: typing.Optional[dict], arguments: typing.List[str]) -> str:
+        try:
+            user_args = parse_arguments([str(sdf), "-db", self.default_db, *[str(argument) for argument in arguments]])
+        except ArgumentsError as e:
+            raise RequestError(texts.server_request_error.format(e))
+        user_args.dict[NUM_CORE] = self.cpu
+        user_args.dict[BACKEND] = config.THREADS_BACKEND
+        user_args.dict[OUTPUT] = config.DEFAULT_OUTPUT
+        user_args.dict[NO_FINGERPRINT_CACHE] |= not sdf_input
+        if not user_args.are_ok(sdf_input):
+            raise RequestError(user_args.errormsg)
+        user_args.output_function = OutputObject(2, user_args.dict[OUTPUT_FORMAT], user_args.max_target_number, user_args.show_info)
+
+        fps = FingerprintList(user_args, sdf, self.database_store)
+        fps.create_fingerprints()
+        try:
+            if sdf_input:
+                query_dicts = fps.generate_molecule_files()
+            else:
+                query_dicts = fps.use_fingerprints(request_fingerprints(fingerprints, user_args.dict[FINGERPRINT]))
+        finally:
+            if user_args.sdf_index is not None:
+                user_args.sdf_index.close()
+            if fps.fingerprint_cache is not None:
+                fps.fingerprint_cache.close()
+
+        molecules = MoleculeList.create_list(user_args, query_dicts, fps)
+        molecules.executor = self.executor
+        molecules.compute_fingerprints()
+        return user_args.output_function.text
+
+    def status(self) -> dict:
+        return {
+            "requests": self.request_number
+            , "loaded": [list(key) for key in self.database_store.loaded]
+        }
+
+    def serve(self, port: int = config.DEFAULT_SERVER_PORT, socket_path: typing.Optional[str] = None):
+        # Serve requests until interrupted, one thread per connection
+        if socket_path is not None:
+            if Path(socket_path).exists():
+                Path(socket_path).unlink()
+            http_server = _UnixHTTPServer(socket_path, _PredictionRequestHandler)
+            address = socket_path
+        else:
+            http_server = ThreadingHTTPServer((config.DEFAULT_SERVER_HOST, port), _PredictionRequestHandler)
+            address = "http://{}:{}".format(config.DEFAULT_SERVER_HOST, http_server.server_address[1])
+        http_server.daemon_threads = True
+        http_server.prediction_server = self
+        signal.signal(signal.SIGTERM, _interrupt)  # Stop on kill as on Ctrl+C, cleaning up
+        print(texts.server_listening.format(address), flush=True)
+        try:
+            http_server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            http_server.server_close()
+            if socket_path is not None and Path(socket_path).exists():
+                Path(socket_path).unlink()
+            self.executor.shutdown()
+            print(texts.server_stopped)
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def request_fingerprints(fingerprints: dict, fp_names: typing.List[str]) -> typing.List[Fingerprints]:
+    # Fingerprints of a request, one Fingerprints per fingerprint name
+    try:
+        return [
+            {str(name): bytes.fromhex(molecule_fps[fp_name]) for name, molecule_fps in fingerprints.items() if fp_name in molecule_fps}
+            for fp_name in fp_names
+        ]
+    except (AttributeError, TypeError, ValueError) as e:
+        raise RequestError(texts.server_request_error.format(e))
+
+
+if hasattr(socketserver, "UnixStreamServer"):  # Not on Windows
+    class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        pass
+
+
+class _PredictionRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != config.SERVER_PREDICT_PATH:
+            self._respond(404, texts.server_path_error.format(self.path))
+            return
+        try:
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode(config.ENCODING))
+            except ValueError as e:
+                raise RequestError(texts.server_request_error.format(e))
+            if not isinstance(request, dict) or not isinstance(request.get("args", []), list):
+                raise RequestError(texts.server_request_error.format("JSON object expected, with a list of arguments"))
+            self._respond(200, self.server.prediction_server.predict(request))
+        except RequestError as e:
+            self._respond(400, str(e))
+        except Exception:
+            self._respond(500, traceback.format_exc())
+
+    def do_GET(self):
+        if self.path != config.SERVER_STATUS_PATH:
+            self._respond(404, texts.server_path_error.format(self.path))
+            return
+        self._respond(200, json.dumps(self.server.prediction_server.status()), "application/json")
+
+    def _respond(self, status: int, text: str, content_type: str = "text/plain"):
+        body = text.encode(config.ENCODING)
+        self.send_response(status)
+        self.send_header("Content-Type", "{}; charset={}".format(content_type, config.ENCODING))
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self) -> str:
+        # Unix socket clients have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: float):
+        super().__init__(config.DEFAULT_SERVER_HOST, timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def request_prediction(
+        arguments: typing.List[str], sdf: typing.Optional[str] = None, fingerprints: typing.Optional[dict] = None
+        , port: int = config.DEFAULT_SERVER_PORT, socket_path: typing.Optional[str] = None, timeout: float = 600.
+) -> str:
+    """
+    Client side : send a prediction request to a running server and return its answer.
+    Raise RequestError when the server refuses the request or fails.
+    """
+    if socket_path is not None:
+        connection = _UnixHTTPConnection(socket_path, timeout)
+    else:
+        connection = http.client.HTTPConnection(config.DEFAULT_SERVER_HOST, port, timeout=timeout)
+    request = {"args": arguments}
+    if sdf is not None:
+        request["sdf"] = sdf
+    if fingerprints is not None:
+        request["fingerprints"] = fingerprints
+    try:
+        connection.request(
+            "POST", config.SERVER_PREDICT_PATH, json.dumps(request).encode(config.ENCODING), {"Content-Type": "application/json"}
+        )
+        response = connection.getresponse()
+        text = response.read().decode(config.ENCODING)
+    finally:
+        connection.close()
+    if response.status != 200:
+        raise RequestError(text)
+    return text
+
+
+def _get_argparse_setup() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=texts.server_abstract, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-db', dest='db', type=str, nargs='+', default=[config.DEFAULT_DB]
+                        , help=texts.help_server_db)
+    parser.add_argument('-fp', dest='fp', type=str, nargs='+', default=list(config.FP_AVAILABLE)
+                        , help=texts.help_server_fp)
+    parser.add_argument('-cpu', dest='cpu', type=int, default=config.DEFAULT_NUM_CORE
+                        , help=texts.help_server_cpu)
+    parser.add_argument('-port', dest='port', type=int, default=config.DEFAULT_SERVER_PORT
+                        , help=texts.help_server_port.format(config.DEFAULT_SERVER_PORT))
+    parser.add_argument('-socket', dest='socket', type=str, default=None
+                        , help=texts.help_server_socket)
+    return parser
+
+
+def start():
+    ns = _get_argparse_setup().parse_args()
+    server = PredictionServer(ns.cpu)
+    print(texts.server_loading, end='', flush=True)
+    t0 = time()
+    file_number = server.load(ns.db, [fp.upper() for fp in ns.fp])
+    print(texts.checked)
+    print(texts.server_loaded.format(file_number, time() - t0))
+    server.serve(ns.port, ns.socket)
@@ -0,0 +1,184 @@
+# Python 3.7 Built-in packages
+import array
+import heapq
+import math
+import multiprocessing as mp
+import typing
+
+# Local packages
+from . import profiling
+from .database import FingerprintDatabase, kernel_arguments
+from .molecule import HitArrays, Molecule, tc_process_shard
+from .profiling import ProcessProfile
+from .target_table import TargetTable
+
+# Sharded Tanimoto calculation (-shards).
+#
+# Every database is split into consecutive slices of compounds, the shards, each one scanned by its own worker process.
+# For each query, a shard worker sends back the sufficient statistics of its compounds (their number, the sum and the sum
+# of squares of their coefficients, for each fingerprint) and its candidate hits : the compounds passing the tc threshold,
+# with their coefficients. The coordinator sums the statistics of every shard into the mean and standard deviation of
+# the whole databases, then applies the z-score threshold and the top_k selection, exactly like tc_process_arrays.
+# Requests and results are plain bytes and tuples sent over a multiprocessing connection : the local processes stand in
+# for workers on other hosts. Every worker is handed the whole (memory mapped) databases. It scans its own shard only,
+# but in consensus, when databases list their compounds in different orders (index map), the candidates of the shard of
+# the first database are looked up and scored in the other databases wherever they are, outside of the shard included.
+# Such a worker then reads pages of the whole database files, and a remote one would need all of them.
+
+
+class ShardHits(typing.NamedTuple):  # Results of one query on one shard as returned by tc_process_shard
+    indices: memoryview     # Index of each candidate hit in the first database
+    tcs: memoryview         # Tanimoto coefficients, one per fingerprint for each candidate hit
+    statistics: memoryview  # Compounds of the shard, sum and sum of squares of their coefficients, for each fingerprint
+    pruned_number: int      # Compounds of the shard skipped by the popcount bounds (databases sorted by popcount)
+
+    @classmethod
+    def from_kernel(cls, results: typing.Tuple[bytes, bytes, bytes, int]) -> "ShardHits":
+        indices, tcs, statistics, pruned_number = results
+        return cls(memoryview(indices).cast('i'), memoryview(tcs).cast('d'), memoryview(statistics).cast('d'), pruned_number)
+
+
+def _divide(a: float, b: float) -> float:  # a / b as computed by the kernel (IEEE 754) : no error on a zero divisor
+    if b != 0:
+        return a / b
+    if a == 0 or math.isnan(a):
+        return math.nan
+    return math.copysign(math.inf, a) * math.copysign(1., b)
+
+
+def score_statistics(shard_hits: typing.List[ShardHits], fingerprint_number: int) -> typing.Tuple[typing.List[float], typing.List[float]]:
+    """
+    Mean and sample standard deviation of the coefficients of a query in each database, from the statistics of every
+    shard. Same formula as compute_score_statistics of the kernel.
+    """
+    means, stdevs = [], []
+    for f in range(fingerprint_number):
+        count = sum(hits.statistics[3 * f] for hits in shard_hits)
+        tc_sum = sum(hits.statistics[3 * f + 1] for hits in shard_hits)
+        squared_tc_sum = sum(hits.statistics[3 * f + 2] for hits in shard_hits)
+        variance = _divide(squared_tc_sum, count - 1.) - _divide(tc_sum ** 2., (count - 1.) * count)
+        means.append(_divide(tc_sum, count))
+        stdevs.append(math.sqrt(variance) if variance >= 0 else math.nan)
+    return means, stdevs
+
+
+def merge_shard_hits(shard_hits: typing.List[ShardHits], fingerprint_number: int, zscore_threshold: float, normalize: bool
+                     , top_k: int) -> HitArrays:
+    """
+    Hits of a query from its results on every shard, in shard order : the same hits, coefficients and zscores as
+    tc_process_arrays on the whole databases (up to the rounding of the sums of the statistics).
+    """
+    pruned_number = sum(hits.pruned_number for hits in shard_hits)
+    rows: typing.List[typing.Tuple[float, int, typing.List[float], typing.List[float]]] = []  # (score, index, tcs, zscores)
+    if fingerprint_number > 0:
+        means, stdevs = score_statistics(shard_hits, fingerprint_number) if normalize else ([], [])
+        for hits in shard_hits:
+            for h, index in enumerate(hits.indices):
+                tcs = list(hits.tcs[h * fingerprint_number:(h + 1) * fingerprint_number])
+                if not normalize:
+                    rows.append((tcs[-1], index, tcs, []))
+                    continue
+                zscores = [_divide(tc - mean, stdev) for tc, mean, stdev in zip(tcs, means, stdevs)]
+                zscore_sum = 0.
+                for zscore in zscores:
+                    zscore_sum += zscore
+                zscores.append(zscore_sum / fingerprint_number)
+                if zscore_threshold != 0 and zscores[-1] <= zscore_threshold:
+                    continue
+                rows.append((zscores[-1], index, tcs, zscores))
+    if top_k > 0 and len(rows) > top_k:
+        # Best scores first, then earlier in the database, like the kernel ranks them
+        rows = sorted(heapq.nsmallest(top_k, rows, key=lambda row: (-row[0], row[1])), key=lambda row: row[1])
+
+    indices = array.array('i', (row[1] for row in rows))
+    tcs = array.array('d', (tc for row in rows for tc in row[2]))
+    zscores = array.array('d', (zscore for row in rows for zscore in row[3]))
+    return HitArrays(memoryview(indices), memoryview(tcs), memoryview(zscores), pruned_number)
+
+
+def serve_shard(connection, databases: typing.List[FingerprintDatabase], shard_index: int, shard_number: int
+                , profile_origin: typing.Optional[float] = None):
+    # Shard worker loop : compare each block of queries received to the shard and send back the results, until None.
+    # Errors are sent back instead of results. The profile of the worker (None if not profiled) is the last message.
+    profiler = profiling.start_worker(profile_origin)
+    database_arguments = kernel_arguments(databases)
+    request = connection.recv()
+    while request is not None:
+        query_arguments, tc_threshold_list, normalize, top_k = request
+        try:
+            with profiling.span("tc_process_shard", shard=shard_index):
+                results = tc_process_shard(*query_arguments, database_arguments, tc_threshold_list, normalize, top_k, shard_index, shard_number)
+        except Exception as e:
+            results = e
+        connection.send(results)
+        request = connection.recv()
+    connection.send(profiler.stop() if profiler is not None else None)
+    connection.close()
+
+
+class ShardPool(object):
+    """
+    Worker processes each comparing the query blocks to one shard of the databases, and the coordinator merging their
+    results into the hits of each query (see merge_shard_hits).
+    """
+    def __init__(self, databases: typing.List[FingerprintDatabase], shard_number: int):
+        self.shard_number = shard_number
+        self.connections = []
+        self.processes: typing.List[mp.Process] = []
+        for shard_index in range(shard_number):
+            connection, worker_connection = mp.Pipe()
+            process = mp.Process(
+                target=serve_shard
+                , args=(worker_connection, databases, shard_index, shard_number, profiling.origin())
+                , name="shard_process_{}".format(shard_index)
+                , daemon=True
+            )
+            process.start()
+            worker_connection.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+
+    def compare(self, query_arguments: tuple, tc_threshold_list: typing.List[float], normalize: bool, top_k: int) -> typing.List[list]:
+        # Send a block of queries (see QueryFingerprints.block_arguments) to every shard. Return the results of each shard.
+        for connection in self.connections:
+            connection.send((query_arguments, tc_threshold_list, normalize, top_k))
+        results = [connection.recv() for connection in self.connections]
+        for shard_results in results:
+            if isinstance(shard_results, Exception):
+                raise shard_results
+        return results
+
+    def compute_batch(self, molecules: typing.List[Molecule], target_table: TargetTable, shared_progression_queue, output_queue) -> int:
+        """
+        Same as compute_tanimoto_batch, with the databases scanned by the shard workers.
+        Return the number of database compounds pruned for the block.
+        """
+        query_row, databases, tc_threshold_list, zscore_threshold, normalize, top_k = molecules[0].tc_process_args
+        query_fingerprints = molecules[0].query_fingerprints
+        with profiling.span("tc_process", molecules=len(molecules), shards=self.shard_number):
+            results = self.compare(
+                query_fingerprints.block_arguments([molecule.query_row for molecule in molecules]), tc_threshold_list, normalize, top_k
+            )
+        pruned_number = 0
+        for m, molecule in enumerate(molecules):
+            with profiling.span("shard_merge"):
+                hit_arrays = merge_shard_hits(
+                    [ShardHits.from_kernel(shard_results[m]) for shard_results in results]
+                    , query_fingerprints.fingerprint_numbers[molecule.query_row], zscore_threshold, normalize, top_k
+                )
+            pruned_number += hit_arrays.pruned_number
+            molecule.process_results(hit_arrays, databases[0], target_table, shared_progression_queue, output_queue)
+        return pruned_number
+
+    def close(self) -> typing.List[ProcessProfile]:
+        # Stop the shard workers. Return their profiles (-profile).
+        profiles = []
+        for connection in self.connections:
+            connection.send(None)
+        for connection, process in zip(self.connections, self.processes):
+            profile = connection.recv()
+            if profile is not None:
+                profiles.append(profile)
+            connection.close()
+            process.join()
+        return profiles
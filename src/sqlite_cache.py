@@ -0,0 +1,80 @@
+# Python 3.7 Built-in packages
+import sqlite3
+import time
+import typing
+from pathlib import Path
+
+# Local packages
+from . import config
+
+
+class SQLiteCache(object):
+    """
+    On-disk key-value cache (SQLite) with least recently used eviction.
+    Entries are evicted past max_entries entries or max_bytes bytes of values, whichever comes first (None : no bound).
+    A cache must be used from the thread that opened it.
+    """
+    def __init__(self, path: typing.Union[str, Path], max_entries: typing.Optional[int] = None, max_bytes: typing.Optional[int] = None):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(path))
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key BLOB PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        self.connection.commit()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def hit_rate(self) -> float:  # Percentage
+        return 100 * self.hits / max(self.hits + self.misses, 1)
+
+    def get_many(self, keys: typing.List[bytes]) -> typing.Dict[bytes, bytes]:
+        # Cached value of each key found. Found keys become the most recently used ones.
+        found = {}
+        for i in range(0, len(keys), config.CACHE_QUERY_SIZE):
+            chunk = keys[i:i + config.CACHE_QUERY_SIZE]
+            found.update(self.connection.execute(
+                "SELECT key, value FROM entries WHERE key IN ({})".format(",".join("?" * len(chunk)))
+                , chunk
+            ).fetchall())
+        now = time.time()
+        self.connection.executemany("UPDATE entries SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+        self.connection.commit()
+        self.hits += len(found)
+        self.misses += len(set(keys)) - len(found)
+        return found
+
+    def put_many(self, items: typing.List[typing.Tuple[bytes, bytes]]):
+        # Store (key, value) couples, then evict the least recently used entries past the bounds
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO entries (key, value, size, last_used) VALUES (?, ?, ?, ?)"
+            , [(key, value, len(value), now) for key, value in items]
+        )
+        self._evict()
+        self.connection.commit()
+
+    def _evict(self):
+        entry_number, byte_number = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        excess_entries = entry_number - self.max_entries if self.max_entries is not None else 0
+        excess_bytes = byte_number - self.max_bytes if self.max_bytes is not None else 0
+        if excess_entries <= 0 and excess_bytes <= 0:
+            return
+        evicted = []
+        cursor = self.connection.execute("SELECT key, size FROM entries ORDER BY last_used")
+        for key, size in cursor:
+            if excess_entries <= 0 and excess_bytes <= 0:
+                break
+            evicted.append((key,))
+            excess_entries -= 1
+            excess_bytes -= size
+        cursor.close()
+        self.connection.executemany("DELETE FROM entries WHERE key = ?", evicted)
+        self.evictions += len(evicted)
+
+    def close(self):
+        self.connection.close()
@@ -4,15 +4,90 @@
 #include <stdlib.h>
 #include <string.h>
 #include <math.h>
+#include <stdint.h>
 #include "tanimoto_processing.h"
 
+// Compiler and CPU specific popcount support. Kernels are compiled for their own target and selected at runtime.
+#if defined(__x86_64__) || defined(_M_X64)
+	#if defined(__GNUC__) || defined(__clang__)
+		#include <immintrin.h>
+		#define HAVE_HW_POPCOUNT 1
+		#define HAVE_AVX2 1
+		#define TARGET_POPCNT __attribute__((target("popcnt")))
+		#define TARGET_AVX2 __attribute__((target("avx2")))
+		#define POPCOUNT64(x) __builtin_popcountll(x)
+		#define cpu_has_popcnt() __builtin_cpu_supports("popcnt")
+		#define cpu_has_avx2() __builtin_cpu_supports("avx2")
+	#elif defined(_MSC_VER)
+		#include <intrin.h>
+		#include <immintrin.h>
+		#define HAVE_HW_POPCOUNT 1
+		#define HAVE_AVX2 1
+		#define TARGET_POPCNT
+		#define TARGET_AVX2
+		#define POPCOUNT64(x) __popcnt64(x)
+		#define cpu_has_popcnt() msvc_cpu_has_popcnt()
+		#define cpu_has_avx2() msvc_cpu_has_avx2()
+	#endif
+#elif defined(__aarch64__) && (defined(__GNUC__) || defined(__clang__))
+	// Always available on arm64, compiled to cnt
+	#define HAVE_HW_POPCOUNT 1
+	#define TARGET_POPCNT
+	#define POPCOUNT64(x) __builtin_popcountll(x)
+	#define cpu_has_popcnt() 1
+#endif
+#ifndef HAVE_HW_POPCOUNT
+	#define HAVE_HW_POPCOUNT 0
+	#define cpu_has_popcnt() 0
+#endif
+#ifndef HAVE_AVX2
+	#define HAVE_AVX2 0
+	#define cpu_has_avx2() 0
+#endif
+
+#if defined(_MSC_VER) && HAVE_AVX2
+int msvc_cpu_has_popcnt(void) {
+	int info[4];
+	__cpuid(info, 1);
+	return (info[2] >> 23) & 1;
+}
+
+int msvc_cpu_has_avx2(void) {
+	int info[4];
+	__cpuid(info, 1);
+	// The OS must save the ymm registers (OSXSAVE + XCR0 bits 1 and 2)
+	if (!((info[2] >> 27) & 1) || (_xgetbv(0) & 6) != 6) {
+		return 0;
+	}
+	__cpuidex(info, 7, 0);
+	return (info[1] >> 5) & 1;
+}
+#endif
+
 //define the size of the int containing the fingerprint length
 #define FP_LENGTH_SIZE	4
+//define the size of the database compound ID offsets
+#define ID_OFFSET_SIZE	4
+//define the size of the database precomputed popcounts
+#define POPCOUNT_SIZE	2
+//define the size of the compound indices (index maps and returned hit indices)
+#define INDEX_SIZE	4
+//define the size of the popcount bucket offsets of sorted databases
+#define BUCKET_OFFSET_SIZE	4
+//define the largest fingerprint stride (bytes) accepted from a database
+#define MAX_FP_BYTES	1024
+//define the size of the database tiles kept in cache while a block of queries is compared to them
+#define TILE_BYTES	(256 * 1024)
 
 // Declaring python link stuff
 static PyObject *TanimotoProcessingError;
 static PyMethodDef TanimotoProcessingMethods[] = {
     {"tc_process",  tc_process, METH_VARARGS, "Process binary Fingerprints with db."}
+    , {"tc_process_batch",  tc_process_batch, METH_VARARGS, "Process binary Fingerprints of a block of molecules with db."}
+    , {"tc_process_arrays",  tc_process_arrays, METH_VARARGS, "Process in-memory Fingerprints of a block of molecules with db, hits returned as arrays."}
+    , {"tc_process_shard",  tc_process_shard, METH_VARARGS, "Process in-memory Fingerprints of a block of molecules with one shard of db, for an exact merge of the shards."}
+    , {"popcount_self_test",  popcount_self_test, METH_NOARGS, "Check every popcount kernel supported by the CPU against the lookup table."}
+    , {"popcount_kernel",  popcount_kernel_name, METH_VARARGS, "Get (or set) the popcount kernel in use."}
     , {NULL, NULL, 0, NULL}        /* Sentinel */
 };
 static struct PyModuleDef tanimoto_processing__module = {
@@ -31,6 +106,11 @@ PyObject* PyInit_tanimoto_processing(void) {
     if (m == NULL)
         return NULL;
 
+    if (select_popcount_kernel() < 0) { // RuntimeWarning turned into an error
+        Py_DECREF(m);
+        return NULL;
+    }
+
     TanimotoProcessingError = PyErr_NewException("tanimoto_processing.error", NULL, NULL);
     Py_XINCREF(TanimotoProcessingError);
     if (PyModule_AddObject(m, "error", TanimotoProcessingError) < 0) {
@@ -67,450 +147,1481 @@ int popcount(unsigned int x) {
 );
 }
 
-// Delete keys present in the list from dictionnary if exists
-void delete_keys_from_dict(PyObject* dict, PyObject* keylist) {
-	Py_ssize_t t = 0; // increment var
-	Py_ssize_t l = PyList_Size(keylist);
-	PyObject* current_key;
-	while (t<l) {
-		current_key = PyList_GetItem(keylist, t);
-		if (PyDict_Contains(dict, current_key)) {			
-			PyDict_DelItem(
-				dict
-				, current_key
-			);
+// Popcount kernels.
+// Each kernel counts the bits set in a buffer (popcount_buffer) or in the AND of two buffers (popcount_and_buffer).
+// Buffers are read 64 bits (or 256 bits) at a time, remaining bytes go through the lookup table.
+// The fastest kernel supported by the CPU is selected when the module is imported, once it passed the self test.
+
+// Portable fallback : byte by byte lookup table
+uint32_t popcount_table(const unsigned char* a, Py_ssize_t n) {
+	uint32_t count = 0;
+	Py_ssize_t k;
+	for (k=0; k<n; k++) {
+		count += popcount(a[k]);
+	}
+	return count;
+}
+
+uint32_t popcount_and_table(const unsigned char* a, const unsigned char* b, Py_ssize_t n) {
+	uint32_t count = 0;
+	Py_ssize_t k;
+	for (k=0; k<n; k++) {
+		count += popcount(a[k] & b[k]);
+	}
+	return count;
+}
+
+// Unaligned 64 bits load. Compilers turn it into a single mov.
+static inline uint64_t load_u64(const unsigned char* p) {
+	uint64_t w;
+	memcpy(&w, p, sizeof(w));
+	return w;
+}
+
+// Portable 64 bits kernel : bit twiddling popcount, no hardware instruction needed
+static inline uint32_t swar_popcount64(uint64_t x) {
+	x = x - ((x >> 1) & 0x5555555555555555ULL);
+	x = (x & 0x3333333333333333ULL) + ((x >> 2) & 0x3333333333333333ULL);
+	x = (x + (x >> 4)) & 0x0f0f0f0f0f0f0f0fULL;
+	return (uint32_t)((x * 0x0101010101010101ULL) >> 56);
+}
+
+uint32_t popcount_swar(const unsigned char* a, Py_ssize_t n) {
+	uint32_t count = 0;
+	Py_ssize_t k = 0;
+	for (; k + 8 <= n; k += 8) {
+		count += swar_popcount64(load_u64(a + k));
+	}
+	return count + popcount_table(a + k, n - k);
+}
+
+uint32_t popcount_and_swar(const unsigned char* a, const unsigned char* b, Py_ssize_t n) {
+	uint32_t count = 0;
+	Py_ssize_t k = 0;
+	for (; k + 8 <= n; k += 8) {
+		count += swar_popcount64(load_u64(a + k) & load_u64(b + k));
+	}
+	return count + popcount_and_table(a + k, b + k, n - k);
+}
+
+// Hardware popcount kernels (popcnt on x86-64, cnt on arm64)
+#if HAVE_HW_POPCOUNT
+TARGET_POPCNT uint32_t popcount_hw(const unsigned char* a, Py_ssize_t n) {
+	uint32_t count = 0;
+	Py_ssize_t k = 0;
+	for (; k + 8 <= n; k += 8) {
+		count += (uint32_t)POPCOUNT64(load_u64(a + k));
+	}
+	return count + popcount_table(a + k, n - k);
+}
+
+TARGET_POPCNT uint32_t popcount_and_hw(const unsigned char* a, const unsigned char* b, Py_ssize_t n) {
+	uint32_t count = 0;
+	Py_ssize_t k = 0;
+	for (; k + 8 <= n; k += 8) {
+		count += (uint32_t)POPCOUNT64(load_u64(a + k) & load_u64(b + k));
+	}
+	return count + popcount_and_table(a + k, b + k, n - k);
+}
+#endif
+
+// AVX2 kernels : nibble lookup with vpshufb, bytes summed with vpsadbw (Mula et al.)
+#if HAVE_AVX2
+TARGET_AVX2 static inline __m256i avx2_popcount_bytes(__m256i v) {
+	const __m256i lookup = _mm256_setr_epi8(
+		0,1,1,2,1,2,2,3,1,2,2,3,2,3,3,4
+		, 0,1,1,2,1,2,2,3,1,2,2,3,2,3,3,4
+	);
+	const __m256i low_mask = _mm256_set1_epi8(0x0f);
+	__m256i lo = _mm256_and_si256(v, low_mask);
+	__m256i hi = _mm256_and_si256(_mm256_srli_epi16(v, 4), low_mask);
+	return _mm256_add_epi8(_mm256_shuffle_epi8(lookup, lo), _mm256_shuffle_epi8(lookup, hi));
+}
+
+TARGET_AVX2 static inline uint32_t avx2_horizontal_sum(__m256i acc) {
+	return (uint32_t)(
+		(uint64_t)_mm256_extract_epi64(acc, 0) + (uint64_t)_mm256_extract_epi64(acc, 1)
+		+ (uint64_t)_mm256_extract_epi64(acc, 2) + (uint64_t)_mm256_extract_epi64(acc, 3)
+	);
+}
+
+TARGET_AVX2 uint32_t popcount_avx2(const unsigned char* a, Py_ssize_t n) {
+	__m256i acc = _mm256_setzero_si256();
+	Py_ssize_t k = 0;
+	for (; k + 32 <= n; k += 32) {
+		__m256i v = _mm256_loadu_si256((const __m256i*)(a + k));
+		acc = _mm256_add_epi64(acc, _mm256_sad_epu8(avx2_popcount_bytes(v), _mm256_setzero_si256()));
+	}
+	return avx2_horizontal_sum(acc) + popcount_swar(a + k, n - k);
+}
+
+TARGET_AVX2 uint32_t popcount_and_avx2(const unsigned char* a, const unsigned char* b, Py_ssize_t n) {
+	__m256i acc = _mm256_setzero_si256();
+	Py_ssize_t k = 0;
+	for (; k + 32 <= n; k += 32) {
+		__m256i v = _mm256_and_si256(
+			_mm256_loadu_si256((const __m256i*)(a + k))
+			, _mm256_loadu_si256((const __m256i*)(b + k))
+		);
+		acc = _mm256_add_epi64(acc, _mm256_sad_epu8(avx2_popcount_bytes(v), _mm256_setzero_si256()));
+	}
+	return avx2_horizontal_sum(acc) + popcount_and_swar(a + k, b + k, n - k);
+}
+#endif
+
+// Kernel table, from the slowest to the fastest
+static popcount_kernel popcount_kernels[] = {
+	{"table", popcount_table, popcount_and_table, 1}
+	, {"swar", popcount_swar, popcount_and_swar, 0}
+#if HAVE_HW_POPCOUNT
+	, {"popcnt", popcount_hw, popcount_and_hw, 0}
+#endif
+#if HAVE_AVX2
+	, {"avx2", popcount_avx2, popcount_and_avx2, 0}
+#endif
+};
+#define POPCOUNT_KERNEL_NUMBER ((int)(sizeof(popcount_kernels) / sizeof(popcount_kernel)))
+
+// Kernel in use. Table one until the module initialization selects another.
+static popcount_kernel* current_popcount_kernel = &popcount_kernels[0];
+#define popcount_buffer(a, n) (current_popcount_kernel->count((a), (n)))
+#define popcount_and_buffer(a, b, n) (current_popcount_kernel->count_and((a), (b), (n)))
+
+// Tell if the CPU can run the given kernel
+int popcount_kernel_supported(const popcount_kernel* kernel) {
+	if (strcmp(kernel->name, "popcnt") == 0) {
+		return cpu_has_popcnt();
+	}
+	if (strcmp(kernel->name, "avx2") == 0) {
+		return cpu_has_avx2();
+	}
+	return 1;
+}
+
+// Compare a kernel to the lookup table on pseudo-random buffers of every length up to MAX_FP_BYTES
+int popcount_kernel_check(const popcount_kernel* kernel) {
+	unsigned char a[MAX_FP_BYTES + 1], b[MAX_FP_BYTES + 1];
+	uint64_t state = 0x9e3779b97f4a7c15ULL; // xorshift seed
+	Py_ssize_t n, k;
+	int density;
+
+	for (density=0; density<3; density++) {
+		for (k=0; k<MAX_FP_BYTES + 1; k++) {
+			state ^= state << 13;
+			state ^= state >> 7;
+			state ^= state << 17;
+			// Sparse, random and dense buffers
+			a[k] = (unsigned char)(density == 0 ? state & (state >> 8) & (state >> 16) : (density == 1 ? state : state | (state >> 8)));
+			b[k] = (unsigned char)(density == 0 ? (state >> 24) | (state >> 32) : (state >> 40));
+		}
+		for (n=0; n<=MAX_FP_BYTES; n++) {
+			// Unaligned start on purpose
+			if (kernel->count(a + 1, n) != popcount_table(a + 1, n)
+				|| kernel->count_and(a + 1, b, n) != popcount_and_table(a + 1, b, n)
+			) {
+				return 0;
+			}
 		}
-		
-		t += 1;
 	}
+	return 1;
 }
 
-// Args : 
-// 	query_file_name 		- name of the file that contain fingerprints of the molecule
-//	database_file_name_list	- list of name of the database file to look at
-//	tc_threshold_list		- list of threshold for tc filtering
-//	zscore_threshold		- threshold for zscore filtering
-PyObject *tc_process(PyObject *self, PyObject *args)
-{
-	// const char **query_file_name = PyMem_RawMalloc(sizeof(char*));
-	const char *query_file_name;
-	PyObject* database_file_name_list; // Must be in the same order of appearance that the molecule's fingerprint file 
-	PyObject* tc_threshold_list; // Must be in the same order of appearance that the molecule's fingerprint file 
-	double zscore_threshold;
-	int normalize;
-	
-	// Argument parsing
-	if(!PyArg_ParseTuple(args
-			, "sOOdp"
-			, &query_file_name
-			, &database_file_name_list
-			, &tc_threshold_list
-			, &zscore_threshold
-			, &normalize
-		)
-	){
-		PyErr_SetString(TanimotoProcessingError, "Unable to read arguments.");
+// Check every kernel supported by the CPU against the lookup table (self test) and select the fastest one.
+// A kernel disagreeing with the table means a CPU or compiler issue that would give wrong Tanimoto coefficients :
+// the table kernel is used instead, and a RuntimeWarning is issued. Return -1 if the warning raised an exception.
+int select_popcount_kernel(void) {
+	const char* failed = NULL;
+	int i;
+	current_popcount_kernel = &popcount_kernels[0];
+	for (i=1; i<POPCOUNT_KERNEL_NUMBER; i++) {
+		if (!popcount_kernel_supported(&popcount_kernels[i])) {
+			popcount_kernels[i].passed = 0;
+			continue;
+		}
+		popcount_kernels[i].passed = popcount_kernel_check(&popcount_kernels[i]);
+		if (!popcount_kernels[i].passed) {
+			failed = popcount_kernels[i].name;
+		} else if (failed == NULL) {
+			current_popcount_kernel = &popcount_kernels[i];
+		}
+	}
+	if (failed != NULL) {
+		current_popcount_kernel = &popcount_kernels[0];
+		return PyErr_WarnFormat(
+			PyExc_RuntimeWarning, 1
+			, "Popcount kernel %s failed its self test against the lookup table : falling back to the table kernel.", failed
+		);
+	}
+	return 0;
+}
+
+// Args :
+//	none
+// Return a dict {kernel name : self test passed} for every kernel supported by the CPU. The test is run again.
+PyObject *popcount_self_test(PyObject *self, PyObject *args) {
+	PyObject* result = PyDict_New();
+	PyObject* passed;
+	int i;
+	if (result == NULL) {
 		return NULL;
 	}
-	if (!PyList_Check(database_file_name_list)){
-		PyErr_SetString(TanimotoProcessingError, "Database files must be contained in a list.");
-		return NULL;		
+	for (i=0; i<POPCOUNT_KERNEL_NUMBER; i++) {
+		if (!popcount_kernel_supported(&popcount_kernels[i])) {
+			continue;
+		}
+		passed = PyBool_FromLong(popcount_kernel_check(&popcount_kernels[i]));
+		PyDict_SetItemString(result, popcount_kernels[i].name, passed);
+		Py_DECREF(passed);
+	}
+	return result;
+}
+
+// Args :
+//	name (optional)	- name of the kernel to use from now on
+// Return the name of the kernel in use
+PyObject *popcount_kernel_name(PyObject *self, PyObject *args) {
+	const char* name = NULL;
+	int i;
+	if (!PyArg_ParseTuple(args, "|s", &name)) {
+		return NULL;
 	}
-	if (!PyList_Check(tc_threshold_list)){
-		PyErr_SetString(TanimotoProcessingError, "Tanimoto threshold value must be contained in a list.");
-		return NULL;		
+	if (name != NULL) {
+		for (i=0; i<POPCOUNT_KERNEL_NUMBER; i++) {
+			if (strcmp(popcount_kernels[i].name, name) == 0) {
+				break;
+			}
+		}
+		if (i == POPCOUNT_KERNEL_NUMBER || !popcount_kernel_supported(&popcount_kernels[i]) || !popcount_kernel_check(&popcount_kernels[i])) {
+			PyErr_Format(TanimotoProcessingError, "Popcount kernel %s is not available on this CPU.", name);
+			return NULL;
+		}
+		current_popcount_kernel = &popcount_kernels[i];
 	}
-	
-	// Evaluate filtering task
-	int is_tc_threshold, is_zscore_threshold;
-	if (PyList_Size(tc_threshold_list) == 0) {is_tc_threshold = 0;}else{is_tc_threshold = 1;}
-	if (zscore_threshold == 0) {is_zscore_threshold = 0;}else{is_zscore_threshold = 1;}
-	
-	
-	unsigned char query_fp[128]; // buffer that accept 128 bytes (fingerprint's size)
-	unsigned char chembl_mol[128]; // buffer that accept 128 bytes (fingerprint's size)
-	unsigned char* db_bytes; // Will hold the entire db bytes while looping
-	Py_ssize_t db_size // Will hold the size of the db red while looping
-		, db_position // Will hold the position of the 'cursor' while parsing the db
-		;
-	unsigned int db_id_size = 0
-		, reading_i=0
-		;
-	
-	unsigned char id_query_length[1]; // will hold query molecule's name's length over the loops
-	int id_query_length_int = 0; // numerical value of the var above
-	char fingerprint_length_str[FP_LENGTH_SIZE]; // will hold query molecule's fingerprint's length over the loops
-	unsigned int fingerprint_length_int=0, fingerprint_byte_length_int; // numerical value of the var above
-	Py_ssize_t fingerprint_number=0;
-	
-	unsigned int lenid_chembl_mol_int = 0;
+	return PyUnicode_FromString(current_popcount_kernel->name);
+}
 
-	char id_query[255];
-	char id_chembl_mol[255];
+// Read the offset of the index-th compound ID inside the id block (little-endian uint32)
+size_t read_id_offset(const void* id_offsets, Py_ssize_t index) {
+	const unsigned char* p = (const unsigned char*)id_offsets + index * ID_OFFSET_SIZE;
+	return (size_t)p[0] | (size_t)p[1] << 8 | (size_t)p[2] << 16 | (size_t)p[3] << 24;
+}
 
-	int A, B, c;
+// Read the precomputed popcount of the index-th database fingerprint (little-endian uint16)
+static inline uint32_t read_popcount(const void* popcounts, Py_ssize_t index) {
+	const unsigned char* p = (const unsigned char*)popcounts + index * POPCOUNT_SIZE;
+	return (uint32_t)p[0] | (uint32_t)p[1] << 8;
+}
 
+// Release the buffers held by the database views
+void release_database_views(database_view* views, Py_ssize_t n) {
+	Py_ssize_t i;
+	for (i=0; i<n; i++) {
+		PyBuffer_Release(&views[i].fingerprints);
+		PyBuffer_Release(&views[i].id_offsets);
+		PyBuffer_Release(&views[i].id_block);
+		PyBuffer_Release(&views[i].popcounts); // No-op when the database has no popcounts
+		PyBuffer_Release(&views[i].index_map); // Same when the database has no index map
+		PyBuffer_Release(&views[i].popcount_buckets); // Same when the database is not sorted
+	}
+	PyMem_Free(views);
+}
 
-	FILE *query_file;
+// Index of the i-th compound of the first database inside this database, -1 if it is not found
+static inline Py_ssize_t matched_index(const database_view* db, Py_ssize_t i) {
+	int32_t j;
+	if (db->index_map.buf == NULL) {
+		return i < db->count ? i : -1;
+	}
+	memcpy(&j, (const unsigned char*)db->index_map.buf + i * INDEX_SIZE, INDEX_SIZE);
+	return (Py_ssize_t)j;
+}
 
-	unsigned char a[1];
-	a[0] = '2';
-	int b = (int)a[0]; 
-	unsigned int molecule_hit_count, inner_array_size=1;
-	
-	// vars meant to be appended to the list 
-	PyObject* db_molecule_id;
-	PyObject* tanimoto_score;
-	PyObject* result_row;
-	// Meant to hold the results of this program
-	PyObject* molecule_results_list; // Hold a list of row results for current loop
-	PyObject* return_dict;
-	
-	// Some utility vars
-	PyObject* db_tanimoto_dict = PyDict_New();
-	PyObject* db_zscore_dict = PyDict_New();
-	PyObject* current_array_0; // will held the current python array of chemblid, tc, zscore while looping
-	PyObject* current_array_1; 
-	PyObject* key_2_remove_list; // will hold the keys to remove while looping on dictionnary
-	PyObject *pylong_buffer_0, *pyfloat_buffer;
-	PyObject *key, *value;
-	double tanimoto
-		, tc_sum // Will hold the sum of tanimoto's scores per molecule for standart deviation calculation
-		, squared_tc_sum // Will hold the sum of the squared tanimoto's scores per molecule for standart deviation calculation
-		, tc_mean_distance_sum
-		, tc_stdev_loop // Will hold the tc during the stdev loop
-		, tc_stdev
-		, double_loop // Will hold double value during remove-key loops
-		, tc_mean 
-		, zscore // Will hold the zscore during zscore calculation loop
-		, zscore_sum // Will hold the zscore during zscore mean calculation loop
-		, zscore_mean 
-		, molecule_hit_count_double
-		;
-	Py_ssize_t pos = 0
-		, py_index=0 // Pythonized index
-		;
-	Py_ssize_t i, ii, l, current_array_size_int
-		, remove_value // BOOL - say if we remove the value for threshold trespassing
-		;
-	unsigned int k=0;
-	Py_ssize_t 
-		db_id_index = 0
-		, tc_index = 1
-		, zscore_index = 2
-		;
-		
-	int TEMP_i = 0;
-		
-	if (normalize) {
-		inner_array_size = 3;
-	} else {
-		inner_array_size = 2;
+// Check that an index map covers reference_count compounds and only points inside the database. Return -1 on failure.
+int check_index_map(const database_view* view, Py_ssize_t reference_count) {
+	Py_ssize_t i, j;
+	if (view->index_map.len < reference_count * INDEX_SIZE) {
+		return -1;
+	}
+	for (i=0; i<reference_count; i++) {
+		j = matched_index(view, i);
+		if (j < -1 || j >= view->count) {
+			return -1;
+		}
+	}
+	return 0;
+}
+
+// Read the index of the first compound of the popcount-th bucket of a sorted database (little-endian uint32)
+static inline Py_ssize_t read_bucket_offset(const database_view* db, Py_ssize_t popcount) {
+	const unsigned char* p = (const unsigned char*)db->popcount_buckets.buf + popcount * BUCKET_OFFSET_SIZE;
+	return (Py_ssize_t)((size_t)p[0] | (size_t)p[1] << 8 | (size_t)p[2] << 16 | (size_t)p[3] << 24);
+}
+
+// Check that the popcount buckets are increasing and cover the whole database. Return -1 on failure.
+int check_popcount_buckets(database_view* view) {
+	Py_ssize_t b;
+	view->bucket_number = view->popcount_buckets.len / BUCKET_OFFSET_SIZE - 1;
+	if (view->bucket_number < 1 || read_bucket_offset(view, 0) != 0 || read_bucket_offset(view, view->bucket_number) != view->count) {
+		return -1;
+	}
+	for (b=0; b<view->bucket_number; b++) {
+		if (read_bucket_offset(view, b) > read_bucket_offset(view, b + 1)) {
+			return -1;
+		}
 	}
-	query_file = fopen(query_file_name,"rb");
+	return 0;
+}
+
+// Get a view on each database tuple (fingerprints, stride, count, id_offsets, id_block, popcounts[, index_map[, popcount_buckets]])
+// of the list. See src/database.py for the layout. Buffers are borrowed as is : no copy is made.
+// popcounts may be None, popcounts of the database fingerprints are then computed on the fly.
+// index_map may be None or missing when the database lists its compounds in the same order as the first one.
+// popcount_buckets may be None or missing when the database is not sorted by popcount.
+database_view* get_database_views(PyObject* database_list) {
+	Py_ssize_t i, n = PyList_Size(database_list);
+	database_view* views = PyMem_Calloc(n > 0 ? n : 1, sizeof(database_view));
+	database_view* view;
+	const unsigned char* id_offsets;
+	PyObject* popcounts;
+	PyObject* index_map;
+	PyObject* popcount_buckets;
 	
-	// Loop over query molecule's fingerprint (var fingerprint_number will hold the iteration number)
-	while(
-		fread(id_query_length,sizeof(id_query_length),1,query_file) > 0 // read the first byte to get the size of the molecule's name
+	if (views == NULL) {
+		PyErr_NoMemory();
+		return NULL;
+	}
+	for (i=0; i<n; i++) {
+		view = &views[i];
+		index_map = Py_None;
+		popcount_buckets = Py_None;
+		if (!PyArg_ParseTuple(
+				PyList_GetItem(database_list, i)
+				, "y*nny*y*O|OO"
+				, &view->fingerprints
+				, &view->stride
+				, &view->count
+				, &view->id_offsets
+				, &view->id_block
+				, &popcounts
+				, &index_map
+				, &popcount_buckets
+			)
+		) {
+			release_database_views(views, i);
+			return NULL;
+		}
+		if (popcounts != Py_None) {
+			if (PyObject_GetBuffer(popcounts, &view->popcounts, PyBUF_SIMPLE) < 0) {
+				release_database_views(views, i + 1);
+				return NULL;
+			}
+			if (view->popcounts.len < view->count * POPCOUNT_SIZE) {
+				release_database_views(views, i + 1);
+				PyErr_SetString(TanimotoProcessingError, "Inconsistent database popcounts.");
+				return NULL;
+			}
+		}
+		id_offsets = (const unsigned char*)view->id_offsets.buf;
+		if (
+			view->stride <= 0
+			|| view->stride > MAX_FP_BYTES
+			|| view->count < 0
+			|| view->fingerprints.len < view->count * view->stride
+			|| view->id_offsets.len < (view->count + 1) * ID_OFFSET_SIZE
+			|| read_id_offset(id_offsets, view->count) > (size_t)view->id_block.len
+		) {
+			release_database_views(views, i + 1);
+			PyErr_SetString(TanimotoProcessingError, "Inconsistent database layout.");
+			return NULL;
+		}
+		if (index_map != Py_None && i > 0) { // The first database is the reference : it never needs a map
+			if (PyObject_GetBuffer(index_map, &view->index_map, PyBUF_SIMPLE) < 0) {
+				release_database_views(views, i + 1);
+				return NULL;
+			}
+			if (check_index_map(view, views[0].count) < 0) {
+				release_database_views(views, i + 1);
+				PyErr_SetString(TanimotoProcessingError, "Inconsistent database index map.");
+				return NULL;
+			}
+		}
+		if (popcount_buckets != Py_None) {
+			if (PyObject_GetBuffer(popcount_buckets, &view->popcount_buckets, PyBUF_SIMPLE) < 0) {
+				release_database_views(views, i + 1);
+				return NULL;
+			}
+			if (check_popcount_buckets(view) < 0) {
+				release_database_views(views, i + 1);
+				PyErr_SetString(TanimotoProcessingError, "Inconsistent database popcount buckets.");
+				return NULL;
+			}
+		}
+	}
+	return views;
+}
+
+// Address of the f-th fingerprint of the q-th query of the block
+static inline unsigned char* query_fingerprint(const query_block* queries, Py_ssize_t q, Py_ssize_t f) {
+	return queries->fingerprints + (q * queries->database_number + f) * MAX_FP_BYTES;
+}
+
+void free_query_block(query_block* queries) {
+	PyMem_Free(queries->fingerprints);
+	PyMem_Free(queries->popcounts);
+	PyMem_Free(queries->fingerprint_number);
+	PyMem_Free(queries->tc_sums);
+	PyMem_Free(queries->squared_tc_sums);
+	PyMem_Free(queries->scan_starts);
+	PyMem_Free(queries->scan_ends);
+}
+
+// Allocate a zeroed block for query_number queries of database_number fingerprints. Return -1 on failure.
+int allocate_query_block(query_block* queries, Py_ssize_t query_number, Py_ssize_t database_number) {
+	Py_ssize_t n = query_number * database_number;
+	queries->query_number = query_number;
+	queries->database_number = database_number;
+	queries->fingerprints = PyMem_Calloc(n > 0 ? n : 1, MAX_FP_BYTES);
+	queries->popcounts = PyMem_Calloc(n > 0 ? n : 1, sizeof(uint32_t));
+	queries->fingerprint_number = PyMem_Calloc(query_number > 0 ? query_number : 1, sizeof(int));
+	queries->tc_sums = PyMem_Calloc(n > 0 ? n : 1, sizeof(double));
+	queries->squared_tc_sums = PyMem_Calloc(n > 0 ? n : 1, sizeof(double));
+	queries->scan_starts = PyMem_Calloc(n > 0 ? n : 1, sizeof(Py_ssize_t));
+	queries->scan_ends = PyMem_Calloc(n > 0 ? n : 1, sizeof(Py_ssize_t));
+	if (queries->fingerprints == NULL || queries->popcounts == NULL || queries->fingerprint_number == NULL
+		|| queries->tc_sums == NULL || queries->squared_tc_sums == NULL || queries->scan_starts == NULL || queries->scan_ends == NULL
+	) {
+		free_query_block(queries);
+		PyErr_NoMemory();
+		return -1;
+	}
+	return 0;
+}
+
+// Read the fingerprints of a query file into the q-th slot of the block. Return -1 on failure.
+// Query file records are [name length : 1 byte][name][fingerprint bit length : 4 bytes big-endian][fingerprint],
+// one per fingerprint, in the same order as the databases.
+int read_query_file(const char* query_file_name, query_block* queries, Py_ssize_t q, const database_view* databases) {
+	unsigned char id_query_length[1]; // will hold query molecule's name's length over the loops
+	char id_query[255];
+	unsigned char fingerprint_length_str[FP_LENGTH_SIZE]; // will hold query molecule's fingerprint's length over the loops
+	unsigned int fingerprint_length_int, fingerprint_byte_length_int; // numerical value of the var above
+	int fingerprint_number = 0;
+	unsigned char* query_fp;
+	FILE *query_file = fopen(query_file_name, "rb");
+
+	if (query_file == NULL) {
+		PyErr_SetFromErrnoWithFilename(PyExc_OSError, query_file_name);
+		return -1;
+	}
+	// Loop over query molecule's fingerprint. Fingerprints without database are ignored.
+	while (
+		fingerprint_number < queries->database_number
+		&& fread(id_query_length, sizeof(id_query_length), 1, query_file) > 0 // read the first byte to get the size of the molecule's name
 	) {
-		// Figure out the length of the molecule name
-		id_query_length_int = (int)id_query_length[0];
-		
-		// Read the molecule name
-		fread(id_query,id_query_length_int,1,query_file);
-		
-		// Read the size of the fingerprint
-		fread(fingerprint_length_str,FP_LENGTH_SIZE,1,query_file);
-		
+		// Read the molecule name, then the size of the fingerprint
+		if ((fread(id_query, id_query_length[0], 1, query_file) != 1 && id_query_length[0] > 0)
+			|| fread(fingerprint_length_str, FP_LENGTH_SIZE, 1, query_file) != 1
+		) {
+			break;
+		}
 		// Convert red 4 bytes into unsigned int
-		fingerprint_length_int = (unsigned int)fingerprint_length_str[0] << 24 
-			| (unsigned int)fingerprint_length_str[1] << 16 
-			| (unsigned int)fingerprint_length_str[2] << 8 
+		fingerprint_length_int = (unsigned int)fingerprint_length_str[0] << 24
+			| (unsigned int)fingerprint_length_str[1] << 16
+			| (unsigned int)fingerprint_length_str[2] << 8
 			| (unsigned int)fingerprint_length_str[3]
 			;
-		
 		fingerprint_byte_length_int = fingerprint_length_int / 8; // Because the size is given in bit number, so we convert it to byte number
+		if (fingerprint_byte_length_int > (unsigned int)databases[fingerprint_number].stride) {
+			fclose(query_file);
+			PyErr_SetString(TanimotoProcessingError, "Query fingerprint is larger than the database fingerprints.");
+			return -1;
+		}
 
-		// Read the fingerprint
-		fread(query_fp, fingerprint_byte_length_int, 1, query_file);
-		A=0;
-		for(k=0;k<fingerprint_byte_length_int;k++){
-			A += popcount(query_fp[k]);
-		}
-		
-		molecule_results_list = PyList_New(0);
-		
-		molecule_hit_count = 0;
-		tc_sum = 0;
-		squared_tc_sum = 0;
-		
-		PyBytes_AsStringAndSize(
-			PyList_GetItem(
-				database_file_name_list
-				, fingerprint_number
-			)
-			, &db_bytes
-			, &db_size
-		);
-		db_position = 0;
-		// Loop over hits (database molecules)
-		while( db_position < db_size) {	
-			// Read database ID
-			db_id_size = (size_t)db_bytes[db_position];
-			db_position+=1;
-			
-			// Read the database molecule name
-			reading_i = 0;
-			while (reading_i < db_id_size) {
-				id_chembl_mol[reading_i] = db_bytes[db_position];
-				reading_i+=1;
-				db_position+=1;
-			}
-			
-			// Read the fingerprint
-			reading_i = 0;
-			while (reading_i < fingerprint_byte_length_int) {
-				chembl_mol[reading_i] = db_bytes[db_position];
-				reading_i+=1;
-				db_position+=1;
-			}
+		// Read the fingerprint. Padding bytes are left to zero so they never count as set bits.
+		query_fp = query_fingerprint(queries, q, fingerprint_number);
+		if (fread(query_fp, fingerprint_byte_length_int, 1, query_file) != 1 && fingerprint_byte_length_int > 0) {
+			break;
+		}
+		queries->popcounts[q * queries->database_number + fingerprint_number] = popcount_buffer(query_fp, databases[fingerprint_number].stride);
+		fingerprint_number += 1;
+	}
+	queries->fingerprint_number[q] = fingerprint_number;
+	fclose(query_file);
+	return 0;
+}
 
-			TEMP_i += 1;
-			B=0;
-			c=0;
-			// Compare molecules A and B
-			for(k=0;k<fingerprint_byte_length_int;k++){
-				B += popcount(chembl_mol[k]);
-				c += popcount(query_fp[k]&chembl_mol[k]);
-			}
-			
-			// Compute tanimoto
-			tanimoto = ((double)c)/(A+B-c);
-			molecule_hit_count = molecule_hit_count + 1;
-			tc_sum += tanimoto;
-			squared_tc_sum += pow(tanimoto, 2.0);
-			
-			// Lets pythonise these results
-			db_molecule_id = PyUnicode_FromStringAndSize(id_chembl_mol, db_id_size);
-			tanimoto_score = PyFloat_FromDouble(tanimoto);
-			
-			
-			// current_array_0 = PyDict_GetItem(db_tanimoto_dict, db_molecule_id); // WARNING : code here note up to date : possible memory leaks
-			// if (current_array_0) { // Append the tc score no matter what
-				// PyList_Append(current_array_0, tanimoto_score);
-			// }else{
-				// current_array_0 = PyList_New(1);
-				// PyList_SetItem(current_array_0,PyLong_AsSsize_t(PyLong_FromLong(0)), tanimoto_score);
-				// PyDict_SetItem(db_tanimoto_dict, db_molecule_id, current_array_0);
-			// }
-			
-			current_array_0 = PyDict_GetItem(db_tanimoto_dict, db_molecule_id); // return NULL if not found. NULL tested as false in boolean context
-			if (fingerprint_number == 0) { // Append tc score for final results only if this is the first loop or if another tc score has been computed
-				current_array_0 = PyList_New(1);
-				PyList_SetItem(current_array_0, 0, tanimoto_score);
-				Py_INCREF(tanimoto_score);
-				PyDict_SetItem(db_tanimoto_dict, db_molecule_id, current_array_0);
-				Py_DECREF(current_array_0);
-			} else if (current_array_0) {
-				PyList_Append(current_array_0, tanimoto_score);
+// Read the fingerprints of the query rows of in-memory matrices into the block. Return -1 on failure.
+// query_matrices holds one (fingerprints, stride) couple per fingerprint, in the same order as the databases :
+// row r of a matrix is the fingerprint of query molecule r, zero-padded to stride.
+// fingerprint_numbers gives, for each row, the number of leading fingerprints it actually holds.
+// query_rows gives the native int32 row of each query of the block.
+int read_query_rows(PyObject* query_matrices, const Py_buffer* fingerprint_numbers, const Py_buffer* query_rows
+		, query_block* queries, const database_view* databases) {
+	Py_ssize_t matrix_number = PyList_Size(query_matrices);
+	Py_ssize_t row_number = fingerprint_numbers->len;
+	Py_ssize_t f, q, stride;
+	int32_t row;
+	Py_buffer matrix;
+	unsigned char* query_fp;
+	const unsigned char* available = (const unsigned char*)fingerprint_numbers->buf;
+
+	if (query_rows->len != queries->query_number * INDEX_SIZE) {
+		PyErr_SetString(TanimotoProcessingError, "Query rows must hold one native int32 per query.");
+		return -1;
+	}
+	for (q=0; q<queries->query_number; q++) {
+		memcpy(&row, (const unsigned char*)query_rows->buf + q * INDEX_SIZE, INDEX_SIZE);
+		if (row < 0 || row >= row_number) {
+			PyErr_SetString(TanimotoProcessingError, "Query row out of the query matrices.");
+			return -1;
+		}
+		queries->fingerprint_number[q] = available[row] < matrix_number ? available[row] : (int)matrix_number;
+		if (queries->fingerprint_number[q] > queries->database_number) {
+			queries->fingerprint_number[q] = (int)queries->database_number;
+		}
+	}
+	// Matrices without database are ignored
+	for (f=0; f<matrix_number && f<queries->database_number; f++) {
+		if (!PyArg_ParseTuple(PyList_GetItem(query_matrices, f), "y*n", &matrix, &stride)) {
+			return -1;
+		}
+		if (stride < 0 || stride > databases[f].stride) {
+			PyBuffer_Release(&matrix);
+			PyErr_SetString(TanimotoProcessingError, "Query fingerprint is larger than the database fingerprints.");
+			return -1;
+		}
+		if (matrix.len < row_number * stride) {
+			PyBuffer_Release(&matrix);
+			PyErr_SetString(TanimotoProcessingError, "Query matrix is shorter than its rows.");
+			return -1;
+		}
+		for (q=0; q<queries->query_number; q++) {
+			if (f >= queries->fingerprint_number[q]) {
+				continue;
 			}
-			
-			result_row = PyList_New(inner_array_size);
-			PyList_SetItem(result_row, db_id_index, db_molecule_id);
-			PyList_SetItem(result_row, tc_index, tanimoto_score);
-			PyList_Append(molecule_results_list, result_row); // Append all tc score to this object for normalization purpose. A row may be discarded from final result if missing tc value
-			Py_DECREF(result_row);
-		}
-		
-		if (normalize) {
-			molecule_hit_count_double = (double)molecule_hit_count;
-			tc_mean = tc_sum / molecule_hit_count_double;
-			tc_stdev = sqrt(
-				(squared_tc_sum / (molecule_hit_count_double - 1.0))
-				- (pow(tc_sum, 2.0) / ( (molecule_hit_count_double - 1.0) * molecule_hit_count_double ))
-			);
+			memcpy(&row, (const unsigned char*)query_rows->buf + q * INDEX_SIZE, INDEX_SIZE);
+			// Padding bytes are left to zero so they never count as set bits
+			query_fp = query_fingerprint(queries, q, f);
+			memcpy(query_fp, (const unsigned char*)matrix.buf + row * stride, stride);
+			queries->popcounts[q * queries->database_number + f] = popcount_buffer(query_fp, databases[f].stride);
+		}
+		PyBuffer_Release(&matrix);
+	}
+	return 0;
+}
 
-			// Now loop for normalization
-			ii = 0;
-			tc_mean_distance_sum = 0;
-			while(ii < molecule_hit_count) {
-				// Get current array
-				current_array_0 = PyList_GetItem(
-					molecule_results_list
-					, ii // loop index
-				);
-				
-				// Extract tc value from current array
-				tc_stdev_loop = PyFloat_AsDouble(
-					PyList_GetItem(
-						current_array_0
-						, tc_index // Postion of the tanimoto coefficient inside the inner list
-					)
-				);
-				
-				// Compute zscore
-				zscore = (tc_stdev_loop - tc_mean) / tc_stdev;
-				pyfloat_buffer = PyFloat_FromDouble(zscore);
-				
-				// Put zscore in the array's last spot
-				PyList_SetItem(
-					current_array_0
-					, zscore_index
-					, pyfloat_buffer // Transfer the ownership to this array ...
-				);
-				Py_INCREF(pyfloat_buffer); // Take ownership
-				// Put normalized value in dict
-				current_array_1 = PyDict_GetItem(
-					db_zscore_dict
-					, PyList_GetItem(
-						current_array_0
-						, db_id_index // Postion of the db id inside the inner list
-					)
-				);
-				if (current_array_1) { // If the array is borrow from the dict, we have to take ownership
-					PyList_Append(current_array_1, pyfloat_buffer);
-				}else{
-					current_array_1 = PyList_New(1);
-					PyList_SetItem(current_array_1, 0, pyfloat_buffer);// Transfer the ownership to this array ...
-					Py_INCREF(pyfloat_buffer); 
-					PyDict_SetItem(
-						db_zscore_dict
-						, PyList_GetItem(
-							current_array_0
-							, db_id_index // Postion of the db id inside the inner list
-						)
-						, current_array_1
-					);
-					Py_DECREF(current_array_1);
+// Compounds of a database sorted by popcount whose tc with a query of popcount A may reach tc_threshold.
+// As tc = c / (A + B - c) <= min(A, B) / max(A, B), only the popcounts B in [A * tc_threshold, A / tc_threshold] can pass.
+// Bounds are rounded outwards so no passing compound is ever left out. tc_threshold must be > 0.
+void feasible_range(const database_view* db, uint32_t A, double tc_threshold, Py_ssize_t* start, Py_ssize_t* end) {
+	double high_bound = ceil((double)A / tc_threshold);
+	Py_ssize_t low = (Py_ssize_t)floor((double)A * tc_threshold);
+	Py_ssize_t high = high_bound < (double)(db->bucket_number - 1) ? (Py_ssize_t)high_bound : db->bucket_number - 1;
+
+	if (low > high) {
+		*start = 0;
+		*end = 0;
+		return;
+	}
+	*start = read_bucket_offset(db, low);
+	*end = read_bucket_offset(db, high + 1);
+}
+
+// Compute the tanimoto coefficient of every query of the block against every compound of every database.
+// Databases are scanned tile by tile : each tile stays in cache while all the queries of the block are compared to it,
+// so the database is streamed from memory once per block instead of once per query.
+// scores[q * score_stride + score_offsets[f] + i] receives the coefficient of query q with compound i of database f.
+// The sum and the sum of squares of the coefficients of each query and database are accumulated on the way,
+// in compound order, so the normalization never has to go through the scores again.
+// With prune set, databases sorted by popcount are only scanned over the popcount range able to reach tc_threshold
+// (see feasible_range) : the scores of the other compounds are left unset.
+// With shard_starts set, only the compounds shard_starts[f] <= i < shard_ends[f] of database f are scanned, and their
+// scores are stored from score_offsets[f] on : the coefficient of compound i goes to index i - shard_starts[f].
+// No Python object is touched here : it runs without the GIL.
+void scan_databases(query_block* queries, const database_view* databases
+		, const Py_ssize_t* score_offsets, Py_ssize_t score_stride, double* scores, int prune, double tc_threshold
+		, const Py_ssize_t* shard_starts, const Py_ssize_t* shard_ends) {
+	Py_ssize_t f, q, i, qf, tile_start, tile_end, tile_size, scan_start, scan_end, first, last;
+	const database_view* db;
+	const unsigned char *db_fps, *query_fp, *chembl_mol;
+	const void* db_popcounts;
+	double* query_scores;
+	double tanimoto, tc_sum, squared_tc_sum;
+	int A, B, c;
+
+	for (f=0; f<queries->database_number; f++) {
+		db = &databases[f];
+		db_fps = (const unsigned char*)db->fingerprints.buf;
+		db_popcounts = db->popcounts.buf;
+		first = shard_starts != NULL ? shard_starts[f] : 0;
+		last = shard_ends != NULL ? shard_ends[f] : db->count;
+		for (q=0; q<queries->query_number; q++) {
+			qf = q * queries->database_number + f;
+			if (prune && db->popcount_buckets.buf != NULL) {
+				feasible_range(db, queries->popcounts[qf], tc_threshold, &queries->scan_starts[qf], &queries->scan_ends[qf]);
+				queries->scan_starts[qf] = queries->scan_starts[qf] > first ? queries->scan_starts[qf] : first;
+				queries->scan_ends[qf] = queries->scan_ends[qf] < last ? queries->scan_ends[qf] : last;
+				if (queries->scan_ends[qf] < queries->scan_starts[qf]) { // Popcount range outside of the shard
+					queries->scan_ends[qf] = queries->scan_starts[qf];
 				}
-				
-				if (PyList_Size(current_array_1))
-				
-				Py_DECREF(pyfloat_buffer);
-				ii += 1;
+			} else {
+				queries->scan_starts[qf] = first;
+				queries->scan_ends[qf] = last;
+			}
+		}
+		tile_size = TILE_BYTES / db->stride;
+		if (tile_size < 1) {
+			tile_size = 1;
+		}
+		for (tile_start=first; tile_start<last; tile_start+=tile_size) {
+			tile_end = tile_start + tile_size < last ? tile_start + tile_size : last;
+			for (q=0; q<queries->query_number; q++) {
+				qf = q * queries->database_number + f;
+				scan_start = queries->scan_starts[qf] > tile_start ? queries->scan_starts[qf] : tile_start;
+				scan_end = queries->scan_ends[qf] < tile_end ? queries->scan_ends[qf] : tile_end;
+				if (f >= queries->fingerprint_number[q] || scan_start >= scan_end) {
+					continue;
+				}
+				query_fp = query_fingerprint(queries, q, f);
+				A = (int)queries->popcounts[qf];
+				query_scores = scores + q * score_stride + score_offsets[f];
+				tc_sum = queries->tc_sums[qf];
+				squared_tc_sum = queries->squared_tc_sums[qf];
+				for (i=scan_start; i<scan_end; i++) {
+					chembl_mol = db_fps + i * db->stride;
+					// Compare molecules A and B. B never changes : read it from the database when it has been stored.
+					if (db_popcounts != NULL) {
+						B = (int)read_popcount(db_popcounts, i);
+					} else {
+						B = (int)popcount_buffer(chembl_mol, db->stride);
+					}
+					c = (int)popcount_and_buffer(query_fp, chembl_mol, db->stride);
+					tanimoto = ((double)c)/(A+B-c);
+					query_scores[i - first] = tanimoto;
+					tc_sum += tanimoto;
+					squared_tc_sum += tanimoto * tanimoto;
+				}
+				queries->tc_sums[qf] = tc_sum;
+				queries->squared_tc_sums[qf] = squared_tc_sum;
 			}
 		}
-		// if (PyErr_Occurred()) {printf("Error occured\n");PyErr_Print();} else {printf("No Error so far\n");} // A nice string for python debugging
-		Py_DECREF(molecule_results_list);
-		fingerprint_number += 1;
 	}
-	
+}
+
+// Mean and sample standard deviation of the scores of the q-th query in each database, used by the normalization
+void compute_score_statistics(const query_block* queries, Py_ssize_t q, const database_view* databases, double* means, double* stdevs) {
+	double tc_sum, squared_tc_sum, molecule_hit_count_double;
+	int f;
+
+	for (f=0; f<queries->fingerprint_number[q]; f++) {
+		tc_sum = queries->tc_sums[q * queries->database_number + f];
+		squared_tc_sum = queries->squared_tc_sums[q * queries->database_number + f];
+		molecule_hit_count_double = (double)databases[f].count;
+		means[f] = tc_sum / molecule_hit_count_double;
+		stdevs[f] = sqrt(
+			(squared_tc_sum / (molecule_hit_count_double - 1.0))
+			- (pow(tc_sum, 2.0) / ( (molecule_hit_count_double - 1.0) * molecule_hit_count_double ))
+		);
+	}
+}
+
+void free_hit_selection(hit_selection* selection) {
+	PyMem_Free(selection->hits);
+	PyMem_Free(selection->means);
+	PyMem_Free(selection->stdevs);
+	PyMem_Free(selection->tcs);
+	PyMem_Free(selection->zscores);
+	PyMem_Free(selection->heap_scores);
+	PyMem_Free(selection->heap_hits);
+}
+
+// Allocate the scratch buffers used to select the hits of each query. Return -1 on failure.
+// top_k > 0 keeps only the top_k best hits of each query (see push_top_hit).
+int allocate_hit_selection(hit_selection* selection, const database_view* databases, Py_ssize_t database_number, Py_ssize_t top_k) {
+	Py_ssize_t reference_count = database_number > 0 && databases[0].count > 0 ? databases[0].count : 1;
+	selection->top_k = top_k > reference_count ? reference_count : top_k;
+	selection->hits = PyMem_Malloc(reference_count * sizeof(int32_t));
+	selection->means = PyMem_Calloc(database_number + 1, sizeof(double));
+	selection->stdevs = PyMem_Calloc(database_number + 1, sizeof(double));
+	selection->tcs = PyMem_Calloc(database_number + 1, sizeof(double));
+	selection->zscores = PyMem_Calloc(database_number + 1, sizeof(double));
+	selection->heap_scores = PyMem_Malloc((selection->top_k > 0 ? selection->top_k : 1) * sizeof(double));
+	selection->heap_hits = PyMem_Malloc((selection->top_k > 0 ? selection->top_k : 1) * sizeof(int32_t));
+	if (selection->hits == NULL || selection->means == NULL || selection->stdevs == NULL
+		|| selection->tcs == NULL || selection->zscores == NULL || selection->heap_scores == NULL || selection->heap_hits == NULL
+	) {
+		free_hit_selection(selection);
+		PyErr_NoMemory();
+		return -1;
+	}
+	return 0;
+}
+
+// Is hit a (score_a, hit_a) worse than hit b ? Lower score first, then later in the database, like a stable sort would rank them.
+static inline int is_worse_hit(double score_a, int32_t hit_a, double score_b, int32_t hit_b) {
+	return score_a < score_b || (score_a == score_b && hit_a > hit_b);
+}
+
+// Swap two slots of the top hit heap
+static inline void swap_top_hits(hit_selection* selection, Py_ssize_t a, Py_ssize_t b) {
+	double score = selection->heap_scores[a];
+	int32_t hit = selection->heap_hits[a];
+	selection->heap_scores[a] = selection->heap_scores[b];
+	selection->heap_hits[a] = selection->heap_hits[b];
+	selection->heap_scores[b] = score;
+	selection->heap_hits[b] = hit;
+}
+
+// Offer a hit to the bounded heap of the top_k best hits. The worst kept hit stays on top, so it is replaced in O(log k).
+void push_top_hit(hit_selection* selection, double score, int32_t hit) {
+	Py_ssize_t node, child;
+
+	if (selection->heap_size < selection->top_k) { // Not full : sift the new hit up
+		node = selection->heap_size++;
+		selection->heap_scores[node] = score;
+		selection->heap_hits[node] = hit;
+		while (node > 0 && is_worse_hit(
+				selection->heap_scores[node], selection->heap_hits[node]
+				, selection->heap_scores[(node - 1) / 2], selection->heap_hits[(node - 1) / 2]
+			)
+		) {
+			swap_top_hits(selection, node, (node - 1) / 2);
+			node = (node - 1) / 2;
+		}
+		return;
+	}
+	if (!is_worse_hit(selection->heap_scores[0], selection->heap_hits[0], score, hit)) {
+		return;
+	}
+	// Replace the worst kept hit, then sift it down
+	selection->heap_scores[0] = score;
+	selection->heap_hits[0] = hit;
+	node = 0;
+	while ((child = 2 * node + 1) < selection->heap_size) {
+		if (child + 1 < selection->heap_size && is_worse_hit(
+				selection->heap_scores[child + 1], selection->heap_hits[child + 1]
+				, selection->heap_scores[child], selection->heap_hits[child]
+			)
+		) {
+			child += 1;
+		}
+		if (!is_worse_hit(selection->heap_scores[child], selection->heap_hits[child], selection->heap_scores[node], selection->heap_hits[node])) {
+			break;
+		}
+		swap_top_hits(selection, node, child);
+		node = child;
+	}
+}
+
+int compare_hits(const void* a, const void* b) {
+	int32_t hit_a = *(const int32_t*)a, hit_b = *(const int32_t*)b;
+	return (hit_a > hit_b) - (hit_a < hit_b);
+}
 
+// Select the hits of the q-th query into selection->hits and return their number.
+// Hits are compounds of the first database found in every database (see matched_index) that pass the filters :
+//     every tc >= tc_threshold (if is_tc_threshold)
+//     with normalization, zscore mean > zscore_threshold (no filtering if 0)
+// With selection->top_k, only the top_k best scores (zscore mean, or tc of the last fingerprint) are kept.
+// Hits are always given in database order.
+// Only the compounds scanned in the first database are considered : pruned ones can't pass the tc threshold.
+// Nothing is allocated : the compounds failing the filters never leave the score buffer.
+Py_ssize_t select_hits(const double* query_scores, const Py_ssize_t* score_offsets, const database_view* databases
+		, const query_block* queries, Py_ssize_t q, int is_tc_threshold, double tc_threshold, double zscore_threshold, int normalize
+		, hit_selection* selection) {
+	int f, keep, is_zscore_threshold, fingerprint_number = queries->fingerprint_number[q];
+	double tanimoto = 0, zscore_sum;
+	Py_ssize_t i, j, hit_number = 0;
+
+	selection->heap_size = 0;
+	if (fingerprint_number == 0) {
+		return 0;
+	}
+	is_zscore_threshold = zscore_threshold != 0 && normalize;
 	if (normalize) {
-		// Calculation of the zscore mean
-		pos = 0;
-		key_2_remove_list = PyList_New(0);
-		while (PyDict_Next(db_zscore_dict, &pos, &key, &value)){
-			// if (PyErr_Occurred()) {printf("Error occured\n");PyErr_Print();} else {printf("No Error so far\n");} // A nice string for python debugging
-			pylong_buffer_0 = PyLong_FromSsize_t(PyList_Size(value));
-			current_array_size_int = PyLong_AsLong(pylong_buffer_0);
-			Py_DECREF(pylong_buffer_0);
-			if (fingerprint_number == current_array_size_int){// check if the zscore list is same length as the number of fingerprint
-				i = 0;
-				zscore_sum = 0;
-				zscore_mean = 0;
-				// compute zscore mean
-				while (i < current_array_size_int){
-					zscore_sum += PyFloat_AsDouble(
-						PyList_GetItem(
-							value
-							, i
-						)
-					);
-						
-					i +=1;
-				}
-				zscore_mean = zscore_sum / (double)current_array_size_int;
-				pyfloat_buffer = PyFloat_FromDouble(zscore_mean);
-				PyList_Append(value, pyfloat_buffer);
-				Py_DECREF(pyfloat_buffer);
-			} else {// if the zscore list miss some values, discard it 
-				PyList_Append(key_2_remove_list, key);
+		compute_score_statistics(queries, q, databases, selection->means, selection->stdevs);
+	}
+
+	for (i=queries->scan_starts[q * queries->database_number]; i<queries->scan_ends[q * queries->database_number]; i++) {
+		keep = 1;
+		zscore_sum = 0;
+		for (f=0; f<fingerprint_number && keep; f++) {
+			j = matched_index(&databases[f], i);
+			if (j < 0) {
+				keep = 0;
+				break;
+			}
+			tanimoto = query_scores[score_offsets[f] + j];
+			if (is_tc_threshold && tanimoto < tc_threshold) {
+				keep = 0;
+			}
+			if (normalize) {
+				zscore_sum += (tanimoto - selection->means[f]) / selection->stdevs[f];
 			}
 		}
-		
-		//Removing entry with missing zscore value
-		// ii = 0;
-		// l = PyLong_AsLong( PyLong_FromSsize_t( PyList_Size(key_2_remove_list)));
-		// while (ii<l) {
-			// PyDict_DelItem(
-				// db_zscore_dict
-				// , PyList_GetItem(key_2_remove_list, ii)
-			// );
-			// ii += 1;
-		// }
-		delete_keys_from_dict(db_zscore_dict, key_2_remove_list);
-		Py_DECREF(key_2_remove_list);
+		if (keep && is_zscore_threshold && zscore_sum / (double)fingerprint_number <= zscore_threshold) {
+			keep = 0;
+		}
+		if (!keep) {
+			continue;
+		}
+		if (selection->top_k > 0) {
+			push_top_hit(selection, normalize ? zscore_sum / (double)fingerprint_number : tanimoto, (int32_t)i);
+		} else {
+			selection->hits[hit_number++] = (int32_t)i;
+		}
 	}
-	
-	fclose(query_file);
-	
-	if (normalize){
-		return_dict = db_zscore_dict;
-		Py_INCREF(db_zscore_dict);
-	} else {
-		return_dict = db_tanimoto_dict;
-		Py_INCREF(db_tanimoto_dict);
+	if (selection->top_k > 0) {
+		hit_number = selection->heap_size;
+		memcpy(selection->hits, selection->heap_hits, hit_number * sizeof(int32_t));
+		qsort(selection->hits, hit_number, sizeof(int32_t), compare_hits);
 	}
-	
-	if (is_tc_threshold | is_zscore_threshold) {
-		// Remove rows according to the threshold
-		key_2_remove_list = PyList_New(0);
-		if (is_tc_threshold){ // According to tc threshold
-			pos = 0;
-			
-			// Loop over hits
-			while (PyDict_Next(db_tanimoto_dict, &pos, &key, &value)){
-				i = 0;
-				remove_value = 0;
-				l = PyList_Size(value);
-				while (i<l) { // loop over different fp tanimotos
-					double_loop = PyFloat_AsDouble( 
-						PyList_GetItem(
-							value
-							, i
-						)
-					);
-					// Compare tanimoto coefficient to the user provided threshold
-					if (double_loop < PyFloat_AsDouble(PyList_GetItem(tc_threshold_list, py_index))) {
-						remove_value = 1; // Set it to 1 so we can remove it
-					}
-					i += 1;
-				}
-				if (remove_value) {
-					PyList_Append(key_2_remove_list, key);
-				}
-				
+	return hit_number;
+}
+
+// Fill selection->tcs (one per fingerprint) and, with normalization, selection->zscores (one per fingerprint then their mean)
+// for the i-th compound of the first database. It must have been selected by select_hits.
+void compute_hit_row(const double* query_scores, const Py_ssize_t* score_offsets, const database_view* databases
+		, int fingerprint_number, int normalize, Py_ssize_t i, hit_selection* selection) {
+	double zscore, zscore_sum = 0;
+	int f;
+
+	for (f=0; f<fingerprint_number; f++) {
+		selection->tcs[f] = query_scores[score_offsets[f] + matched_index(&databases[f], i)];
+		if (normalize) {
+			zscore = (selection->tcs[f] - selection->means[f]) / selection->stdevs[f];
+			selection->zscores[f] = zscore;
+			zscore_sum += zscore;
+		}
+	}
+	if (normalize) {
+		selection->zscores[fingerprint_number] = zscore_sum / (double)fingerprint_number;
+	}
+}
+
+// Build the result dictionary of the selected hits of one query.
+// Without normalization : {database id : [tc fp 1, ..., tc fp n]}
+// With normalization : {database id : [zscore fp 1, ..., zscore fp n, zscore mean]}
+PyObject* build_query_results(const double* query_scores, const Py_ssize_t* score_offsets, const database_view* databases
+		, int fingerprint_number, int normalize, Py_ssize_t hit_number, hit_selection* selection) {
+	PyObject* db_tanimoto_dict = PyDict_New();
+	PyObject *db_molecule_id, *current_array, *pyfloat_buffer;
+	const double* row = normalize ? selection->zscores : selection->tcs;
+	Py_ssize_t h, k, width = normalize ? fingerprint_number + 1 : fingerprint_number;
+	size_t db_id_start;
+
+	if (db_tanimoto_dict == NULL) {
+		return NULL;
+	}
+	for (h=0; h<hit_number; h++) {
+		compute_hit_row(query_scores, score_offsets, databases, fingerprint_number, normalize, selection->hits[h], selection);
+
+		// Lets pythonise these results
+		db_id_start = read_id_offset(databases[0].id_offsets.buf, selection->hits[h]);
+		db_molecule_id = PyUnicode_FromStringAndSize(
+			(const char*)databases[0].id_block.buf + db_id_start
+			, read_id_offset(databases[0].id_offsets.buf, selection->hits[h] + 1) - db_id_start
+		);
+		current_array = PyList_New(width);
+		if (db_molecule_id == NULL || current_array == NULL) {
+			Py_XDECREF(db_molecule_id);
+			Py_XDECREF(current_array);
+			Py_DECREF(db_tanimoto_dict);
+			return NULL;
+		}
+		for (k=0; k<width; k++) {
+			pyfloat_buffer = PyFloat_FromDouble(row[k]);
+			if (pyfloat_buffer == NULL) {
+				Py_DECREF(db_molecule_id);
+				Py_DECREF(current_array);
+				Py_DECREF(db_tanimoto_dict);
+				return NULL;
 			}
+			PyList_SET_ITEM(current_array, k, pyfloat_buffer);
 		}
-		if (is_zscore_threshold & normalize){ // According to zscore
-			pos = 0;
-			while (PyDict_Next(db_zscore_dict, &pos, &key, &value)){
-				i = 0;
-				
-				// Now determine the last index of the list to apply threshold on the last. Assume that the last float is the mean
-				l = PyList_Size(value) - 1;
-				if (
-						PyFloat_AsDouble(
-							PyList_GetItem(value, l) // Py float value of zscore mean
-						)
-						<= zscore_threshold
-				) {
-					PyList_Append(key_2_remove_list, key);
-				}
+		if (PyDict_SetItem(db_tanimoto_dict, db_molecule_id, current_array) < 0) {
+			Py_DECREF(db_molecule_id);
+			Py_DECREF(current_array);
+			Py_DECREF(db_tanimoto_dict);
+			return NULL;
+		}
+		Py_DECREF(db_molecule_id);
+		Py_DECREF(current_array);
+	}
+	return db_tanimoto_dict;
+}
+
+// Build the hit arrays of the selected hits of one query.
+// Return a tuple (indices, tcs, zscores, pruned_number) :
+//     indices			bytes, native int32 index of each hit in the first database, in database order
+//     tcs				bytes, fingerprint_number doubles per hit
+//     zscores			bytes, fingerprint_number + 1 doubles per hit, the last one being their mean. Empty without normalization.
+//     pruned_number	number of compounds of the first database skipped by the popcount bounds
+PyObject* build_query_arrays(const double* query_scores, const Py_ssize_t* score_offsets, const database_view* databases
+		, int fingerprint_number, int normalize, Py_ssize_t hit_number, Py_ssize_t pruned_number, hit_selection* selection) {
+	PyObject *indices, *tcs, *zscores;
+	Py_ssize_t h, zscore_width = normalize ? fingerprint_number + 1 : 0;
+
+	indices = PyBytes_FromStringAndSize((const char*)selection->hits, hit_number * INDEX_SIZE);
+	tcs = PyBytes_FromStringAndSize(NULL, hit_number * fingerprint_number * sizeof(double));
+	zscores = PyBytes_FromStringAndSize(NULL, hit_number * zscore_width * sizeof(double));
+	if (indices == NULL || tcs == NULL || zscores == NULL) {
+		Py_XDECREF(indices);
+		Py_XDECREF(tcs);
+		Py_XDECREF(zscores);
+		return NULL;
+	}
+	for (h=0; h<hit_number; h++) {
+		compute_hit_row(query_scores, score_offsets, databases, fingerprint_number, normalize, selection->hits[h], selection);
+		memcpy(PyBytes_AS_STRING(tcs) + h * fingerprint_number * sizeof(double), selection->tcs, fingerprint_number * sizeof(double));
+		memcpy(PyBytes_AS_STRING(zscores) + h * zscore_width * sizeof(double), selection->zscores, zscore_width * sizeof(double));
+	}
+	return Py_BuildValue("(NNNn)", indices, tcs, zscores, pruned_number);
+}
+
+// Compare a block of queries, already read, to the databases. Return a list of results, one per query :
+// result dictionaries (see build_query_results), or hit arrays when arrays is set (see build_query_arrays).
+// The score buffer holds one double per query and database compound, whatever the number of hits.
+// Single database searches without normalization only scan the popcount range able to reach the tc threshold
+// when the database is sorted by popcount. top_k > 0 keeps only the top_k best hits of each query.
+PyObject* compare_queries(query_block* queries, const database_view* databases, PyObject* tc_threshold_list
+		, double zscore_threshold, int normalize, int arrays, Py_ssize_t top_k) {
+	Py_ssize_t database_number = queries->database_number;
+	Py_ssize_t query_number = queries->query_number;
+	Py_ssize_t f, q, hit_number, pruned_number, score_stride = 0;
+	int is_tc_threshold = PyList_Size(tc_threshold_list) != 0, prune;
+	double tc_threshold = is_tc_threshold ? PyFloat_AsDouble(PyList_GetItem(tc_threshold_list, 0)) : 0;
+	Py_ssize_t* score_offsets = NULL;
+	hit_selection selection;
+	double* scores = NULL;
+	PyObject *results = NULL, *query_results;
+
+	if (is_tc_threshold && tc_threshold == -1.0 && PyErr_Occurred()) {
+		return NULL;
+	}
+	if (allocate_hit_selection(&selection, databases, database_number, top_k) < 0) {
+		return NULL;
+	}
+
+	// Scores of a query are laid out database after database
+	score_offsets = PyMem_Calloc(database_number > 0 ? database_number : 1, sizeof(Py_ssize_t));
+	if (score_offsets == NULL) {
+		PyErr_NoMemory();
+		goto finally;
+	}
+	for (f=0; f<database_number; f++) {
+		score_offsets[f] = score_stride;
+		score_stride += databases[f].count;
+	}
+	scores = PyMem_Malloc((query_number * score_stride > 0 ? query_number * score_stride : 1) * sizeof(double));
+	if (scores == NULL) {
+		PyErr_NoMemory();
+		goto finally;
+	}
+	prune = database_number == 1 && !normalize && is_tc_threshold && tc_threshold > 0;
+
+	// The scan only touches native buffers : other Python threads can run meanwhile
+	Py_BEGIN_ALLOW_THREADS
+	scan_databases(queries, databases, score_offsets, score_stride, scores, prune, tc_threshold, NULL, NULL);
+	Py_END_ALLOW_THREADS
+
+	results = PyList_New(query_number);
+	if (results == NULL) {
+		goto finally;
+	}
+	for (q=0; q<query_number; q++) {
+		hit_number = select_hits(
+			scores + q * score_stride
+			, score_offsets
+			, databases
+			, queries
+			, q
+			, is_tc_threshold
+			, tc_threshold
+			, zscore_threshold
+			, normalize
+			, &selection
+		);
+		if (arrays) {
+			pruned_number = database_number > 0 && queries->fingerprint_number[q] > 0
+				? databases[0].count - (queries->scan_ends[q * database_number] - queries->scan_starts[q * database_number])
+				: 0;
+			query_results = build_query_arrays(
+				scores + q * score_stride
+				, score_offsets
+				, databases
+				, queries->fingerprint_number[q]
+				, normalize
+				, hit_number
+				, pruned_number
+				, &selection
+			);
+		} else {
+			query_results = build_query_results(
+				scores + q * score_stride
+				, score_offsets
+				, databases
+				, queries->fingerprint_number[q]
+				, normalize
+				, hit_number
+				, &selection
+			);
+		}
+		if (query_results == NULL) {
+			Py_CLEAR(results);
+			goto finally;
+		}
+		PyList_SET_ITEM(results, q, query_results);
+	}
+
+finally:
+	PyMem_Free(scores);
+	PyMem_Free(score_offsets);
+	free_hit_selection(&selection);
+	return results;
+}
+
+// Compounds start <= i < end of a database of count compounds held by the shard_index-th of shard_number shards :
+// consecutive slices of (almost) the same size, so every shard of every database gets its share of the scan.
+void shard_range(Py_ssize_t count, Py_ssize_t shard_index, Py_ssize_t shard_number, Py_ssize_t* start, Py_ssize_t* end) {
+	*start = count * shard_index / shard_number;
+	*end = count * (shard_index + 1) / shard_number;
+}
+
+// Tanimoto coefficient of the q-th query with compound j of database f : read from the shard scores when the shard
+// holds it, computed on the spot otherwise (compounds of the first database matched outside the shard of database f).
+static inline double shard_tanimoto(const double* query_scores, const Py_ssize_t* score_offsets, const database_view* databases
+		, const query_block* queries, Py_ssize_t q, int f, Py_ssize_t j, const Py_ssize_t* shard_starts, const Py_ssize_t* shard_ends) {
+	const database_view* db = &databases[f];
+	const unsigned char* chembl_mol;
+	int A, B, c;
+
+	if (j >= shard_starts[f] && j < shard_ends[f]) {
+		return query_scores[score_offsets[f] + j - shard_starts[f]];
+	}
+	chembl_mol = (const unsigned char*)db->fingerprints.buf + j * db->stride;
+	A = (int)queries->popcounts[q * queries->database_number + f];
+	B = db->popcounts.buf != NULL ? (int)read_popcount(db->popcounts.buf, j) : (int)popcount_buffer(chembl_mol, db->stride);
+	c = (int)popcount_and_buffer(query_fingerprint(queries, q, f), chembl_mol, db->stride);
+	return ((double)c)/(A+B-c);
+}
+
+// Select the candidate hits of the q-th query among the compounds of the first database held by the shard.
+// Same filters as select_hits, but the z-scores : they need the statistics of every shard, so the coordinator applies
+// them (and the top_k selection, with normalization). Without normalization, the top_k best hits of the shard are kept.
+Py_ssize_t select_shard_hits(const double* query_scores, const Py_ssize_t* score_offsets, const database_view* databases
+		, const query_block* queries, Py_ssize_t q, const Py_ssize_t* shard_starts, const Py_ssize_t* shard_ends
+		, int is_tc_threshold, double tc_threshold, hit_selection* selection) {
+	int f, keep, fingerprint_number = queries->fingerprint_number[q];
+	double tanimoto = 0;
+	Py_ssize_t i, j, hit_number = 0;
+
+	selection->heap_size = 0;
+	if (fingerprint_number == 0) {
+		return 0;
+	}
+	for (i=queries->scan_starts[q * queries->database_number]; i<queries->scan_ends[q * queries->database_number]; i++) {
+		keep = 1;
+		for (f=0; f<fingerprint_number && keep; f++) {
+			j = matched_index(&databases[f], i);
+			if (j < 0) {
+				keep = 0;
+				break;
+			}
+			tanimoto = shard_tanimoto(query_scores, score_offsets, databases, queries, q, f, j, shard_starts, shard_ends);
+			if (is_tc_threshold && tanimoto < tc_threshold) {
+				keep = 0;
 			}
 		}
-		// Now we collected all the data to discard, we cure the result dictionnary that will be returned t opython code
-		delete_keys_from_dict(return_dict, key_2_remove_list);
-		Py_DECREF(key_2_remove_list);
+		if (!keep) {
+			continue;
+		}
+		if (selection->top_k > 0) {
+			push_top_hit(selection, tanimoto, (int32_t)i);
+		} else {
+			selection->hits[hit_number++] = (int32_t)i;
+		}
 	}
-	
-	// Deallocate variables
-	Py_DECREF(db_tanimoto_dict);
-	Py_DECREF(db_zscore_dict);
-	// Py_DECREF(database_file_name_list);
-	// Py_DECREF(tc_threshold_list);
-	
-	
+	if (selection->top_k > 0) {
+		hit_number = selection->heap_size;
+		memcpy(selection->hits, selection->heap_hits, hit_number * sizeof(int32_t));
+		qsort(selection->hits, hit_number, sizeof(int32_t), compare_hits);
+	}
+	return hit_number;
+}
+
+// Build the shard results of one query. Return a tuple (indices, tcs, statistics, pruned_number) :
+//     indices			bytes, native int32 index of each candidate hit in the first database, in database order
+//     tcs				bytes, fingerprint_number doubles per candidate hit
+//     statistics		bytes, 3 doubles per fingerprint : compounds of the shard, sum and sum of squares of their coefficients
+//     pruned_number	number of compounds of the shard of the first database skipped by the popcount bounds
+PyObject* build_shard_arrays(const double* query_scores, const Py_ssize_t* score_offsets, const database_view* databases
+		, const query_block* queries, Py_ssize_t q, const Py_ssize_t* shard_starts, const Py_ssize_t* shard_ends
+		, Py_ssize_t hit_number, hit_selection* selection) {
+	PyObject *indices, *tcs, *statistics;
+	Py_ssize_t h, i, qf, pruned_number = 0;
+	int f, fingerprint_number = queries->fingerprint_number[q];
+	double* row;
+
+	indices = PyBytes_FromStringAndSize((const char*)selection->hits, hit_number * INDEX_SIZE);
+	tcs = PyBytes_FromStringAndSize(NULL, hit_number * fingerprint_number * sizeof(double));
+	statistics = PyBytes_FromStringAndSize(NULL, 3 * fingerprint_number * sizeof(double));
+	if (indices == NULL || tcs == NULL || statistics == NULL) {
+		Py_XDECREF(indices);
+		Py_XDECREF(tcs);
+		Py_XDECREF(statistics);
+		return NULL;
+	}
+	for (h=0; h<hit_number; h++) {
+		i = selection->hits[h];
+		row = (double*)PyBytes_AS_STRING(tcs) + h * fingerprint_number;
+		for (f=0; f<fingerprint_number; f++) {
+			row[f] = shard_tanimoto(query_scores, score_offsets, databases, queries, q, f, matched_index(&databases[f], i), shard_starts, shard_ends);
+		}
+	}
+	row = (double*)PyBytes_AS_STRING(statistics);
+	for (f=0; f<fingerprint_number; f++) {
+		qf = q * queries->database_number + f;
+		row[3 * f] = (double)(shard_ends[f] - shard_starts[f]);
+		row[3 * f + 1] = queries->tc_sums[qf];
+		row[3 * f + 2] = queries->squared_tc_sums[qf];
+	}
+	if (fingerprint_number > 0) {
+		pruned_number = (shard_ends[0] - shard_starts[0]) - (queries->scan_ends[q * queries->database_number] - queries->scan_starts[q * queries->database_number]);
+	}
+	return Py_BuildValue("(NNNn)", indices, tcs, statistics, pruned_number);
+}
+
+// Compare a block of queries, already read, to the shard_index-th of shard_number shards of the databases (see shard_range).
+// Return a list of shard results, one per query (see build_shard_arrays). The score buffer only holds the shard compounds.
+// Pruning and top_k work as in compare_queries, but with normalization : the coordinator needs every candidate.
+PyObject* compare_query_shard(query_block* queries, const database_view* databases, PyObject* tc_threshold_list
+		, int normalize, Py_ssize_t top_k, Py_ssize_t shard_index, Py_ssize_t shard_number) {
+	Py_ssize_t database_number = queries->database_number;
+	Py_ssize_t query_number = queries->query_number;
+	Py_ssize_t f, q, hit_number, score_stride = 0;
+	int is_tc_threshold = PyList_Size(tc_threshold_list) != 0, prune;
+	double tc_threshold = is_tc_threshold ? PyFloat_AsDouble(PyList_GetItem(tc_threshold_list, 0)) : 0;
+	Py_ssize_t *score_offsets = NULL, *shard_starts = NULL, *shard_ends = NULL;
+	hit_selection selection;
+	double* scores = NULL;
+	PyObject *results = NULL, *query_results;
+
+	if (is_tc_threshold && tc_threshold == -1.0 && PyErr_Occurred()) {
+		return NULL;
+	}
+	if (allocate_hit_selection(&selection, databases, database_number, normalize ? 0 : top_k) < 0) {
+		return NULL;
+	}
+
+	// Scores of a query are laid out shard after shard, one per database
+	score_offsets = PyMem_Calloc(database_number > 0 ? database_number : 1, sizeof(Py_ssize_t));
+	shard_starts = PyMem_Calloc(database_number > 0 ? database_number : 1, sizeof(Py_ssize_t));
+	shard_ends = PyMem_Calloc(database_number > 0 ? database_number : 1, sizeof(Py_ssize_t));
+	if (score_offsets == NULL || shard_starts == NULL || shard_ends == NULL) {
+		PyErr_NoMemory();
+		goto finally;
+	}
+	for (f=0; f<database_number; f++) {
+		shard_range(databases[f].count, shard_index, shard_number, &shard_starts[f], &shard_ends[f]);
+		score_offsets[f] = score_stride;
+		score_stride += shard_ends[f] - shard_starts[f];
+	}
+	scores = PyMem_Malloc((query_number * score_stride > 0 ? query_number * score_stride : 1) * sizeof(double));
+	if (scores == NULL) {
+		PyErr_NoMemory();
+		goto finally;
+	}
+	prune = database_number == 1 && !normalize && is_tc_threshold && tc_threshold > 0;
+
+	Py_BEGIN_ALLOW_THREADS
+	scan_databases(queries, databases, score_offsets, score_stride, scores, prune, tc_threshold, shard_starts, shard_ends);
+	Py_END_ALLOW_THREADS
+
+	results = PyList_New(query_number);
+	if (results == NULL) {
+		goto finally;
+	}
+	for (q=0; q<query_number; q++) {
+		hit_number = select_shard_hits(
+			scores + q * score_stride, score_offsets, databases, queries, q, shard_starts, shard_ends, is_tc_threshold, tc_threshold, &selection
+		);
+		query_results = build_shard_arrays(
+			scores + q * score_stride, score_offsets, databases, queries, q, shard_starts, shard_ends, hit_number, &selection
+		);
+		if (query_results == NULL) {
+			Py_CLEAR(results);
+			goto finally;
+		}
+		PyList_SET_ITEM(results, q, query_results);
+	}
+
+finally:
+	PyMem_Free(scores);
+	PyMem_Free(score_offsets);
+	PyMem_Free(shard_starts);
+	PyMem_Free(shard_ends);
+	free_hit_selection(&selection);
+	return results;
+}
+
+// Compare a block of query files to the databases (see compare_queries).
+PyObject* process_query_files(PyObject* query_file_name_list, PyObject* database_list, PyObject* tc_threshold_list
+		, double zscore_threshold, int normalize, int arrays, Py_ssize_t top_k) {
+	Py_ssize_t database_number = PyList_Size(database_list);
+	Py_ssize_t query_number = PyList_Size(query_file_name_list);
+	Py_ssize_t q;
+	database_view* databases;
+	query_block queries;
+	const char* query_file_name;
+	PyObject *results = NULL;
+
+	databases = get_database_views(database_list);
+	if (databases == NULL) {
+		return NULL;
+	}
+	if (allocate_query_block(&queries, query_number, database_number) < 0) {
+		release_database_views(databases, database_number);
+		return NULL;
+	}
+	for (q=0; q<query_number; q++) {
+		query_file_name = PyUnicode_AsUTF8(PyList_GetItem(query_file_name_list, q));
+		if (query_file_name == NULL || read_query_file(query_file_name, &queries, q, databases) < 0) {
+			goto finally;
+		}
+	}
+	results = compare_queries(&queries, databases, tc_threshold_list, zscore_threshold, normalize, arrays, top_k);
+
+finally:
+	free_query_block(&queries);
+	release_database_views(databases, database_number);
+	return results;
+}
+
+// Compare the query rows of in-memory matrices to the databases (see read_query_rows and compare_queries),
+// or to one of their shards when shard_number > 0 (see compare_query_shard).
+PyObject* process_query_rows(PyObject* query_matrices, const Py_buffer* fingerprint_numbers, const Py_buffer* query_rows
+		, PyObject* database_list, PyObject* tc_threshold_list, double zscore_threshold, int normalize, Py_ssize_t top_k
+		, Py_ssize_t shard_index, Py_ssize_t shard_number) {
+	Py_ssize_t database_number = PyList_Size(database_list);
+	database_view* databases;
+	query_block queries;
+	PyObject *results = NULL;
+
+	databases = get_database_views(database_list);
+	if (databases == NULL) {
+		return NULL;
+	}
+	if (allocate_query_block(&queries, query_rows->len / INDEX_SIZE, database_number) < 0) {
+		release_database_views(databases, database_number);
+		return NULL;
+	}
+	if (read_query_rows(query_matrices, fingerprint_numbers, query_rows, &queries, databases) == 0) {
+		if (shard_number > 0) {
+			results = compare_query_shard(&queries, databases, tc_threshold_list, normalize, top_k, shard_index, shard_number);
+		} else {
+			results = compare_queries(&queries, databases, tc_threshold_list, zscore_threshold, normalize, 1, top_k);
+		}
+	}
+	free_query_block(&queries);
+	release_database_views(databases, database_number);
+	return results;
+}
+
+// Check the arguments shared by tc_process and tc_process_batch
+int check_tc_process_arguments(PyObject* database_list, PyObject* tc_threshold_list) {
+	if (!PyList_Check(database_list)){
+		PyErr_SetString(TanimotoProcessingError, "Databases must be contained in a list.");
+		return 0;
+	}
+	if (!PyList_Check(tc_threshold_list)){
+		PyErr_SetString(TanimotoProcessingError, "Tanimoto threshold value must be contained in a list.");
+		return 0;
+	}
+	return 1;
+}
+
+// Args : 
+// 	query_file_name 		- name of the file that contain fingerprints of the molecule
+//	database_list			- list of database views (see get_database_views)
+//	tc_threshold_list		- list of threshold for tc filtering
+//	zscore_threshold		- threshold for zscore filtering
+//	normalize				- compute zscores (consensus)
+PyObject *tc_process(PyObject *self, PyObject *args)
+{
+	PyObject* query_file_name;
+	PyObject* database_list; // Must be in the same order of appearance that the molecule's fingerprint file 
+	PyObject* tc_threshold_list; // Must be in the same order of appearance that the molecule's fingerprint file 
+	double zscore_threshold;
+	int normalize;
+	PyObject *query_file_name_list, *results, *return_dict;
+
+	// Argument parsing
+	if(!PyArg_ParseTuple(args
+			, "UOOdp"
+			, &query_file_name
+			, &database_list
+			, &tc_threshold_list
+			, &zscore_threshold
+			, &normalize
+		)
+	){
+		PyErr_SetString(TanimotoProcessingError, "Unable to read arguments.");
+		return NULL;
+	}
+	if (!check_tc_process_arguments(database_list, tc_threshold_list)) {
+		return NULL;
+	}
+
+	query_file_name_list = PyList_New(1);
+	if (query_file_name_list == NULL) {
+		return NULL;
+	}
+	Py_INCREF(query_file_name);
+	PyList_SET_ITEM(query_file_name_list, 0, query_file_name);
+	results = process_query_files(query_file_name_list, database_list, tc_threshold_list, zscore_threshold, normalize, 0, 0);
+	Py_DECREF(query_file_name_list);
+	if (results == NULL) {
+		return NULL;
+	}
+	return_dict = PyList_GET_ITEM(results, 0);
+	Py_INCREF(return_dict);
+	Py_DECREF(results);
 	return return_dict;
 }
+
+// Args : 
+// 	query_file_name_list	- list of the files that contain fingerprints of each molecule of the block
+//	database_list, tc_threshold_list, zscore_threshold, normalize - same as tc_process
+// Return a list holding the tc_process result dictionary of each query file, in the same order.
+// The databases are streamed from memory once for the whole block.
+PyObject *tc_process_batch(PyObject *self, PyObject *args)
+{
+	PyObject* query_file_name_list;
+	PyObject* database_list;
+	PyObject* tc_threshold_list;
+	double zscore_threshold;
+	int normalize;
+
+	if(!PyArg_ParseTuple(args
+			, "O!OOdp"
+			, &PyList_Type
+			, &query_file_name_list
+			, &database_list
+			, &tc_threshold_list
+			, &zscore_threshold
+			, &normalize
+		)
+	){
+		return NULL;
+	}
+	if (!check_tc_process_arguments(database_list, tc_threshold_list)) {
+		return NULL;
+	}
+	return process_query_files(query_file_name_list, database_list, tc_threshold_list, zscore_threshold, normalize, 0, 0);
+}
+
+// Args : 
+// 	query_matrices			- list of (fingerprints, stride) couples, one per fingerprint in the same order as the databases :
+//							  packed fingerprints of every query molecule, one zero-padded row per molecule
+//	fingerprint_numbers		- bytes, number of leading fingerprints held by each row
+//	query_rows				- native int32 rows of the molecules of the block
+//	database_list, tc_threshold_list, zscore_threshold, normalize - same as tc_process_batch
+//	top_k					- (optional) keep only the top_k best hits of each query, 0 (default) to keep them all
+// Return a list holding the hit arrays (indices, tcs, zscores, pruned_number) of each query row, in the same order (see build_query_arrays).
+// No Python object is created per database compound : only the hits are copied out of the native score buffer.
+PyObject *tc_process_arrays(PyObject *self, PyObject *args)
+{
+	PyObject* query_matrices;
+	Py_buffer fingerprint_numbers;
+	Py_buffer query_rows;
+	PyObject* database_list;
+	PyObject* tc_threshold_list;
+	double zscore_threshold;
+	int normalize;
+	Py_ssize_t top_k = 0;
+	PyObject* results = NULL;
+
+	if(!PyArg_ParseTuple(args
+			, "O!y*y*OOdp|n"
+			, &PyList_Type
+			, &query_matrices
+			, &fingerprint_numbers
+			, &query_rows
+			, &database_list
+			, &tc_threshold_list
+			, &zscore_threshold
+			, &normalize
+			, &top_k
+		)
+	){
+		return NULL;
+	}
+	if (!check_tc_process_arguments(database_list, tc_threshold_list)) {
+		goto finally;
+	}
+	if (top_k < 0) {
+		PyErr_SetString(TanimotoProcessingError, "top_k must be positive.");
+		goto finally;
+	}
+	results = process_query_rows(query_matrices, &fingerprint_numbers, &query_rows, database_list, tc_threshold_list, zscore_threshold, normalize, top_k, 0, 0);
+
+finally:
+	PyBuffer_Release(&fingerprint_numbers);
+	PyBuffer_Release(&query_rows);
+	return results;
+}
+
+// Args : 
+// 	query_matrices, fingerprint_numbers, query_rows, database_list, tc_threshold_list - same as tc_process_arrays
+//	normalize				- compute zscores (consensus) : every candidate passing the tc threshold is returned
+//	top_k					- keep only the top_k best hits of each query (without normalization), 0 to keep them all
+//	shard_index				- shard compared, from 0 to shard_number - 1
+//	shard_number			- number of shards of every database (see shard_range)
+// Return a list holding the shard results (indices, tcs, statistics, pruned_number) of each query row, in the same order
+// (see build_shard_arrays). Merging the results of every shard gives the hits of tc_process_arrays (see src/shards.py).
+PyObject *tc_process_shard(PyObject *self, PyObject *args)
+{
+	PyObject* query_matrices;
+	Py_buffer fingerprint_numbers;
+	Py_buffer query_rows;
+	PyObject* database_list;
+	PyObject* tc_threshold_list;
+	int normalize;
+	Py_ssize_t top_k, shard_index, shard_number;
+	PyObject* results = NULL;
+
+	if(!PyArg_ParseTuple(args
+			, "O!y*y*OOpnnn"
+			, &PyList_Type
+			, &query_matrices
+			, &fingerprint_numbers
+			, &query_rows
+			, &database_list
+			, &tc_threshold_list
+			, &normalize
+			, &top_k
+			, &shard_index
+			, &shard_number
+		)
+	){
+		return NULL;
+	}
+	if (!check_tc_process_arguments(database_list, tc_threshold_list)) {
+		goto finally;
+	}
+	if (top_k < 0) {
+		PyErr_SetString(TanimotoProcessingError, "top_k must be positive.");
+		goto finally;
+	}
+	if (shard_number < 1 || shard_index < 0 || shard_index >= shard_number) {
+		PyErr_SetString(TanimotoProcessingError, "Shard index out of range.");
+		goto finally;
+	}
+	results = process_query_rows(query_matrices, &fingerprint_numbers, &query_rows, database_list, tc_threshold_list, 0, normalize, top_k, shard_index, shard_number);
+
+finally:
+	PyBuffer_Release(&fingerprint_numbers);
+	PyBuffer_Release(&query_rows);
+	return results;
+}
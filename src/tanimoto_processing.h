@@ -1 +1,55 @@
-PyObject *tc_process(PyObject *self, PyObject *args);
\ No newline at end of file
+// Fixed-stride view over one fingerprint database (see src/database.py)
+typedef struct {
+	Py_buffer fingerprints;	// count * stride bytes
+	Py_buffer id_offsets;	// (count + 1) little-endian uint32
+	Py_buffer id_block;		// concatenated compound IDs
+	Py_buffer popcounts;	// count little-endian uint16, or empty (buf == NULL) when not stored
+	Py_buffer index_map;	// native int32 index of each compound of the first database in this one (-1 if absent), or empty when both share their compound order
+	Py_buffer popcount_buckets;	// little-endian uint32 index of the first compound of each popcount, then count. Empty when not sorted by popcount.
+	Py_ssize_t stride;
+	Py_ssize_t count;
+	Py_ssize_t bucket_number;	// number of popcount buckets (largest popcount + 1)
+} database_view;
+
+// Fingerprints of a block of query molecules, each zero-padded to the stride of its database
+typedef struct {
+	Py_ssize_t query_number;
+	Py_ssize_t database_number;
+	unsigned char* fingerprints;	// query_number * database_number slots of MAX_FP_BYTES
+	uint32_t* popcounts;			// query_number * database_number
+	int* fingerprint_number;		// fingerprints actually read for each query
+	double* tc_sums;				// query_number * database_number, sum of the coefficients (filled by the scan)
+	double* squared_tc_sums;		// query_number * database_number, sum of the squared coefficients (filled by the scan)
+	Py_ssize_t* scan_starts;		// query_number * database_number, compounds scanned for each query and database :
+	Py_ssize_t* scan_ends;			// scan_starts <= i < scan_ends, the others are pruned
+} query_block;
+
+// Scratch buffers used to select and write out the hits of each query of a block
+typedef struct {
+	int32_t* hits;		// index in the first database of each hit, one slot per compound
+	double* means;		// tc mean of each database
+	double* stdevs;		// tc standard deviation of each database
+	double* tcs;		// tc row of the current hit, one per database
+	double* zscores;	// zscore row of the current hit, one per database then their mean
+	Py_ssize_t top_k;	// keep only the top_k best hits of each query, 0 to keep them all
+	Py_ssize_t heap_size;
+	double* heap_scores;	// top_k slots : bounded min-heap of the best hits, worst one on top
+	int32_t* heap_hits;
+} hit_selection;
+
+// Popcount kernel : bits set in a buffer, and in the AND of two buffers
+typedef struct {
+	const char* name;
+	uint32_t (*count)(const unsigned char* a, Py_ssize_t n);
+	uint32_t (*count_and)(const unsigned char* a, const unsigned char* b, Py_ssize_t n);
+	int passed;	// Self test result
+} popcount_kernel;
+
+int select_popcount_kernel(void);
+
+PyObject *tc_process(PyObject *self, PyObject *args);
+PyObject *tc_process_batch(PyObject *self, PyObject *args);
+PyObject *tc_process_arrays(PyObject *self, PyObject *args);
+PyObject *tc_process_shard(PyObject *self, PyObject *args);
+PyObject *popcount_self_test(PyObject *self, PyObject *args);
+PyObject *popcount_kernel_name(PyObject *self, PyObject *args);
@@ -0,0 +1,163 @@
+# Python 3.7 Built-in packages
+import abc
+import csv
+import os
+import sqlite3
+import threading
+import typing
+from pathlib import Path
+
+# Local packages
+from . import config, profiling
+
+# Target information : UniProt annotations of the ChEMBL targets (db/uniprot_database_ChEMBL.csv), printed with the hits.
+#
+# The CSV file can be compiled into an indexed SQLite store, <csv>.sqlite (db/correct_multiple_chembl.py), used
+# instead of it while it is not older than the CSV file. Only the targets of the results are read from the store,
+# with the requested columns. Without a store, the CSV file is parsed once, on the first lookup.
+
+TargetInfo = typing.Dict[str, typing.List[typing.Dict[str, str]]]       # Information rows of each target ChEMBL id
+
+
+def info_columns(columns: typing.List[str], show_info: bool) -> typing.List[str]:
+    # Columns printed : all of them, or only the UniProt and ChEMBL ids (-noinfo). File order.
+    if show_info:
+        return list(columns)
+    return [column for column in columns if column in (config.INFO_UNIPROTID_FIELD_NAME, config.INFO_CHEMBLID_FIELD_NAME)]
+
+
+class TargetInfoSource(abc.ABC):
+    """
+    Information rows of the targets, looked up by target ChEMBL id. Sources are shared between threads.
+    """
+    def __init__(self, columns: typing.List[str]):
+        self.columns: typing.List[str] = columns
+
+    def load(self):  # Read everything needed before the first lookup, if anything
+        pass
+
+    @abc.abstractmethod
+    def lookup(self, target_ids: typing.Iterable[str], show_info: bool) -> TargetInfo:
+        # Rows of the given targets, in file order, restricted to the requested columns. Unknown targets are left out.
+        raise NotImplementedError
+
+
+class CsvTargetInfo(TargetInfoSource):
+    def __init__(self, path: Path):
+        self.path = path
+        with path.open('r', encoding=config.ENCODING, newline='') as f:
+            columns = next(csv.reader(f, delimiter=config.UNIPROT_DATABASE__CHEMBL_FILE_DELIMITER), [])
+        super().__init__(columns)
+        self._lock = threading.Lock()
+        self._table: typing.Optional[typing.Dict[str, typing.List[typing.List[str]]]] = None
+
+    def load(self):
+        with self._lock:
+            if self._table is None:
+                with profiling.span("target_info_parse"):
+                    self._table = {}
+                    for row in read_target_info_rows(self.path):
+                        self._table.setdefault(row[self.columns.index(config.INFO_CHEMBLID_FIELD_NAME)], []).append(row)
+
+    def lookup(self, target_ids: typing.Iterable[str], show_info: bool) -> TargetInfo:
+        self.load()
+        columns = info_columns(self.columns, show_info)
+        positions = [self.columns.index(column) for column in columns]
+        return {
+            target_id: [dict(zip(columns, (row[p] for p in positions))) for row in self._table[target_id]]
+            for target_id in target_ids if target_id in self._table
+        }
+
+
+class CompiledTargetInfo(TargetInfoSource):
+    """
+    SQLite store written by write_target_info_store. Rows are looked up through the index on the target id.
+    """
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect("file:{}?mode=ro".format(path.resolve().as_posix()), uri=True, check_same_thread=False)
+        super().__init__([name for name, in self.connection.execute("SELECT name FROM columns ORDER BY position")])
+
+    def lookup(self, target_ids: typing.Iterable[str], show_info: bool) -> TargetInfo:
+        columns = info_columns(self.columns, show_info)
+        selected = ", ".join("c{}".format(self.columns.index(column)) for column in columns)
+        target_ids = list(set(target_ids))
+        info: TargetInfo = {}
+        with self._lock:
+            for i in range(0, len(target_ids), config.CACHE_QUERY_SIZE):
+                chunk = target_ids[i:i + config.CACHE_QUERY_SIZE]
+                for target_id, *values in self.connection.execute(
+                        "SELECT target_id{} FROM info WHERE target_id IN ({}) ORDER BY rowid".format(
+                            ", " + selected if selected else "", ",".join("?" * len(chunk)))
+                        , chunk
+                ):
+                    info.setdefault(target_id, []).append(dict(zip(columns, values)))
+        return info
+
+    def close(self):
+        self.connection.close()
+
+
+def read_target_info_rows(path: Path) -> typing.Iterator[typing.List[str]]:
+    # Rows of a target information CSV file, padded to the header length
+    with path.open('r', encoding=config.ENCODING, newline='') as f:
+        reader = csv.reader(f, delimiter=config.UNIPROT_DATABASE__CHEMBL_FILE_DELIMITER)
+        columns = next(reader, [])
+        for row in reader:
+            if len(row) == 0:
+                continue
+            yield (row + [''] * len(columns))[:len(columns)]
+
+
+def write_target_info_store(csv_path: Path, store_path: Path) -> typing.Tuple[int, int]:
+    """
+    Compile a target information CSV file into a SQLite store. Return the numbers of rows and targets written.
+    The store is written next to its final name, then moved : readers never see a partial store.
+    """
+    with csv_path.open('r', encoding=config.ENCODING, newline='') as f:
+        columns = next(csv.reader(f, delimiter=config.UNIPROT_DATABASE__CHEMBL_FILE_DELIMITER), [])
+    if config.INFO_CHEMBLID_FIELD_NAME not in columns:
+        raise ValueError("No {} column in {}.".format(config.INFO_CHEMBLID_FIELD_NAME, csv_path))
+    id_position = columns.index(config.INFO_CHEMBLID_FIELD_NAME)
+
+    temp_path = store_path.with_name(store_path.name + ".tmp")
+    if temp_path.exists():
+        temp_path.unlink()
+    connection = sqlite3.connect(str(temp_path))
+    connection.execute("CREATE TABLE columns (position INTEGER PRIMARY KEY, name TEXT NOT NULL)")
+    connection.executemany("INSERT INTO columns (position, name) VALUES (?, ?)", enumerate(columns))
+    # Columns are named by position : any header text is valid
+    connection.execute("CREATE TABLE info (target_id TEXT NOT NULL{})".format("".join(", c{} TEXT".format(i) for i in range(len(columns)))))
+    connection.executemany(
+        "INSERT INTO info VALUES (?{})".format(", ?" * len(columns))
+        , ((row[id_position], *row) for row in read_target_info_rows(csv_path))
+    )
+    connection.execute("CREATE INDEX info_target_id ON info (target_id)")
+    row_number, target_number = connection.execute("SELECT COUNT(*), COUNT(DISTINCT target_id) FROM info").fetchone()
+    connection.commit()
+    connection.close()
+    os.replace(str(temp_path), str(store_path))
+    return row_number, target_number
+
+
+def target_info_file(csv_path: str) -> Path:
+    """
+    File the target information is read from : the compiled store when it is present
+    and not older than the CSV file, else the CSV file.
+    """
+    csv_file = Path(csv_path)
+    store_file = csv_file.with_suffix(config.TARGET_INFO_STORE_SUFFIX)
+    if store_file.is_file() and (not csv_file.is_file() or os.stat(str(store_file)).st_mtime_ns >= os.stat(str(csv_file)).st_mtime_ns):
+        return store_file
+    return csv_file
+
+
+def open_target_info(csv_path: str) -> typing.Optional[TargetInfoSource]:
+    # None when there is no target information at all : hits are printed without it
+    info_file = target_info_file(csv_path)
+    if info_file.suffix == config.TARGET_INFO_STORE_SUFFIX:
+        return CompiledTargetInfo(info_file)
+    if info_file.is_file():
+        return CsvTargetInfo(info_file)
+    return None
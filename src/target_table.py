@@ -0,0 +1,235 @@
+# Python 3.7 Built-in packages
+import abc
+import array
+import mmap
+import os
+import struct
+import typing
+import zlib
+from pathlib import Path
+
+# Local packages
+from . import config
+from .database import FingerprintDatabase, ID_OFFSET_FORMAT
+
+# Target lookup tables : the targets of each database compound.
+#
+# Text files (<db>.tlt) hold one line per compound : its ChEMBL id then its targets, separated by spaces.
+# They are parsed into a dictionary on every run.
+#
+# Compiled files (<db>.tltb) are memory mapped and read without parsing :
+#     header          TLT_HEADER_SIZE bytes, see TLT_HEADER_FORMAT
+#     id offsets      (count + 1) little-endian uint32, offsets of each compound ID inside the id block
+#     id block        concatenated ascii compound IDs
+#     row offsets     (count + 1) little-endian uint32, compound i has the targets rows[i] <= j < rows[i + 1]
+#     targets         entry count little-endian uint32, interned target of each entry
+#     string offsets  (target count + 1) little-endian uint32, offsets of each target name inside the string block
+#     string block    concatenated utf-8 target names
+# Every section starts on an 8 bytes boundary. The id offsets and id block have the layout of the .bfp ones :
+# when compounds are in the order of the database (see write_target_table), a hit index is directly a row.
+# The checksum is the crc32 of everything following the header.
+# Target lists are kept exactly as the text file parsing gives them, empty names included.
+
+TLT_MAGIC = b"\x89TLT\r\n\x1a\n"
+TLT_VERSION = 1
+TLT_HEADER_SIZE = 64
+TLT_HEADER_FORMAT = "<8sIIQIIQQQQ"      # magic, version, header size, count, target count, checksum, row offset, entry offset, entry count, string offset
+ROW_OFFSET_FORMAT = "<I"
+TARGET_FORMAT = "<I"
+
+
+def _align(n: int, alignment: int = 8) -> int:
+    return (n + alignment - 1) // alignment * alignment
+
+
+class TltHeader(typing.NamedTuple):
+    version: int
+    header_size: int
+    count: int
+    target_count: int
+    checksum: int
+    row_offset: int
+    entry_offset: int
+    entry_count: int
+    string_offset: int
+
+    def pack(self) -> bytes:
+        return struct.pack(
+            TLT_HEADER_FORMAT
+            , TLT_MAGIC, self.version, self.header_size, self.count, self.target_count, self.checksum
+            , self.row_offset, self.entry_offset, self.entry_count, self.string_offset
+        ).ljust(self.header_size, b"\x00")
+
+    @classmethod
+    def unpack(cls, buffer) -> "TltHeader":
+        magic, *fields = struct.unpack_from(TLT_HEADER_FORMAT, buffer)
+        if magic != TLT_MAGIC:
+            raise ValueError("Not a compiled target lookup table.")
+        return cls(*fields)
+
+
+class TargetTable(abc.ABC):
+    """
+    Targets of the compounds of a database, looked up by hit : compound index in a fingerprint database.
+    """
+    @abc.abstractmethod
+    def targets(self, database: FingerprintDatabase, index: int) -> typing.List[str]:
+        raise NotImplementedError
+
+
+class TextTargetTable(TargetTable):
+    def __init__(self, table: typing.Dict[str, typing.List[str]]):
+        self.table = table
+
+    def targets(self, database: FingerprintDatabase, index: int) -> typing.List[str]:
+        return self.table.get(database.compound_id(index), [])
+
+
+class CompiledTargetTable(TargetTable):
+    """
+    Memory mapped compiled target lookup table. Every process working on the same file shares one page-cache copy,
+    only the target names are decoded (once).
+    """
+    def __init__(self, path: typing.Union[str, Path]):
+        self.path = Path(path)
+        with self.path.open("rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.header = header = TltHeader.unpack(self._mmap)
+        if header.version != TLT_VERSION:
+            raise ValueError("Unsupported target lookup table version {} in {}.".format(header.version, self.path))
+
+        view = memoryview(self._mmap)
+        self.count = header.count
+        id_block_offset = header.header_size + (header.count + 1) * 4
+        self.id_offsets = view[header.header_size:id_block_offset]
+        id_block_size, = struct.unpack_from(ID_OFFSET_FORMAT, self.id_offsets, self.count * 4)
+        self.id_block = view[id_block_offset:id_block_offset + id_block_size]
+        self.row_offsets = view[header.row_offset:header.row_offset + (header.count + 1) * 4]
+        self.entries = view[header.entry_offset:header.entry_offset + header.entry_count * 4]
+        string_offsets = view[header.string_offset:header.string_offset + (header.target_count + 1) * 4]
+        if len(self.row_offsets) != (self.count + 1) * 4 or len(string_offsets) != (header.target_count + 1) * 4:
+            raise ValueError("Truncated target lookup table {}.".format(self.path))
+        string_block_offset = header.string_offset + len(string_offsets)
+        bounds = struct.unpack_from("<{}I".format(header.target_count + 1), string_offsets)
+        string_block = bytes(view[string_block_offset:string_block_offset + bounds[-1]])
+        self.target_names: typing.List[str] = [string_block[start:end].decode(config.ENCODING) for start, end in zip(bounds, bounds[1:])]
+        self._row_maps: typing.Dict[str, typing.Optional[array.array]] = {}
+
+    def row_map(self, database: FingerprintDatabase) -> typing.Optional[array.array]:
+        """
+        Row of each compound of the database (-1 when absent), as native int32.
+        None when the table lists the compounds of the database in the same order, which is the case for tables compiled with it.
+        """
+        key = str(database.path)
+        if key not in self._row_maps:
+            if self.id_offsets == database.id_offsets and self.id_block == database.id_block:
+                self._row_maps[key] = None
+            else:
+                rows = {self.compound_id(i): i for i in range(self.count)}
+                self._row_maps[key] = array.array('i', (rows.get(database.compound_id(i), -1) for i in range(database.count)))
+        return self._row_maps[key]
+
+    def compound_id(self, row: int) -> str:
+        start, end = struct.unpack_from("<II", self.id_offsets, row * 4)
+        return bytes(self.id_block[start:end]).decode('ascii')
+
+    def row_targets(self, row: int) -> typing.List[str]:
+        start, end = struct.unpack_from("<II", self.row_offsets, row * 4)
+        return [self.target_names[t] for t in struct.unpack_from("<{}I".format(end - start), self.entries, start * 4)]
+
+    def targets(self, database: FingerprintDatabase, index: int) -> typing.List[str]:
+        row_map = self.row_map(database)
+        row = index if row_map is None else row_map[index]
+        return self.row_targets(row) if row >= 0 else []
+
+    def items(self) -> typing.Iterator[typing.Tuple[str, typing.List[str]]]:
+        for row in range(self.count):
+            yield self.compound_id(row), self.row_targets(row)
+
+    def verify(self) -> bool:
+        return zlib.crc32(memoryview(self._mmap)[self.header.header_size:]) == self.header.checksum
+
+    def __len__(self):
+        return self.count
+
+    def __reduce__(self):
+        # Memory views can't be pickled : child processes re-open (and re-map) the file instead
+        return self.__class__, (str(self.path),)
+
+
+def read_target_table(db_path: str) -> typing.Dict[str, typing.List[str]]:
+    text_ = Path(db_path + config.DEFAULT_TLT_FILE_SUFFIX).read_text()
+    return {l[0]: l[1:] for l in [line.split(' ') for line in text_.split('\n')]}
+
+
+def write_target_table(path: typing.Union[str, Path], table: typing.Dict[str, typing.List[str]]
+                       , database: typing.Optional[FingerprintDatabase] = None) -> TltHeader:
+    """
+    Compile a target lookup table. With a database, compounds are written in its order, so hit indices are rows :
+    compounds of the database missing from the table get no target, the others follow.
+    """
+    compound_ids = [database.compound_id(i) for i in range(database.count)] if database is not None else []
+    listed = set(compound_ids)
+    compound_ids += [compound_id for compound_id in table if compound_id not in listed]
+
+    target_ids: typing.Dict[str, int] = {}
+    id_offsets, id_block, row_offsets, entries = bytearray(), bytearray(), bytearray(), bytearray()
+    entry_count = 0
+    for compound_id in compound_ids:
+        id_offsets += struct.pack(ID_OFFSET_FORMAT, len(id_block))
+        id_block += compound_id.encode('ascii')
+        row_offsets += struct.pack(ROW_OFFSET_FORMAT, entry_count)
+        for target in table.get(compound_id, []):
+            entries += struct.pack(TARGET_FORMAT, target_ids.setdefault(target, len(target_ids)))
+            entry_count += 1
+    id_offsets += struct.pack(ID_OFFSET_FORMAT, len(id_block))
+    row_offsets += struct.pack(ROW_OFFSET_FORMAT, entry_count)
+
+    string_offsets, string_block = bytearray(), bytearray()
+    for target in target_ids:  # Insertion order : target i is the i-th interned
+        string_offsets += struct.pack(ROW_OFFSET_FORMAT, len(string_block))
+        string_block += target.encode(config.ENCODING)
+    string_offsets += struct.pack(ROW_OFFSET_FORMAT, len(string_block))
+
+    sections = [bytes(id_offsets + id_block), bytes(row_offsets), bytes(entries), bytes(string_offsets + string_block)]
+    offsets = []
+    body = bytearray()
+    for section in sections:
+        body += b"\x00" * (_align(TLT_HEADER_SIZE + len(body)) - TLT_HEADER_SIZE - len(body))
+        offsets.append(TLT_HEADER_SIZE + len(body))
+        body += section
+
+    header = TltHeader(
+        version=TLT_VERSION
+        , header_size=TLT_HEADER_SIZE
+        , count=len(compound_ids)
+        , target_count=len(target_ids)
+        , checksum=zlib.crc32(body)
+        , row_offset=offsets[1]
+        , entry_offset=offsets[2]
+        , entry_count=entry_count
+        , string_offset=offsets[3]
+    )
+    with open(str(path), "wb") as f:
+        f.write(header.pack())
+        f.write(body)
+    return header
+
+
+def target_table_file(db_path: str) -> Path:
+    """
+    File the target lookup table of a database is read from : the compiled one when it is present
+    and not older than the text one, else the text one.
+    """
+    text_file = Path(db_path + config.DEFAULT_TLT_FILE_SUFFIX)
+    compiled_file = Path(db_path + config.COMPILED_TLT_FILE_SUFFIX)
+    if compiled_file.is_file() and (not text_file.is_file() or os.stat(str(compiled_file)).st_mtime_ns >= os.stat(str(text_file)).st_mtime_ns):
+        return compiled_file
+    return text_file
+
+
+def open_target_table(db_path: str) -> TargetTable:
+    table_file = target_table_file(db_path)
+    if table_file.suffix == config.COMPILED_TLT_FILE_SUFFIX:
+        return CompiledTargetTable(table_file)
+    return TextTargetTable(read_target_table(db_path))
@@ -81,20 +81,24 @@ help_format = """\
 Result output format.
 
     Default: txt
-    Allow to choose a format file for printing results. Currently support .csv and .txt
+    Allow to choose a format file for printing results. Currently support .txt, .csv, .jsonl and .csv.gz
     Example:
             -f txt                      (output in the default txt formatted file)
+            -f csv.gz -o out.csv.gz     (gzip compressed csv, needs an output file)
 
     List of accepted file format :
             txt
             csv
+            jsonl                       (one JSON object per query molecule and line)
+            csv.gz
 
 """
 help_cpu = """\
 Number of CPUs used for the computations.
 
     Default: 4
-    Allow to choose the number of CPUs used during the Tanimoto calculations. (This does not affect prior maya calculation)
+    Allow to choose the number of CPUs used during the maya and Tanimoto calculations.
+    Query molecules are split into shards of at least 200 molecules, computed by up to -cpu concurrent maya subprocesses.
     Example:
             -cpu 8                      (run Tanimoto's calculations on 8 cores)
     
@@ -120,6 +124,112 @@ Show or not information about target hits.
             -noinfo                       (hide information)
     
 """
+help_backend = """\
+Execution backend of the Tanimoto calculations.
+
+    Default: processes
+    processes : molecules are split among -cpu processes. Data is shared through a multiprocessing manager.
+    threads   : molecules are computed by -cpu threads of the main process. Databases, targets and information
+                are shared without any copy nor inter-process communication. Usually faster on small and medium jobs.
+    Example:
+            -backend threads            (run Tanimoto's calculations in a thread pool)
+
+"""
+help_topk = """\
+Keep only the best database compounds of each query molecule while computing.
+
+    Default: disabled
+    The Tanimoto calculation keeps the -nbt best scoring database compounds of each query molecule (highest
+    zscore mean in consensus, highest Tanimoto coefficient otherwise) instead of every compound passing the thresholds.
+    It bounds the memory and time spent on hits that are never reported, which matters with low thresholds.
+    Combined with -bppt, the report is identical to a run without -topk as long as every compound has a target,
+    except for the order and choice of rows tied with the last reported score.
+    Without -bppt, several of the best compounds may share a target : the report may then list fewer than -nbt
+    targets, or miss some targets only reached by lower scoring compounds.
+    Requires -nbt greater than 1.
+    Example:
+            -topk -nbt 25 -bppt         (compute and report the 25 best hits of each query)
+
+"""
+help_provider = """\
+Tool computing the query fingerprints.
+
+    Default: maya
+    maya  : MayaChemTools scripts, run in a Perl subprocess for each fingerprint.
+    rdkit : RDKit, in process and without intermediate files. Much faster on large query libraries, but
+            RDKit fingerprints only match databases built with RDKit (see db/bfp_from_sdf.py) : databases
+            built by another provider are refused.
+            Requires RDKit. PL fingerprints are always computed by maya.
+    The throughput of each fingerprint calculation is reported.
+    Example:
+            -provider rdkit             (compute ECFP4, ECFP6 and MACCS fingerprints with RDKit)
+
+"""
+help_nofpcache = """\
+Compute every query fingerprint, without the fingerprint cache.
+
+    Default: use the cache
+    Query fingerprints are kept in cache/query_fingerprints.sqlite, keyed by the structure of each molecule
+    (its molfile without header nor data fields), the fingerprint and the provider settings.
+    Molecules already fingerprinted by a previous run are not sent to maya again. The least recently used
+    fingerprints are evicted past 2 million entries.
+    Example:
+            -nofpcache                  (neither read nor fill the cache)
+
+"""
+help_resultcache = """\
+Reuse the results of previous runs.
+
+    Default: disabled
+    The hits of each query molecule are kept in cache/results.sqlite, keyed by its fingerprints, the checksum
+    of the database files (.bfp and .tlt) and the -fp, -tc, -sd, -bppt and -topk settings.
+    Molecules found in the cache skip the Tanimoto calculation. Results of a database are never reused once
+    its files change. The least recently used results are evicted past 1 GB.
+    Example:
+            -resultcache                (reuse and store results)
+
+"""
+help_profile = """\
+Record the time spent in each stage of the run and write it as a Chrome trace.
+
+    Default: disabled, out/profile.json when no file is given
+    Stages (SD file checking, maya runs, database loading, each Tanimoto kernel call, best match per target,
+    output formatting, queue waits ...) are recorded in every process and thread, with the memory of each
+    process sampled every 0.1s. Open the file in chrome://tracing or https://ui.perfetto.dev.
+    A summary table (time per stage, peak memory per process) is printed at the end of the run.
+    Example:
+            -profile                    (write out/profile.json)
+            -profile run.json           (write run.json)
+
+"""
+help_shards = """\
+Split the databases into shards, each one scanned by its own process.
+
+    Default: 1 (no sharding)
+    Each query molecule is compared to every shard at once, so a single large query uses as many cores as shards.
+    Shards send back the statistics of their Tanimoto coefficients and their hits passing the -tc threshold :
+    zscores are computed over the whole databases, and the hits are the same as without sharding (zscores may
+    only differ in their last digits, the sums of the shards being added up in another order).
+    The Tanimoto calculation then runs in the main process, whatever the -cpu and -backend options.
+    Example:
+            -shards 4                   (scan each database in 4 slices, in 4 processes)
+
+"""
+server_abstract = """\
+Keep databases in memory and answer prediction requests (FastTargetPred arguments and query molecules) over a local socket.
+"""
+help_server_db = "Database(s) loaded at start up (default: chembl25). Requests use the first one unless they give -db : other databases are loaded on first use."
+help_server_fp = "Fingerprint(s) of the databases loaded at start up (default: all the fingerprints found)."
+help_server_cpu = "Number of threads computing tanimoto, shared by all requests."
+help_server_port = "Port of the HTTP server, on localhost (default: {})."
+help_server_socket = "Listen on this Unix socket instead of a localhost port."
+server_loading = "{:<40}".format("Loading databases ...")
+server_loaded = "{:<40}".format("{} database files loaded in {:.2f}s")
+server_listening = "{:<40}".format("Prediction server listening on {}")
+server_stopped = "Prediction server stopped."
+server_query_error = "A request must hold either an \"sdf\" text or \"fingerprints\", not both."
+server_request_error = "Invalid request : {}"
+server_path_error = "Unknown path {}."
 system_not_ok = """\
 System verification found an anomaly in your system setup. Here is some hint(s) on how to correct it :\n
 """
@@ -129,12 +239,18 @@ check_arg = "{:<40}".format("Checking input arguments ...")
 start_maya = "{:<40}".format("Starting maya calculation ...")
 maya_time_estimation = "{:<40}".format("Estimated time : {:> 6}s ...")
 maya_finished = "{:<40}".format("Time for maya calculation: {}")
+fingerprint_throughput = "{:<40}".format("{} fingerprints ({}): {} molecules in {:.2f}s ({:.0f} molecules/s)")
 start_tanimoto = "{:<40}".format("Starting tanimoto computation on {} cores.")
+popcount_kernel = "{:<40}".format("Popcount kernel in use: {}")
+fingerprint_cache_statistics = "{:<40}".format("Fingerprint cache: {} hits, {} misses ({:.1f} % hit rate), {} evicted")
+result_cache_statistics = "{:<40}".format("Result cache: {} hits, {} misses ({:.1f} % hit rate), {} evicted")
+pruned_compounds = "{:<40}".format("Compounds pruned by popcount bounds: {} / {} ({:.1f} %)")
+profile_written = "{:<40}".format("Profile written in {}")
 checked = 'ok'
 sdf_no_mol_name_error = "Error found in input SDfile {}. Molecule number {} has no name."
 sdf_mol_name_duplicate_error = "Duplicate name found in input SDFile {}: {}. Is that the same molecule ?"
 sdf_checked = "Input SD file(s) checked."
-merge_error = "0 molecules retrieved from provided SDFs during file merge."
+no_molecule_error = "0 molecules retrieved from provided SDFs."
 molecules_found = 'A total of {} molecules has been found.'
 sdf_merged = 'Input SD files merged into {}'
 processing_results = "Processing results ..."
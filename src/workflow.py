@@ -5,11 +5,14 @@ from time import time
 from src.arg_parsing import UserArguments, NUM_CORE
 from src.fingerprints import FingerprintList
 from src.molecules import MoleculeList
-from src import texts
+from src.molecule import popcount_kernel
+from src import texts, profiling
 
 def start():
     # Parsing the user arguments
     user_args = UserArguments.get()
+    if user_args.profile_file is not None:
+        profiling.enable()
     print(texts.check_arg, end='')
     error, msg = not user_args.are_ok(), user_args.errormsg
     query_dicts = []
@@ -27,16 +30,32 @@ def start():
         fps = FingerprintList(user_args, sdf)
         fps.create_fingerprints()
         t0 = time()
-        query_dicts = fps.generate_molecule_files()
+        with profiling.span("fingerprint_calculation"):
+            query_dicts = fps.generate_molecule_files()
+        user_args.sdf_index.close()
 
         print(texts.checked)
         print(texts.maya_finished.format(time() - t0))
+        for fp in fps.fp_list:
+            print(texts.fingerprint_throughput.format(fp.name, fp.provider.name, len(fp.fingerprints), fp.calculation_time, fp.throughput))
 
         print(texts.start_tanimoto.format(user_args.dict[NUM_CORE]))
+        print(texts.popcount_kernel.format(popcount_kernel()))
 
         molecules = MoleculeList.create_list(user_args, query_dicts, fps)
-        molecules.compute_fingerprints()
-
+        with profiling.span("tanimoto_calculation"):
+            molecules.compute_fingerprints()
+
+        if fps.fingerprint_cache is not None:
+            cache = fps.fingerprint_cache
+            print(texts.fingerprint_cache_statistics.format(cache.hits, cache.misses, cache.hit_rate, cache.evictions))
+            cache.close()
+
+        profiler = profiling.current()
+        if profiler is not None:
+            profiler.write(user_args.profile_file)
+            print(profiler.summary())
+            print(texts.profile_written.format(user_args.profile_file))
 
 
     if error:
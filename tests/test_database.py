@@ -0,0 +1,40 @@
+# Python 3.7 Built-in packages
+import tempfile
+import unittest
+from pathlib import Path
+
+# Local packages
+from src import config
+from src.database import FingerprintDatabase, open_database, read_provider, write_database
+
+DB_PATH = str(Path(__file__).resolve().parent.parent / "db" / "approved-drugs")
+
+
+class DatabaseProviderTest(unittest.TestCase):
+    def setUp(self):
+        self.model = open_database(DB_PATH, "MACCS")
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = Path(self.folder.name) / "rdkit_MACCS.bfp"
+        write_database(self.path, self.model.records(), self.model.fp_size, provider=config.RDKIT_PROVIDER)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_provider_recorded(self):
+        self.assertEqual(read_provider(self.path), config.RDKIT_PROVIDER)
+        database = FingerprintDatabase(self.path, self.model.fp_size, config.RDKIT_PROVIDER)
+        self.assertEqual(database.provider, config.RDKIT_PROVIDER)
+        self.assertEqual(list(database.records()), list(self.model.records()))
+
+    def test_provider_mismatch_refused(self):
+        with self.assertRaises(ValueError):
+            FingerprintDatabase(self.path, self.model.fp_size, config.MAYA_PROVIDER)
+
+    def test_unrecorded_provider(self):
+        # Databases that don't record their provider were computed by MayaChemTools
+        self.assertEqual(self.model.provider, config.DEFAULT_DATABASE_PROVIDER)
+        self.assertEqual(read_provider("{}_MACCS.bfp".format(DB_PATH)), config.DEFAULT_DATABASE_PROVIDER)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+# Python 3.7 Built-in packages
+import tempfile
+import unittest
+from pathlib import Path
+
+# Local packages
+from src.fingerprint_cache import molecule_key
+from src.sdf_index import SDFIndex
+
+SDF_PATH = Path(__file__).resolve().parent.parent / "test_set" / "sample_1k.sdf"
+SIGNATURE = "maya ECFP4"
+
+
+class MoleculeKeyTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        index = SDFIndex([SDF_PATH])
+        cls.block = index.block(0)
+        index.close()
+        cls.key = molecule_key(cls.block, SIGNATURE)
+
+    def replace_line(self, line_number: int, line: str) -> str:
+        lines = self.block.split('\n')
+        lines[line_number] = line
+        return '\n'.join(lines)
+
+    def test_header_ignored(self):
+        lines = self.block.split('\n')
+        block = '\n'.join(["other name", "  FastTargetPred0101002D", "a comment"] + lines[3:])
+        self.assertEqual(molecule_key(block, SIGNATURE), self.key)
+
+    def test_data_fields_ignored(self):
+        block = self.block.replace("M  END", "M  END\n> <chembl_id>\nCHEMBL1\n\n> <source>\ntest\n", 1)
+        self.assertEqual(molecule_key(block, SIGNATURE), self.key)
+
+    def test_line_endings_ignored(self):
+        self.assertEqual(molecule_key(self.block.replace('\n', '\r\n'), SIGNATURE), self.key)
+        self.assertEqual(molecule_key(self.block.replace('\n', '  \n'), SIGNATURE), self.key)
+
+    def test_crlf_file(self):
+        # Same molecule read from a SD file with CRLF line endings
+        with tempfile.TemporaryDirectory() as folder:
+            sdf = Path(folder) / "crlf.sdf"
+            sdf.write_bytes((self.block.rstrip('\n') + "\n$$$$\n").replace('\n', '\r\n').encode('ascii'))
+            index = SDFIndex([sdf])
+            self.assertEqual(molecule_key(index.block(0), SIGNATURE), self.key)
+            index.close()
+
+    def test_structure_change(self):
+        lines = self.block.split('\n')
+        atom_line = lines[4]
+        self.assertNotEqual(molecule_key(self.replace_line(4, atom_line[:31] + "N" + atom_line[32:]), SIGNATURE), self.key)
+        bond_line = lines.index("M  END") - 1
+        bond = lines[bond_line]
+        other_order = "2" if bond[8] == "1" else "1"
+        self.assertNotEqual(molecule_key(self.replace_line(bond_line, bond[:8] + other_order + bond[9:]), SIGNATURE), self.key)
+
+    def test_signature_change(self):
+        self.assertNotEqual(molecule_key(self.block, "maya ECFP6"), self.key)
+
+
+if __name__ == "__main__":
+    unittest.main()
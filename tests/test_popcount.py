@@ -0,0 +1,45 @@
+# Python 3.7 Built-in packages
+import unittest
+from pathlib import Path
+
+# Local packages
+from src.database import open_database, kernel_arguments
+from src.fingerprints import QueryFingerprints
+from src.molecule import tc_process_arrays, popcount_kernel, popcount_self_test
+
+DB_PATH = str(Path(__file__).resolve().parent.parent / "db" / "approved-drugs")
+
+
+class PopcountKernelTest(unittest.TestCase):
+    def test_self_test(self):
+        # Every kernel supported by the CPU counts the same bits as the lookup table
+        results = popcount_self_test()
+        self.assertIn("table", results)
+        self.assertTrue(all(results.values()), results)
+
+    def test_kernel_in_use_passed(self):
+        self.assertTrue(popcount_self_test()[popcount_kernel()])
+
+    def test_same_scores_with_every_kernel(self):
+        database = open_database(DB_PATH, "ECFP4")
+        queries = QueryFingerprints([database.fp_size])
+        for i in range(0, len(database), len(database) // 8):
+            queries.add(database.compound_id(i), [bytes(database.fingerprints[i * database.stride:(i + 1) * database.stride])])
+        arguments = queries.kernel_arguments(list(range(len(queries))))
+        kernel_in_use = popcount_kernel()
+        try:
+            scores = {}
+            for name in popcount_self_test():
+                popcount_kernel(name)
+                scores[name] = [
+                    (bytes(indices), bytes(tcs))
+                    for indices, tcs, zscores, pruned_number in tc_process_arrays(*arguments, kernel_arguments([database]), [0.3], 0., False)
+                ]
+        finally:
+            popcount_kernel(kernel_in_use)
+        for name, kernel_scores in scores.items():
+            self.assertEqual(kernel_scores, scores["table"], name)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+# Python 3.7 Built-in packages
+import os
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+# Local packages
+from src import config
+from src.result_cache import ResultCache, result_key
+
+DB_PATH = Path(__file__).resolve().parent.parent / "db"
+DATABASE_FILES = ["approved-drugs_ECFP4.bfp", "approved-drugs_MACCS.bfp", "approved-drugs.tlt"]
+# Same layout as MoleculeList._take_cached_results : fingerprints, tc thresholds, zscore threshold, consensus, top_k, -bppt
+PARAMETERS = (["ECFP4", "MACCS"], [0.45, 0.75], 1.5, True, 0, False)
+
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        folder = Path(self.folder.name)
+        self.database_files = []
+        for file_name in DATABASE_FILES:
+            shutil.copyfile(str(DB_PATH / file_name), str(folder / file_name))
+            self.database_files.append(folder / file_name)
+        self.cache = ResultCache(folder / "results.sqlite", config.RESULT_CACHE_MAX_BYTES)
+
+    def tearDown(self):
+        self.cache.close()
+        self.folder.cleanup()
+
+    def signature(self, parameters: tuple = PARAMETERS) -> bytes:
+        return self.cache.run_signature(self.database_files, parameters)
+
+    def touch(self, path: Path):  # Move the modification time of a file forward, whatever the file system resolution
+        stat = os.stat(str(path))
+        os.utime(str(path), ns=(stat.st_atime_ns, stat.st_mtime_ns + 2 * 10 ** 9))
+
+    def test_same_run(self):
+        self.assertEqual(self.signature(), self.signature())
+
+    def test_results_found(self):
+        key = result_key(self.signature(), b"\x01\x02")
+        results = {"CHEMBL1": [("CHEMBL2", 0.5)]}
+        self.cache.put_results([(key, results)])
+        self.assertEqual(self.cache.get_results([key, result_key(self.signature(), b"\x01\x03")]), {key: results})
+
+    def test_database_size_change(self):
+        signature = self.signature()
+        with self.database_files[0].open("ab") as f:
+            f.write(b"\x00")
+        self.assertNotEqual(self.signature(), signature)
+
+    def test_database_content_change(self):
+        # Same size, later modification time
+        signature = self.signature()
+        data = bytearray(self.database_files[1].read_bytes())
+        data[-1] ^= 0xff
+        self.database_files[1].write_bytes(bytes(data))
+        self.touch(self.database_files[1])
+        self.assertNotEqual(self.signature(), signature)
+
+    def test_target_table_change(self):
+        signature = self.signature()
+        with self.database_files[2].open("a") as f:
+            f.write("CHEMBL0 CHEMBL0\n")
+        self.assertNotEqual(self.signature(), signature)
+
+    def test_database_touched(self):
+        # Checksum computed again, same content : the cached results are still found
+        signature = self.signature()
+        self.touch(self.database_files[0])
+        self.assertEqual(self.signature(), signature)
+
+    def test_option_change(self):
+        fingerprints, tc_thresholds, zscore_threshold, consensus, top_k, not_filter_best_match_per_target = PARAMETERS
+        signature = self.signature()
+        for parameters in [
+            (["ECFP4"], tc_thresholds[:1], zscore_threshold, False, top_k, not_filter_best_match_per_target)
+            , (fingerprints, [0.45, 0.8], zscore_threshold, consensus, top_k, not_filter_best_match_per_target)
+            , (fingerprints, tc_thresholds, 2., consensus, top_k, not_filter_best_match_per_target)
+            , (fingerprints, tc_thresholds, zscore_threshold, consensus, 15, not_filter_best_match_per_target)
+            , (fingerprints, tc_thresholds, zscore_threshold, consensus, top_k, True)
+        ]:
+            self.assertNotEqual(self.signature(parameters), signature, parameters)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+# Python 3.7 Built-in packages
+import unittest
+from pathlib import Path
+
+# Local packages
+from src.database import open_database, kernel_arguments
+from src.fingerprints import QueryFingerprints
+from src.molecule import HitArrays, tc_process_arrays, tc_process_shard
+from src.shards import ShardHits, ShardPool, merge_shard_hits
+
+DB_PATH = str(Path(__file__).resolve().parent.parent / "db" / "approved-drugs")
+FP_NAMES = ["ECFP4", "MACCS", "PL"]
+TC_THRESHOLDS = [0.3, 0.6, 0.5]
+ZSCORE_TOLERANCE = 1e-9  # Shard statistics are summed in another order than the kernel sums the whole databases
+
+
+class ShardTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.databases = [open_database(DB_PATH, fp_name) for fp_name in FP_NAMES]
+        cls.database_arguments = kernel_arguments(cls.databases)
+        cls.queries = QueryFingerprints([database.fp_size for database in cls.databases])
+        for i in range(0, len(cls.databases[0]), len(cls.databases[0]) // 12):
+            cls.queries.add(cls.databases[0].compound_id(i), [
+                bytes(database.fingerprints[i * database.stride:(i + 1) * database.stride]) for database in cls.databases
+            ])
+        cls.rows = list(range(len(cls.queries)))
+
+    def expected_hits(self, fingerprint_number: int, zscore_threshold: float, normalize: bool, top_k: int):
+        return [
+            HitArrays.from_kernel(results) for results in tc_process_arrays(
+                *self.queries.kernel_arguments(self.rows), self.database_arguments[:fingerprint_number]
+                , TC_THRESHOLDS[:fingerprint_number], zscore_threshold, normalize, top_k
+            )
+        ]
+
+    def sharded_hits(self, shard_number: int, fingerprint_number: int, zscore_threshold: float, normalize: bool, top_k: int):
+        shard_results = [
+            tc_process_shard(
+                *self.queries.kernel_arguments(self.rows), self.database_arguments[:fingerprint_number]
+                , TC_THRESHOLDS[:fingerprint_number], normalize, top_k, shard_index, shard_number
+            )
+            for shard_index in range(shard_number)
+        ]
+        return [
+            merge_shard_hits(
+                [ShardHits.from_kernel(results[row]) for results in shard_results], fingerprint_number, zscore_threshold
+                , normalize, top_k
+            )
+            for row in self.rows
+        ]
+
+    def assert_same_hits(self, hits: HitArrays, expected: HitArrays):
+        self.assertEqual(list(hits.indices), list(expected.indices))
+        self.assertEqual(list(hits.tcs), list(expected.tcs))
+        self.assertEqual(len(hits.zscores), len(expected.zscores))
+        for zscore, expected_zscore in zip(hits.zscores, expected.zscores):
+            self.assertAlmostEqual(zscore, expected_zscore, delta=ZSCORE_TOLERANCE)
+
+    def check_shards(self, fingerprint_number: int, zscore_threshold: float, normalize: bool, top_k: int):
+        expected = self.expected_hits(fingerprint_number, zscore_threshold, normalize, top_k)
+        self.assertTrue(any(len(hits.indices) > 0 for hits in expected))
+        for shard_number in [1, 3]:
+            for hits, expected_hits in zip(self.sharded_hits(shard_number, fingerprint_number, zscore_threshold, normalize, top_k), expected):
+                self.assert_same_hits(hits, expected_hits)
+
+    def test_tc_threshold(self):
+        self.check_shards(1, 0., False, 0)
+
+    def test_top_k(self):
+        self.check_shards(1, 0., False, 5)
+
+    def test_consensus_zscores(self):
+        self.check_shards(len(FP_NAMES), 0., True, 0)
+
+    def test_consensus_zscore_threshold(self):
+        self.check_shards(len(FP_NAMES), 5., True, 0)
+
+    def test_consensus_top_k(self):
+        self.check_shards(len(FP_NAMES), 0., True, 5)
+
+    def test_shard_pool(self):
+        # Same results from the shard processes as from the kernel run in this process
+        shard_pool = ShardPool(self.databases, 3)
+        try:
+            results = shard_pool.compare(self.queries.block_arguments(self.rows), TC_THRESHOLDS, True, 0)
+        finally:
+            shard_pool.close()
+        expected = self.expected_hits(len(FP_NAMES), 0., True, 0)
+        for row, expected_hits in zip(self.rows, expected):
+            hits = merge_shard_hits([ShardHits.from_kernel(shard_results[row]) for shard_results in results], len(FP_NAMES), 0., True, 0)
+            self.assert_same_hits(hits, expected_hits)
+
+
+if __name__ == "__main__":
+    unittest.main()
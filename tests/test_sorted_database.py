@@ -0,0 +1,57 @@
+# Python 3.7 Built-in packages
+import tempfile
+import typing
+import unittest
+from pathlib import Path
+
+# Local packages
+from src.database import FingerprintDatabase, convert_database, open_database, kernel_arguments
+from src.fingerprints import QueryFingerprints
+from src.molecule import HitArrays, tc_process_arrays
+
+DB_PATH = str(Path(__file__).resolve().parent.parent / "db" / "approved-drugs")
+TC_THRESHOLD = 0.6
+
+
+class SortedDatabaseTest(unittest.TestCase):
+    # A database sorted by popcount gives the hits of the unsorted one, the kernel skipping the compounds out of bounds
+    def setUp(self):
+        self.database = open_database(DB_PATH, "ECFP4")
+        self.folder = tempfile.TemporaryDirectory()
+        sorted_path = Path(self.folder.name) / "sorted_ECFP4.bfp"
+        convert_database(self.database.path, sorted_path, self.database.fp_size, sort_by_popcount=True)
+        self.sorted_database = FingerprintDatabase(sorted_path, self.database.fp_size)
+        self.queries = QueryFingerprints([self.database.fp_size])
+        for i in range(0, len(self.database), 7):
+            self.queries.add(self.database.compound_id(i), [
+                bytes(self.database.fingerprints[i * self.database.stride:(i + 1) * self.database.stride])
+            ])
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def hits(self, database: FingerprintDatabase) -> typing.List[HitArrays]:
+        results = tc_process_arrays(
+            *self.queries.kernel_arguments(list(range(len(self.queries)))), kernel_arguments([database]), [TC_THRESHOLD], 0., False
+        )
+        return [HitArrays.from_kernel(query_results) for query_results in results]
+
+    def test_sorted(self):
+        self.assertTrue(self.sorted_database.is_sorted)
+        self.assertFalse(self.database.is_sorted)
+        self.assertEqual(sorted(self.sorted_database.records()), sorted(self.database.records()))
+
+    def test_same_hits(self):
+        pruned_number = 0
+        for hits, sorted_hits in zip(self.hits(self.database), self.hits(self.sorted_database)):
+            self.assertEqual(hits.pruned_number, 0)
+            pruned_number += sorted_hits.pruned_number
+            self.assertEqual(
+                sorted((self.database.compound_id(index), tc) for index, tc in zip(hits.indices, hits.tcs))
+                , sorted((self.sorted_database.compound_id(index), tc) for index, tc in zip(sorted_hits.indices, sorted_hits.tcs))
+            )
+        self.assertGreater(pruned_number, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()